@@ -0,0 +1,319 @@
+'''
+    Benchmarks for flask_pbj's hot paths: dict and message conversion, the
+    codecs' request parsing and response encoding, and full api round trips
+    through the flask test client.
+
+    Run with `python benchmarks.py`. Results are written as JSON; save them
+    as a baseline with --save and check a later run against it with
+    --compare, which exits with status 1 when any benchmark is slower than
+    the baseline by more than --threshold.
+'''
+import argparse
+import platform
+import sys
+import timeit
+from json import dumps, load
+
+import flask
+from google.protobuf.descriptor import Descriptor, FieldDescriptor
+from google.protobuf.message import Message
+from google.protobuf.reflection import GeneratedProtocolMessageType
+
+import flask_pbj
+from flask_pbj import (
+    Pbj, api, copy_dict_to_pb, copy_pb_to_dict, json, protobuf
+)
+from test_pb import Person, Village
+
+# Seconds each timing repeat should take at least
+MIN_REPEAT_TIME = 0.2
+
+_DEFAULTS = {
+    FieldDescriptor.TYPE_BOOL: False,
+    FieldDescriptor.TYPE_DOUBLE: 0.0,
+    FieldDescriptor.TYPE_INT32: 0,
+    FieldDescriptor.TYPE_INT64: 0,
+    FieldDescriptor.TYPE_STRING: u'',
+}
+
+
+def make_message_type(name, fields):
+    """
+        Build a message type from a list of (name, type, label, message_type)
+        field definitions, the way generated _pb2 modules do.
+    """
+    descriptors = []
+    for index, (field_name, field_type, label, message_type) in enumerate(
+        fields
+    ):
+        if label == FieldDescriptor.LABEL_REPEATED:
+            default = []
+        else:
+            default = _DEFAULTS.get(field_type)
+        descriptors.append(FieldDescriptor(
+            name=field_name, full_name=name + '.' + field_name, index=index,
+            number=index + 1, type=field_type,
+            cpp_type=FieldDescriptor.ProtoTypeToCppProtoType(field_type),
+            label=label, has_default_value=False, default_value=default,
+            message_type=message_type and message_type.DESCRIPTOR,
+            enum_type=None, containing_type=None, is_extension=False,
+            extension_scope=None, options=None
+        ))
+    descriptor = Descriptor(
+        name=name, full_name=name, filename=None, containing_type=None,
+        fields=descriptors, nested_types=[], enum_types=[], extensions=[]
+    )
+    return GeneratedProtocolMessageType(
+        name,
+        (Message,),
+        {'DESCRIPTOR': descriptor}
+    )
+
+
+def make_deep_type(depth):
+    """
+        A chain of depth nested messages, each with a value, a name and a
+        child.
+    """
+    message_type = None
+    for level in reversed(range(depth)):
+        fields = [
+            ('value', FieldDescriptor.TYPE_INT32,
+             FieldDescriptor.LABEL_OPTIONAL, None),
+            ('name', FieldDescriptor.TYPE_STRING,
+             FieldDescriptor.LABEL_OPTIONAL, None),
+        ]
+        if message_type is not None:
+            fields.append(('child', FieldDescriptor.TYPE_MESSAGE,
+                           FieldDescriptor.LABEL_OPTIONAL, message_type))
+        message_type = make_message_type('Level{0}'.format(level), fields)
+    return message_type
+
+
+def make_deep_dict(depth):
+    data = None
+    for level in reversed(range(depth)):
+        node = {'value': level, 'name': u'level {0}'.format(level)}
+        if data is not None:
+            node['child'] = data
+        data = node
+    return data
+
+
+WIDE_TYPES = (
+    FieldDescriptor.TYPE_INT32,
+    FieldDescriptor.TYPE_STRING,
+    FieldDescriptor.TYPE_DOUBLE,
+    FieldDescriptor.TYPE_BOOL,
+    FieldDescriptor.TYPE_INT64,
+)
+
+WIDE_VALUES = {
+    FieldDescriptor.TYPE_BOOL: True,
+    FieldDescriptor.TYPE_DOUBLE: 1.5,
+    FieldDescriptor.TYPE_INT32: 12345,
+    FieldDescriptor.TYPE_INT64: 1 << 40,
+    FieldDescriptor.TYPE_STRING: u'a wide field',
+}
+
+
+def make_wide_type(width):
+    """
+        A message with width scalar fields of mixed types.
+    """
+    return make_message_type('Wide', [
+        ('field{0}'.format(index), WIDE_TYPES[index % len(WIDE_TYPES)],
+         FieldDescriptor.LABEL_OPTIONAL, None)
+        for index in range(width)
+    ])
+
+
+def make_wide_dict(width):
+    return dict(
+        ('field{0}'.format(index),
+         WIDE_VALUES[WIDE_TYPES[index % len(WIDE_TYPES)]])
+        for index in range(width)
+    )
+
+
+def make_village_dict(size):
+    return {
+        'people': [
+            {'id': index, 'name': u'Person {0}'.format(index),
+             'email': u'person{0}@example.com'.format(index)}
+            for index in range(size)
+        ],
+        'numbers': range(size),
+    }
+
+
+def messages():
+    """
+        Return (name, message type, dict) for each benchmarked message.
+    """
+    return [
+        ('person', Person,
+         {'id': 1, 'name': u'Jim', 'email': u'jim@example.com'}),
+        ('village', Village, make_village_dict(10)),
+        ('deep', make_deep_type(32), make_deep_dict(32)),
+        ('wide', make_wide_type(200), make_wide_dict(200)),
+        ('large', Village, make_village_dict(5000)),
+    ]
+
+
+class BenchRequest(object):
+    """
+        Stands in for a request in the codec benchmarks so only the codec is
+        measured.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.message = None
+
+    def get_data(self, *args, **kwargs):
+        return self.data
+
+
+def make_app(message_type):
+    app = flask.Flask(__name__)
+
+    @app.route('/echo', methods=['POST'])
+    @api(json, protobuf(receives=message_type, sends=message_type))
+    def echo():
+        return flask.request.data_dict
+
+    Pbj(app)
+    return app
+
+
+def benchmarks():
+    """
+        Yield (name, function) for each benchmark.
+    """
+    for name, message_type, data in messages():
+        message = message_type()
+        copy_dict_to_pb(message, data)
+        pb_body = message.SerializeToString()
+        json_body = dumps(data)
+        pb_codec = protobuf(receives=message_type, sends=message_type)
+        array_codec = protobuf(receives=message_type, sends=message_type,
+                               arrays=True)
+
+        yield ('copy_dict_to_pb.' + name,
+               lambda m=message_type, d=data: copy_dict_to_pb(m(), d))
+        yield ('copy_pb_to_dict.' + name,
+               lambda m=message: copy_pb_to_dict({}, m))
+        yield ('json.parse_request_data.' + name,
+               lambda b=json_body:
+               json.parse_request_data(BenchRequest(b)))
+        yield ('json.make_response.' + name,
+               lambda d=data: json.make_response(d, 200, {}))
+        yield ('protobuf.parse_request_data.' + name,
+               lambda c=pb_codec, b=pb_body:
+               c.parse_request_data(BenchRequest(b)))
+        yield ('protobuf.make_response.' + name,
+               lambda c=pb_codec, d=data: c.make_response(d, 200, {}))
+        yield ('protobuf.arrays.parse_request_data.' + name,
+               lambda c=array_codec, b=pb_body:
+               c.parse_request_data(BenchRequest(b)))
+        yield ('protobuf.arrays.make_response.' + name,
+               lambda c=array_codec, d=data: c.make_response(d, 200, {}))
+
+        client = make_app(message_type).test_client()
+        for format_name, mimetype, body in (
+            ('json', 'application/json', json_body),
+            ('protobuf', 'application/x-protobuf', pb_body),
+        ):
+            headers = {'Content-Type': mimetype, 'Accept': mimetype}
+            yield ('api.{0}.{1}'.format(format_name, name),
+                   lambda c=client, b=body, h=headers:
+                   c.post('/echo', data=b, headers=h))
+
+
+def time_benchmark(function, repeat):
+    """
+        Return the best seconds per call of function, calling it enough times
+        per repeat to take at least MIN_REPEAT_TIME.
+    """
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < MIN_REPEAT_TIME:
+        number *= 2
+    return min(timer.repeat(repeat, number)) / number
+
+
+def run(repeat, pattern=None):
+    results = {}
+    for name, function in benchmarks():
+        if pattern and pattern not in name:
+            continue
+        seconds = time_benchmark(function, repeat)
+        results[name] = {'seconds': seconds, 'ops_per_second': 1 / seconds}
+        sys.stderr.write('{0:<45} {1:>12.1f} us\n'.format(
+            name, seconds * 1e6))
+    return {
+        'python': platform.python_version(),
+        'flask_pbj': flask_pbj.__version__,
+        'results': results,
+    }
+
+
+def compare(report, baseline, threshold):
+    """
+        Print each benchmark's change from the baseline and return the names
+        of those slower by more than threshold.
+    """
+    regressions = []
+    for name, result in sorted(report['results'].iteritems()):
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['seconds']
+        change = result['seconds'] / before - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        sys.stderr.write('{0:<45} {1:>+8.1%}{2}\n'.format(name, change, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='timing repeats per benchmark, the best is kept')
+    parser.add_argument('-k', '--filter', dest='pattern',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('-o', '--output',
+                        help='write the results to this file')
+    parser.add_argument('--save', metavar='BASELINE',
+                        help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='compare the results with a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown counted as a regression, default 0.1')
+    args = parser.parse_args(argv)
+
+    report = run(args.repeat, args.pattern)
+    output = dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.save:
+        with open(args.save, 'w') as f:
+            f.write(output + '\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            sys.stderr.write('{0} benchmarks regressed\n'.format(
+                len(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,182 +15,3421 @@ __version__ = ".".join(__version_info__)
 __author__ = "Keen Browne"
 __license__ = "MIT/X11"
 __copyright__ = "(c) 2014 by Keen Browne"
-__all__ = ['api', 'json', 'protobuf']
+__all__ = [
+    'api', 'json', 'protobuf', 'Pbj', 'JsonCodec', 'ProtobufCodec',
+    'MsgpackCodec', 'CborCodec', 'MemoryCache', 'OffloadPool',
+    'MetricsHistogram', 'add_metrics_hook', 'remove_metrics_hook',
+]
 
-from functools import wraps
+import cPickle
+import json as _json
+import multiprocessing
+import sys
+import time
+import zlib
+from array import array
+from binascii import a2b_base64, b2a_base64, Error as BinasciiError
+from bisect import bisect_left
+from collections import MutableMapping, OrderedDict, namedtuple
+from functools import partial, wraps
+from hashlib import sha1
+from importlib import import_module
+from inspect import isgeneratorfunction
+from json.encoder import encode_basestring_ascii
+from struct import Struct, error as StructError
+from threading import Lock, local
+from timeit import default_timer
+from types import GeneratorType
 
-from flask import abort, jsonify, request, Flask
+from flask import abort, current_app, request, stream_with_context, Flask
 
-from google.protobuf.internal.containers import BaseContainer
+from google.protobuf.descriptor import FieldDescriptor
 from google.protobuf.reflection import GeneratedProtocolMessageType
 from google.protobuf.message import Message as ProtocolMessage, DecodeError
 
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import generate_etag, parse_options_header, unquote_etag
 from werkzeug.wrappers import Response
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack as _msgpack
+except ImportError:
+    _msgpack = None
+
+try:
+    import cbor2 as _cbor2
+except ImportError:
+    _cbor2 = None
+
 
 class EncodeError(Exception):
     pass
 
 
-class PbjRequest(Flask.request_class):
+class PbjRequestMixin(object):
+    """
+        The request attributes api sets and reads. Pbj(app) mixes this into
+        the app's request class.
+    """
     def __init__(self, *args, **kwargs):
-        super(PbjRequest, self).__init__(*args, **kwargs)
-        self.data_dict = None
+        super(PbjRequestMixin, self).__init__(*args, **kwargs)
+        self._data_dict = None
+        self._message = None
+        self._data_loader = None
+        # The codec of the request body, set by api
+        self.codec = None
+        self.data_iter = None
+        # The RequestMetrics of the request while metrics hooks are added
+        self.metrics = None
+        # The compiled field mask of the request, set by
+        # api(..., field_mask=True)
+        self.field_mask = None
+        # Whether the field mask was applied to the response
+        self.field_mask_applied = False
+        self._on_close = []
+
+    @property
+    def raw_message(self):
+        """
+            The undecoded request body as a RawMessage.
+        """
+        return _raw_message(self)
+
+    def defer_data(self, loader):
+        """
+            Decode the request data by calling loader the first time
+            data_dict or message is read.
+        """
+        self._data_dict = None
+        self._message = None
+        self._data_loader = loader
+
+    def _load_data(self):
+        loader = self._data_loader
+        if loader is not None:
+            data_dict = loader()
+            self._data_loader = None
+            self._data_dict = data_dict
+
+    @property
+    def data_dict(self):
+        self._load_data()
+        return self._data_dict
+
+    @data_dict.setter
+    def data_dict(self, value):
+        self._data_loader = None
+        self._data_dict = value
+
+    @property
+    def message(self):
+        self._load_data()
+        return self._message
+
+    @message.setter
+    def message(self, value):
+        self._message = value
+
+    def call_on_close(self, fn):
+        """
+            Call fn when the request is closed at the end of its request
+            context.
+        """
+        self._on_close.append(fn)
+        return fn
+
+    def close(self):
+        try:
+            super(PbjRequestMixin, self).close()
+        finally:
+            on_close, self._on_close = self._on_close, []
+            for fn in on_close:
+                fn()
+
+
+# Conversion kinds, precomputed for each field so the copy loops can dispatch
+# without inspecting values or descriptors
+_SCALAR = 0
+_MESSAGE = 1
+_REPEATED_SCALAR = 2
+_REPEATED_MESSAGE = 3
+_ENUM = 4
+_REPEATED_ENUM = 5
+_BYTES = 6
+_REPEATED_BYTES = 7
+
+
+class FieldPlan(object):
+    """
+        Conversion metadata for a single protobuf field. Enum fields carry
+        tables of their value names and numbers.
+    """
+    __slots__ = (
+        'name', 'number', 'label', 'type', 'cpp_type', 'kind', 'message_plan',
+        'enum_type', 'enum_numbers', 'enum_names'
+    )
+
+    def __init__(self, descriptor, enums_as_names=False):
+        self.name = descriptor.name
+        self.number = descriptor.number
+        self.label = descriptor.label
+        self.type = descriptor.type
+        self.cpp_type = descriptor.cpp_type
+        repeated = descriptor.label == FieldDescriptor.LABEL_REPEATED
+        self.enum_type = None
+        self.enum_numbers = None
+        self.enum_names = None
+        if descriptor.cpp_type == FieldDescriptor.CPPTYPE_MESSAGE:
+            self.kind = _REPEATED_MESSAGE if repeated else _MESSAGE
+        elif descriptor.type == FieldDescriptor.TYPE_ENUM:
+            self.kind = _REPEATED_ENUM if repeated else _ENUM
+            values = descriptor.enum_type.values
+            self.enum_type = descriptor.enum_type.full_name
+            self.enum_numbers = dict(
+                (value.name, value.number) for value in values
+            )
+            # Numbers are sent as they are unless the plan sends names
+            if enums_as_names:
+                self.enum_names = dict(
+                    (value.number, value.name) for value in values
+                )
+        elif descriptor.type == FieldDescriptor.TYPE_BYTES:
+            self.kind = _REPEATED_BYTES if repeated else _BYTES
+        else:
+            self.kind = _REPEATED_SCALAR if repeated else _SCALAR
+        self.message_plan = None
+
+
+class MessagePlan(object):
+    """
+        A flat table of the fields of a protobuf message type, with a nested
+        plan for each sub-message. Plans are compiled once per descriptor by
+        compile_message_plan.
+    """
+    def __init__(self, descriptor, enums_as_names=False):
+        self.descriptor = descriptor
+        self.enums_as_names = enums_as_names
+        self.fields = []
+        self.fields_by_name = {}
+        self.fields_by_number = {}
+        self.extensions = {}
+        # The repeated numeric fields and the bytes fields, compiled by
+        # compile_array_fields and compile_view_fields for codecs that
+        # split them off
+        self.array_fields = None
+        self.view_fields = None
+        # The fields holding bytes, directly or in sub-messages, compiled
+        # by compile_bytes_fields for codecs that send bytes unlike text
+        self.bytes_fields = None
+        # Maps the name of each field in a oneof to the name of the oneof.
+        # Descriptors before protobuf 2.6 have no oneofs.
+        self.oneofs = {}
+        for oneof in getattr(descriptor, 'oneofs', ()):
+            for field in oneof.fields:
+                self.oneofs[field.name] = oneof.name
+
+    def add_field(self, field):
+        self.fields.append(field)
+        self.fields_by_name[field.name] = field
+        self.fields_by_number[field.number] = field
+
+    def extension_plan(self, descriptor):
+        field = self.extensions.get(descriptor)
+        if field is None:
+            field = FieldPlan(descriptor, self.enums_as_names)
+            if descriptor.message_type is not None:
+                field.message_plan = compile_message_plan(
+                    descriptor.message_type,
+                    self.enums_as_names
+                )
+            self.extensions[descriptor] = field
+        return field
+
+
+_message_plans = {}
+
+
+def compile_message_plan(descriptor, enums_as_names=False):
+    """
+        Return the MessagePlan for a message descriptor, compiling it and the
+        plans of any nested message types the first time it is requested.
+        Dictionaries converted with an enums_as_names plan hold the names of
+        enum values rather than their numbers.
+    """
+    key = (descriptor, enums_as_names)
+    plan = _message_plans.get(key)
+    if plan is None:
+        building = {}
+        plan = _compile_message_plan(key, building)
+        # Only publish complete plans so other threads never see a partially
+        # built table
+        _message_plans.update(building)
+    return plan
+
+
+def _compile_message_plan(key, building):
+    plan = _message_plans.get(key) or building.get(key)
+    if plan is not None:
+        return plan
+
+    # Register the plan before compiling its fields so recursive message
+    # types refer back to it
+    descriptor, enums_as_names = key
+    plan = building[key] = MessagePlan(descriptor, enums_as_names)
+    for field_descriptor in descriptor.fields:
+        field = FieldPlan(field_descriptor, enums_as_names)
+        if field.kind in (_MESSAGE, _REPEATED_MESSAGE):
+            field.message_plan = _compile_message_plan(
+                (field_descriptor.message_type, enums_as_names),
+                building
+            )
+        plan.add_field(field)
+    return plan
+
+
+def warm_message_type(message_type, _seen=None):
+    """
+        Round trip an empty message_type, and each message type it contains,
+        so protobuf has finished setting up their classes before they are
+        needed.
+    """
+    seen = _seen if _seen is not None else set()
+    seen.add(message_type)
+    message = message_type()
+    for field in message_type.DESCRIPTOR.fields:
+        if field.cpp_type != FieldDescriptor.CPPTYPE_MESSAGE:
+            continue
+        if field.label == FieldDescriptor.LABEL_REPEATED:
+            child_type = type(getattr(message, field.name).add())
+        else:
+            child_type = type(getattr(message, field.name))
+        if child_type not in seen:
+            warm_message_type(child_type, seen)
+    message_type().ParseFromString(message.SerializePartialToString())
+    compile_message_plan(message_type.DESCRIPTOR)
+
+
+def _enum_number(field, value):
+    """
+        Return the number of an enum value given by name or number.
+    """
+    if not isinstance(value, basestring):
+        return value
+    try:
+        return field.enum_numbers[value]
+    except KeyError:
+        raise ValueError(
+            "{0!r} is not a {1} value".format(value, field.enum_type)
+        )
+
+
+def _bytes_value(value):
+    """
+        Bytes fields take str as it is, unicode as base64 text, which is how
+        JSON carries bytes, and bytearrays, buffers and memoryviews.
+    """
+    if isinstance(value, unicode):
+        try:
+            return a2b_base64(value)
+        except (BinasciiError, UnicodeEncodeError):
+            raise ValueError("{0!r} is not base64 encoded".format(value))
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    if isinstance(value, (bytearray, buffer)):
+        return str(value)
+    return value
+
+
+def _check_oneofs(plan, dictionary):
+    chosen = {}
+    for key, value in dictionary.iteritems():
+        oneof = plan.oneofs.get(key)
+        if oneof is None or value is None:
+            continue
+        other = chosen.setdefault(oneof, key)
+        if other != key:
+            raise ValueError(
+                "{0} can not set both {1} and {2} of {3}".format(
+                    plan.descriptor.full_name,
+                    other,
+                    key,
+                    oneof
+                )
+            )
+
+
+# TODO: consider using the word 'decode' and 'encode' instead of copy
+def copy_dict_to_pb(instance, dictionary):
+    """
+        Copy the key, value pairs in a dictionary to the fields of an instance
+        of a protobuf message. This method assumes that key values in the
+        dictionary correspond to field names in the message. Enum values may
+        be given by name or number, and bytes as str or base64 unicode.
+        Raises ValueError for unknown enum names and for dictionaries that
+        set more than one field of a oneof.
+    """
+    assert(isinstance(dictionary, _DICT_TYPES))
+    _dict_to_pb(
+        compile_message_plan(instance.DESCRIPTOR),
+        instance,
+        dictionary
+    )
+
+
+def _dict_to_pb(plan, instance, dictionary):
+    if plan.oneofs:
+        _check_oneofs(plan, dictionary)
+    fields = plan.fields_by_name
+    for key, value in dictionary.iteritems():
+        if value is None:
+            continue
+        field = fields.get(key)
+        if field is None:
+            raise AttributeError(
+                "{0} has no field named {1!r}".format(
+                    plan.descriptor.full_name,
+                    key
+                )
+            )
+        kind = field.kind
+        if kind is _SCALAR:
+            setattr(instance, key, value)
+        elif kind is _MESSAGE:
+            _dict_to_pb(field.message_plan, getattr(instance, key), value)
+        elif kind is _REPEATED_SCALAR:
+            getattr(instance, key).extend(value)
+        elif kind is _REPEATED_MESSAGE:
+            add = getattr(instance, key).add
+            item_plan = field.message_plan
+            for item in value:
+                _dict_to_pb(item_plan, add(), item)
+        elif kind is _ENUM:
+            setattr(instance, key, _enum_number(field, value))
+        elif kind is _REPEATED_ENUM:
+            getattr(instance, key).extend(
+                [_enum_number(field, item) for item in value]
+            )
+        elif kind is _BYTES:
+            setattr(instance, key, _bytes_value(value))
+        else:
+            getattr(instance, key).extend(
+                [_bytes_value(item) for item in value]
+            )
+
+
+def copy_pb_to_dict(dictionary, instance, enums_as_names=False):
+    """
+        Copy the fields set on an instance of a protobuf message into a
+        dictionary. Sub-messages become nested dictionaries and repeated fields
+        become lists. Enum values are copied as numbers, or as names with
+        enums_as_names. Returns the dictionary.
+    """
+    return _pb_to_dict(
+        compile_message_plan(instance.DESCRIPTOR, enums_as_names),
+        dictionary,
+        instance
+    )
+
+
+def _pb_to_dict(plan, dictionary, instance):
+    fields = plan.fields_by_number
+    for descriptor, value in instance.ListFields():
+        field = fields.get(descriptor.number)
+        if field is None:
+            field = plan.extension_plan(descriptor)
+        kind = field.kind
+        if kind is _SCALAR:
+            dictionary[field.name] = value
+        elif kind is _MESSAGE:
+            dictionary[field.name] = _pb_to_dict(field.message_plan, {}, value)
+        elif kind is _REPEATED_SCALAR:
+            dictionary[field.name] = value[:]
+        elif kind is _REPEATED_MESSAGE:
+            item_plan = field.message_plan
+            dictionary[field.name] = [
+                _pb_to_dict(item_plan, {}, item) for item in value
+            ]
+        else:
+            dictionary[field.name] = _field_value(field, value)
+    return dictionary
+
+
+def _field_value(field, value):
+    """
+        Convert the value of a field of a message to its dictionary form.
+    """
+    kind = field.kind
+    if kind is _SCALAR or kind is _BYTES:
+        return value
+    elif kind is _MESSAGE:
+        return _pb_to_dict(field.message_plan, {}, value)
+    elif kind is _REPEATED_SCALAR or kind is _REPEATED_BYTES:
+        return value[:]
+    elif kind is _REPEATED_MESSAGE:
+        item_plan = field.message_plan
+        return [_pb_to_dict(item_plan, {}, item) for item in value]
+    names = field.enum_names
+    if kind is _ENUM:
+        return names.get(value, value) if names else value
+    if names:
+        return [names.get(item, item) for item in value]
+    return value[:]
+
+
+# The name and inclusive range of each protobuf integer type
+_INT_RANGES = {
+    FieldDescriptor.CPPTYPE_INT32: ('int32', -2 ** 31, 2 ** 31 - 1),
+    FieldDescriptor.CPPTYPE_INT64: ('int64', -2 ** 63, 2 ** 63 - 1),
+    FieldDescriptor.CPPTYPE_UINT32: ('uint32', 0, 2 ** 32 - 1),
+    FieldDescriptor.CPPTYPE_UINT64: ('uint64', 0, 2 ** 64 - 1),
+}
+
+# Validation stops collecting errors after this many
+MAX_VALIDATION_ERRORS = 100
+
+FieldError = namedtuple('FieldError', ['field', 'message'])
+
+
+def _is_integer(value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+
+def _value_check(field):
+    """
+        Return a function that returns why a single value of field is
+        invalid, or None if it is valid.
+    """
+    cpp_type = field.cpp_type
+    if field.kind in (_ENUM, _REPEATED_ENUM):
+        names = field.enum_numbers
+        numbers = frozenset(names.itervalues())
+        error = "is not a {0} value".format(field.enum_type)
+
+        def check(value):
+            if isinstance(value, basestring):
+                if value not in names:
+                    return error
+            elif not _is_integer(value) or value not in numbers:
+                return error
+    elif field.kind in (_BYTES, _REPEATED_BYTES):
+        def check(value):
+            if not isinstance(value, (basestring, bytearray, buffer,
+                                      memoryview)):
+                return "expected bytes"
+            try:
+                _bytes_value(value)
+            except ValueError:
+                return "is not base64 encoded"
+    elif cpp_type in _INT_RANGES:
+        type_name, low, high = _INT_RANGES[cpp_type]
+        error = "is out of range for " + type_name
+
+        def check(value):
+            if not _is_integer(value):
+                return "expected an integer"
+            if not low <= value <= high:
+                return error
+    elif cpp_type in (FieldDescriptor.CPPTYPE_DOUBLE,
+                      FieldDescriptor.CPPTYPE_FLOAT):
+        def check(value):
+            if (not isinstance(value, (int, long, float)) or
+                    isinstance(value, bool)):
+                return "expected a number"
+    elif cpp_type == FieldDescriptor.CPPTYPE_BOOL:
+        def check(value):
+            if not isinstance(value, bool):
+                return "expected a boolean"
+    else:
+        def check(value):
+            if not isinstance(value, basestring):
+                return "expected a string"
+    return check
+
+
+class MessageValidator(object):
+    """
+        Checks request dictionaries against a message type before the view
+        runs: required and unknown fields, value types, integer ranges, enum
+        values, oneofs and nested messages. Validators are compiled once per
+        descriptor by compile_validator.
+    """
+    def __init__(self, plan):
+        self.plan = plan
+        self.required = [
+            field.name for field in plan.fields
+            if field.label == FieldDescriptor.LABEL_REQUIRED
+        ]
+        # Maps each field name to (repeated, check, validator, typecode),
+        # where validator checks sub-messages, check other values and
+        # typecode is that of arrays that hold valid values of the field
+        self.fields = {}
+
+    def errors(self, data):
+        """
+            Return a list of FieldErrors, with paths such as
+            'people[0].name', for each way data doesn't fit the message.
+        """
+        errors = []
+        self._check(data, '', errors)
+        return errors
+
+    def _check(self, data, path, errors):
+        if not isinstance(data, _DICT_TYPES):
+            errors.append(FieldError(path, "expected an object"))
+            return
+        prefix = path + '.' if path else ''
+        for name in self.required:
+            if data.get(name) is None:
+                errors.append(FieldError(prefix + name, "is required"))
+        if self.plan.oneofs:
+            try:
+                _check_oneofs(self.plan, data)
+            except ValueError as e:
+                errors.append(FieldError(path, str(e)))
+        fields = self.fields
+        for key, value in data.iteritems():
+            if len(errors) >= MAX_VALIDATION_ERRORS:
+                del errors[MAX_VALIDATION_ERRORS:]
+                return
+            if value is None:
+                continue
+            field_path = prefix + key
+            entry = fields.get(key)
+            if entry is None:
+                errors.append(FieldError(
+                    field_path,
+                    "is not a field of {0}".format(
+                        self.plan.descriptor.full_name
+                    )
+                ))
+                continue
+            repeated, check, validator, typecode = entry
+            if not repeated:
+                self._check_value(check, validator, value, field_path, errors)
+            elif isinstance(value, array) and value.typecode == typecode:
+                continue
+            elif not isinstance(value, (list, tuple)):
+                errors.append(FieldError(field_path, "expected a list"))
+            else:
+                for index, item in enumerate(value):
+                    self._check_value(
+                        check,
+                        validator,
+                        item,
+                        '{0}[{1}]'.format(field_path, index),
+                        errors
+                    )
+
+    def _check_value(self, check, validator, value, path, errors):
+        if validator is not None:
+            validator._check(value, path, errors)
+            return
+        error = check(value)
+        if error is not None:
+            errors.append(FieldError(path, error))
 
-Flask.request_class = PbjRequest
 
+_validators = {}
+
+
+def compile_validator(descriptor):
+    """
+        Return the MessageValidator for a message descriptor, compiling it
+        and the validators of its nested message types the first time.
+    """
+    validator = _validators.get(descriptor)
+    if validator is None:
+        building = {}
+        validator = _compile_validator(descriptor, building)
+        _validators.update(building)
+    return validator
+
+
+def _compile_validator(descriptor, building):
+    validator = _validators.get(descriptor) or building.get(descriptor)
+    if validator is not None:
+        return validator
+
+    validator = building[descriptor] = MessageValidator(
+        compile_message_plan(descriptor)
+    )
+    for field in validator.plan.fields:
+        repeated = field.label == FieldDescriptor.LABEL_REPEATED
+        if field.kind in (_MESSAGE, _REPEATED_MESSAGE):
+            validator.fields[field.name] = (
+                repeated,
+                None,
+                _compile_validator(field.message_plan.descriptor, building),
+                None
+            )
+        else:
+            validator.fields[field.name] = (
+                repeated,
+                _value_check(field),
+                None,
+                _ARRAY_TYPECODES.get(field.type)
+            )
+    return validator
+
+
+def message_errors(message):
+    """
+        Return a FieldError for each missing required field of a parsed
+        message.
+    """
+    return [
+        FieldError(path, "is required")
+        for path in message.FindInitializationErrors()
+    ]
+
+
+class _FieldErrors(list):
+    """
+        The FieldErrors of a batch item, encoded once the response codec is
+        known.
+    """
+
+
+def validation_error_data(errors):
+    """
+        The default body of the 400 response to a request that failed
+        validation.
+    """
+    return {
+        'errors': [
+            {'field': error.field, 'message': error.message}
+            for error in errors
+        ],
+    }
+
+
+class LazyMessageDict(MutableMapping):
+    """
+        A dictionary view of a protobuf message that converts each field the
+        first time it is read. Sub-messages are converted into LazyMessageDicts
+        in turn, so views only pay for the parts of a message they use.
+    """
+    def __init__(self, plan, message):
+        self._plan = plan
+        self._data = {}
+        self._pending = {}
+        fields = plan.fields_by_number
+        for descriptor, value in message.ListFields():
+            field = fields.get(descriptor.number)
+            if field is None:
+                field = plan.extension_plan(descriptor)
+            self._pending[field.name] = (field, value)
+
+    def __getitem__(self, key):
+        try:
+            return self._data[key]
+        except KeyError:
+            pass
+        field, value = self._pending.pop(key)
+        kind = field.kind
+        if kind is _MESSAGE:
+            value = LazyMessageDict(field.message_plan, value)
+        elif kind is _REPEATED_MESSAGE:
+            item_plan = field.message_plan
+            value = [LazyMessageDict(item_plan, item) for item in value]
+        else:
+            value = _field_value(field, value)
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._pending.pop(key, None)
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        if self._pending.pop(key, None) is None:
+            del self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data or key in self._pending
+
+    def __iter__(self):
+        return iter(self._data.keys() + self._pending.keys())
+
+    def __len__(self):
+        return len(self._data) + len(self._pending)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def to_dict(self):
+        """
+            Convert the remaining fields and return a plain dictionary.
+        """
+        dictionary = dict(
+            (key, _plain_value(value)) for key, value in self._data.iteritems()
+        )
+        # Fields the view never read are converted straight from the message
+        for key, (field, value) in self._pending.iteritems():
+            dictionary[key] = _field_value(field, value)
+        return dictionary
+
+
+def _plain_value(value):
+    if isinstance(value, LazyMessageDict):
+        return value.to_dict()
+    if isinstance(value, list) and value and \
+            isinstance(value[0], LazyMessageDict):
+        return [item.to_dict() for item in value]
+    return value
+
+
+# Wire types, see https://developers.google.com/protocol-buffers/docs/encoding
+_WIRETYPE_VARINT = 0
+_WIRETYPE_FIXED64 = 1
+_WIRETYPE_LENGTH_DELIMITED = 2
+_WIRETYPE_START_GROUP = 3
+_WIRETYPE_END_GROUP = 4
+_WIRETYPE_FIXED32 = 5
+
+_VARINT_TYPES = frozenset([
+    FieldDescriptor.TYPE_INT32,
+    FieldDescriptor.TYPE_INT64,
+    FieldDescriptor.TYPE_UINT32,
+    FieldDescriptor.TYPE_UINT64,
+    FieldDescriptor.TYPE_BOOL,
+    FieldDescriptor.TYPE_ENUM,
+])
+_SIGNED_VARINT_TYPES = frozenset([
+    FieldDescriptor.TYPE_INT32,
+    FieldDescriptor.TYPE_INT64,
+    FieldDescriptor.TYPE_ENUM,
+])
+_ZIGZAG_TYPES = frozenset([
+    FieldDescriptor.TYPE_SINT32,
+    FieldDescriptor.TYPE_SINT64,
+])
+# Parsers keep the low 32 bits of the varints of these types
+_VARINT32_TYPES = frozenset([
+    FieldDescriptor.TYPE_INT32,
+    FieldDescriptor.TYPE_UINT32,
+    FieldDescriptor.TYPE_SINT32,
+    FieldDescriptor.TYPE_ENUM,
+])
+_FIXED_FORMATS = {
+    FieldDescriptor.TYPE_DOUBLE: Struct('<d'),
+    FieldDescriptor.TYPE_FLOAT: Struct('<f'),
+    FieldDescriptor.TYPE_FIXED64: Struct('<Q'),
+    FieldDescriptor.TYPE_SFIXED64: Struct('<q'),
+    FieldDescriptor.TYPE_FIXED32: Struct('<I'),
+    FieldDescriptor.TYPE_SFIXED32: Struct('<i'),
+}
+_LENGTH_DELIMITED_TYPES = frozenset([
+    FieldDescriptor.TYPE_STRING,
+    FieldDescriptor.TYPE_BYTES,
+    FieldDescriptor.TYPE_MESSAGE,
+])
+
+
+def _wire_type(field_type):
+    if field_type in _LENGTH_DELIMITED_TYPES:
+        return _WIRETYPE_LENGTH_DELIMITED
+    fixed = _FIXED_FORMATS.get(field_type)
+    if fixed is not None:
+        return _WIRETYPE_FIXED64 if fixed.size == 8 else _WIRETYPE_FIXED32
+    return _WIRETYPE_VARINT
+
+
+def _write_varint(out, value):
+    if value < 0:
+        value += 1 << 64
+    while value > 0x7f:
+        out.append(0x80 | (value & 0x7f))
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 64:
+            raise DecodeError("Too many bytes when decoding varint.")
+
+
+def _iter_wire_fields(data):
+    """
+        Yield the field number, wire type and the start and end of the value
+        of each field of a protobuf message. Length-delimited values span
+        their contents without the length prefix.
+    """
+    buf = bytearray(data)
+    pos = 0
+    end = len(buf)
+    try:
+        while pos < end:
+            tag, pos = _read_varint(buf, pos)
+            wire_type = tag & 7
+            start = pos
+            if wire_type == _WIRETYPE_VARINT:
+                _, pos = _read_varint(buf, pos)
+            elif wire_type == _WIRETYPE_FIXED64:
+                pos += 8
+            elif wire_type == _WIRETYPE_FIXED32:
+                pos += 4
+            elif wire_type == _WIRETYPE_LENGTH_DELIMITED:
+                size, start = _read_varint(buf, pos)
+                pos = start + size
+            else:
+                raise DecodeError("Unsupported wire type.")
+            if pos > end:
+                raise DecodeError("Truncated message.")
+            yield tag >> 3, wire_type, start, pos
+    except IndexError:
+        raise DecodeError("Truncated message.")
+
+
+def _raw_message(_request):
+    codec = _request.codec
+    if codec is None:
+        return None
+    return RawMessage(
+        codec.mimetype,
+        _request.get_data(),
+        getattr(codec, 'receive_plan', None)
+    )
+
+
+class RawMessage(object):
+    """
+        An undecoded request body. Views can return request.raw_message to
+        forward the body in whichever format the client accepts; pbj copies
+        it through unchanged or transcodes it between JSON and protobuf
+        without building the message in between.
+    """
+    def __init__(self, mimetype, data, plan=None):
+        self.mimetype = mimetype
+        self.data = data
+        # The plan of the protobuf message type the data is encoded as
+        self.plan = plan
+
+
+def json_to_protobuf(message_type, text):
+    """
+        Encode JSON text as the protobuf wire format of message_type without
+        creating a protobuf message. Raises ValueError if the JSON doesn't
+        match the message type.
+    """
+    return _json_to_protobuf(
+        compile_message_plan(message_type.DESCRIPTOR),
+        text
+    )
+
+
+def _json_to_protobuf(plan, text):
+    value = _json.loads(text)
+    if not isinstance(value, dict):
+        raise ValueError("Expected a JSON object")
+    out = bytearray()
+    _encode_wire(plan, value, out)
+    return str(out)
+
+
+def _encode_wire(plan, dictionary, out):
+    if plan.oneofs:
+        _check_oneofs(plan, dictionary)
+    found = 0
+    for field in plan.fields:
+        value = dictionary.get(field.name)
+        if value is None:
+            if field.label == FieldDescriptor.LABEL_REQUIRED:
+                raise ValueError(
+                    "Missing required field {0}.{1}".format(
+                        plan.descriptor.full_name,
+                        field.name
+                    )
+                )
+            found += field.name in dictionary
+            continue
+        found += 1
+        if field.label == FieldDescriptor.LABEL_REPEATED:
+            if not isinstance(value, list):
+                raise ValueError("Expected a list for " + field.name)
+            for item in value:
+                _encode_wire_value(field, item, out)
+        else:
+            _encode_wire_value(field, value, out)
+
+    if found != len(dictionary):
+        unknown = set(dictionary).difference(plan.fields_by_name)
+        raise ValueError(
+            "{0} has no fields named {1}".format(
+                plan.descriptor.full_name,
+                ", ".join(sorted(unknown))
+            )
+        )
+
+
+def _check_int_range(field, value):
+    int_range = _INT_RANGES.get(field.cpp_type)
+    if int_range is not None and not int_range[1] <= value <= int_range[2]:
+        raise ValueError(
+            "Value out of range for field {0}: {1!r}".format(
+                field.name,
+                value
+            )
+        )
+
+
+def _encode_wire_value(field, value, out):
+    field_type = field.type
+    _write_varint(out, field.number << 3 | _wire_type(field_type))
+    try:
+        if field_type in _VARINT_TYPES:
+            if field.enum_numbers is not None and isinstance(
+                value,
+                basestring
+            ):
+                value = field.enum_numbers[value]
+            if isinstance(value, float) or (
+                isinstance(value, bool) and
+                field_type != FieldDescriptor.TYPE_BOOL
+            ):
+                raise TypeError
+            value = int(value)
+            _check_int_range(field, value)
+            _write_varint(out, value)
+        elif field_type in _ZIGZAG_TYPES:
+            if isinstance(value, (bool, float)):
+                raise TypeError
+            value = int(value)
+            _check_int_range(field, value)
+            _write_varint(out, value << 1 ^ value >> 63)
+        elif field_type == FieldDescriptor.TYPE_STRING:
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            elif not isinstance(value, str):
+                raise TypeError
+            _write_varint(out, len(value))
+            out += value
+        elif field_type == FieldDescriptor.TYPE_BYTES:
+            # JSON carries bytes as base64 text
+            value = a2b_base64(value)
+            _write_varint(out, len(value))
+            out += value
+        elif field_type == FieldDescriptor.TYPE_MESSAGE:
+            if not isinstance(value, dict):
+                raise TypeError
+            nested = bytearray()
+            _encode_wire(field.message_plan, value, nested)
+            _write_varint(out, len(nested))
+            out += nested
+        elif field_type in _FIXED_FORMATS:
+            if isinstance(value, bool) or not isinstance(
+                value,
+                (int, long, float)
+            ):
+                raise TypeError
+            out += _FIXED_FORMATS[field_type].pack(value)
+        else:
+            raise ValueError("Groups are not supported")
+    except (TypeError, KeyError, StructError, BinasciiError):
+        raise ValueError(
+            "Invalid value for field {0}: {1!r}".format(field.name, value)
+        )
+
+
+def protobuf_to_json(message_type, data, enums_as_names=False):
+    """
+        Render protobuf wire format data of message_type as JSON text without
+        creating a protobuf message. Enum values are rendered as numbers, or
+        as names with enums_as_names. Raises DecodeError if the data is not a
+        valid message.
+    """
+    return _protobuf_to_json(
+        compile_message_plan(message_type.DESCRIPTOR, enums_as_names),
+        data
+    )
+
+
+def _protobuf_to_json(plan, data):
+    out = []
+    try:
+        _render_wire(plan, data, bytearray(data), 0, len(data), out)
+    except (IndexError, StructError, UnicodeDecodeError):
+        raise DecodeError("Truncated or malformed message.")
+    return "".join(out)
+
+
+def _render_wire(plan, data, buf, pos, end, out):
+    fields = plan.fields_by_number
+    values = {}
+    while pos < end:
+        tag, pos = _read_varint(buf, pos)
+        wire_type = tag & 7
+        field = fields.get(tag >> 3)
+
+        if field is None:
+            # Skip unknown fields
+            if wire_type == _WIRETYPE_VARINT:
+                _, pos = _read_varint(buf, pos)
+            elif wire_type == _WIRETYPE_FIXED64:
+                pos += 8
+            elif wire_type == _WIRETYPE_FIXED32:
+                pos += 4
+            elif wire_type == _WIRETYPE_LENGTH_DELIMITED:
+                size, pos = _read_varint(buf, pos)
+                pos += size
+            else:
+                raise DecodeError("Unsupported wire type.")
+            continue
+
+        field_type = field.type
+        if (wire_type == _WIRETYPE_LENGTH_DELIMITED and
+                field_type not in _LENGTH_DELIMITED_TYPES):
+            # A packed repeated field
+            size, pos = _read_varint(buf, pos)
+            packed_end = pos + size
+            items = values.setdefault(field.number, [])
+            while pos < packed_end:
+                value, pos = _read_wire_value(field, data, buf, pos)
+                items.append(value)
+            if pos != packed_end:
+                raise DecodeError("Truncated packed field.")
+            continue
+        elif wire_type != _wire_type(field_type):
+            raise DecodeError("Wrong wire type for " + field.name)
+
+        value, pos = _read_wire_value(field, data, buf, pos)
+        if field.label == FieldDescriptor.LABEL_REPEATED:
+            values.setdefault(field.number, []).append(value)
+        else:
+            values[field.number] = value
+
+    if pos != end:
+        raise DecodeError("Truncated message.")
+
+    out.append('{')
+    separator = ''
+    for field in plan.fields:
+        value = values.get(field.number)
+        if value is None:
+            continue
+        out.append(separator)
+        out.append('"' + field.name + '":')
+        if isinstance(value, list):
+            out.append('[')
+            out.append(','.join(value))
+            out.append(']')
+        else:
+            out.append(value)
+        separator = ','
+    out.append('}')
+
+
+def _read_wire_value(field, data, buf, pos):
+    """
+        Read one value of field from the wire and return it rendered as JSON
+    """
+    field_type = field.type
+    if field_type in _VARINT_TYPES:
+        value, pos = _read_varint(buf, pos)
+        if field_type == FieldDescriptor.TYPE_BOOL:
+            return ('true' if value else 'false'), pos
+        bits = 64
+        if field_type in _VARINT32_TYPES:
+            bits = 32
+            value &= 0xffffffff
+        if field_type in _SIGNED_VARINT_TYPES and value >= 1 << bits - 1:
+            value -= 1 << bits
+        if field.enum_names is not None and value in field.enum_names:
+            return '"' + field.enum_names[value] + '"', pos
+        return str(value), pos
+    if field_type in _ZIGZAG_TYPES:
+        value, pos = _read_varint(buf, pos)
+        if field_type in _VARINT32_TYPES:
+            value &= 0xffffffff
+        return str(value >> 1 ^ -(value & 1)), pos
+    fixed = _FIXED_FORMATS.get(field_type)
+    if fixed is not None:
+        value, = fixed.unpack_from(data, pos)
+        return _json.dumps(value), pos + fixed.size
+    if field_type not in _LENGTH_DELIMITED_TYPES:
+        raise DecodeError("Groups are not supported.")
+
+    size, pos = _read_varint(buf, pos)
+    end = pos + size
+    if end > len(data):
+        raise DecodeError("Truncated message.")
+    if field_type == FieldDescriptor.TYPE_STRING:
+        value = encode_basestring_ascii(data[pos:end].decode('utf-8'))
+    elif field_type == FieldDescriptor.TYPE_BYTES:
+        # Encode straight from the request body rather than a slice of it
+        value = '"' + b2a_base64(buffer(data, pos, size))[:-1] + '"'
+    else:
+        out = []
+        _render_wire(field.message_plan, data, buf, pos, end, out)
+        value = ''.join(out)
+    return value, end
+
+
+def _array_typecode(codes, itemsize):
+    """
+        Return the first of codes whose arrays have items of itemsize bytes,
+        or None if no array type does on this platform.
+    """
+    for code in codes:
+        if array(code).itemsize == itemsize:
+            return code
+    return None
+
+
+_ARRAY_TYPECODES = dict((field_type, code) for field_type, code in (
+    (FieldDescriptor.TYPE_DOUBLE, 'd'),
+    (FieldDescriptor.TYPE_FLOAT, 'f'),
+    (FieldDescriptor.TYPE_INT32, _array_typecode('il', 4)),
+    (FieldDescriptor.TYPE_SINT32, _array_typecode('il', 4)),
+    (FieldDescriptor.TYPE_SFIXED32, _array_typecode('il', 4)),
+    (FieldDescriptor.TYPE_UINT32, _array_typecode('IL', 4)),
+    (FieldDescriptor.TYPE_FIXED32, _array_typecode('IL', 4)),
+    (FieldDescriptor.TYPE_INT64, _array_typecode('l', 8)),
+    (FieldDescriptor.TYPE_SINT64, _array_typecode('l', 8)),
+    (FieldDescriptor.TYPE_SFIXED64, _array_typecode('l', 8)),
+    (FieldDescriptor.TYPE_UINT64, _array_typecode('L', 8)),
+    (FieldDescriptor.TYPE_FIXED64, _array_typecode('L', 8)),
+) if code is not None)
+
+# The wire format of fixed width fields is little endian
+_SWAP_BYTES = sys.byteorder == 'big'
+
+
+def compile_array_fields(plan):
+    """
+        Map the number of each repeated numeric field of a message plan to
+        the field and the array typecode that holds its values.
+    """
+    if plan.array_fields is None:
+        plan.array_fields = dict(
+            (field.number, (field, _ARRAY_TYPECODES[field.type]))
+            for field in plan.fields
+            if field.label == FieldDescriptor.LABEL_REPEATED and
+            field.type in _ARRAY_TYPECODES
+        )
+    return plan.array_fields
+
+
+def compile_view_fields(plan):
+    """
+        Map the number of each bytes field of a message plan to the field
+        and None, the typecode of fields split out as memoryviews.
+    """
+    if plan.view_fields is None:
+        plan.view_fields = dict(
+            (field.number, (field, None))
+            for field in plan.fields
+            if field.kind in (_BYTES, _REPEATED_BYTES)
+        )
+    return plan.view_fields
+
+
+def _reaches_bytes(plan, seen):
+    if plan in seen:
+        return False
+    seen.add(plan)
+    for field in plan.fields:
+        if field.kind in (_BYTES, _REPEATED_BYTES):
+            return True
+        if (field.kind in (_MESSAGE, _REPEATED_MESSAGE) and
+                _reaches_bytes(field.message_plan, seen)):
+            return True
+    return False
+
+
+def compile_bytes_fields(plan):
+    """
+        List the bytes fields of a message plan, and the message fields
+        whose messages have bytes fields.
+    """
+    if plan.bytes_fields is None:
+        plan.bytes_fields = [
+            field for field in plan.fields
+            if field.kind in (_BYTES, _REPEATED_BYTES) or (
+                field.kind in (_MESSAGE, _REPEATED_MESSAGE) and
+                _reaches_bytes(field.message_plan, set())
+            )
+        ]
+    return plan.bytes_fields
+
+
+def convert_bytes_fields(plan, data, convert):
+    """
+        Return a copy of a dict with convert applied to the values of its
+        bytes fields, following a message plan. Dicts without bytes fields
+        and other data are returned as they are.
+    """
+    if not isinstance(data, _DICT_TYPES):
+        return data
+    fields = compile_bytes_fields(plan)
+    if not fields:
+        return data
+    converted = dict(data)
+    for field in fields:
+        value = converted.get(field.name)
+        if value is None:
+            continue
+        kind = field.kind
+        if kind is _BYTES:
+            if isinstance(value, _BLOB_TYPES):
+                value = convert(value)
+        elif kind is _REPEATED_BYTES:
+            value = [
+                convert(item) if isinstance(item, _BLOB_TYPES) else item
+                for item in value
+            ]
+        elif kind is _MESSAGE:
+            value = convert_bytes_fields(field.message_plan, value, convert)
+        else:
+            item_plan = field.message_plan
+            value = [
+                convert_bytes_fields(item_plan, item, convert)
+                for item in value
+            ]
+        converted[field.name] = value
+    return converted
+
+
+def _base64_text(value):
+    return b2a_base64(value)[:-1]
+
+
+# Zero copy codecs write bytes values of at least this many bytes as chunks
+# of their own
+ZERO_COPY_MIN_SIZE = 16 * 1024
+
+_BLOB_TYPES = (str, bytearray, buffer, memoryview)
+
+
+def _split_fields(split_fields, data):
+    """
+        Decode the fields of a message that have a typecode in split_fields
+        into arrays, and those without one into memoryviews of data, and
+        return them with the rest of the message. data is read where it is
+        rather than copied to a bytearray, so large bytes fields are never
+        copied.
+    """
+    split = {}
+    kept = []
+    view = None
+    buf = None
+    pos = 0
+    end = len(data)
+    try:
+        while pos < end:
+            tag_start = pos
+            tag, pos = _read_str_varint(data, pos)
+            wire_type = tag & 7
+            entry = split_fields.get(tag >> 3)
+            if entry is None:
+                pos = _skip_wire_value(data, pos, wire_type)
+                if kept and kept[-1][1] == tag_start:
+                    kept[-1] = (kept[-1][0], pos)
+                else:
+                    kept.append((tag_start, pos))
+                continue
+
+            field, typecode = entry
+            if typecode is None:
+                if wire_type != _WIRETYPE_LENGTH_DELIMITED:
+                    raise DecodeError("Wrong wire type for " + field.name)
+                size, pos = _read_str_varint(data, pos)
+                if pos + size > end:
+                    raise DecodeError("Truncated message.")
+                if view is None:
+                    view = memoryview(data)
+                value = view[pos:pos + size]
+                pos += size
+                if field.kind is _BYTES:
+                    split[field.name] = value
+                else:
+                    split.setdefault(field.name, []).append(value)
+                continue
+
+            values = split.get(field.name)
+            if values is None:
+                values = split[field.name] = array(typecode)
+            if buf is None and wire_type == _WIRETYPE_VARINT:
+                # Runs of unpacked varints are read faster from a bytearray
+                buf = bytearray(data)
+            pos = _read_array_values(
+                field,
+                wire_type,
+                data,
+                buf,
+                pos,
+                data[tag_start:pos],
+                values
+            )
+    except IndexError:
+        raise DecodeError("Truncated message.")
+    except OverflowError:
+        raise DecodeError("Value out of range.")
+    if pos != end:
+        raise DecodeError("Truncated message.")
+
+    if kept == [(0, end)]:
+        return split, data
+    return split, ''.join([data[first:last] for first, last in kept])
+
+
+def _read_str_varint(data, pos):
+    """
+        Like _read_varint, but reads a str.
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 64:
+            raise DecodeError("Too many bytes when decoding varint.")
+
+
+def _skip_wire_value(data, pos, wire_type):
+    if wire_type == _WIRETYPE_VARINT:
+        _, pos = _read_str_varint(data, pos)
+        return pos
+    if wire_type == _WIRETYPE_FIXED64:
+        return pos + 8
+    if wire_type == _WIRETYPE_FIXED32:
+        return pos + 4
+    if wire_type == _WIRETYPE_LENGTH_DELIMITED:
+        size, pos = _read_str_varint(data, pos)
+        return pos + size
+    raise DecodeError("Unsupported wire type.")
+
+
+def _read_array_values(field, wire_type, data, buf, pos, tag, values):
+    """
+        Read the value of field at pos into values and return the position
+        after it. Unpacked values usually follow one another, so a run of
+        them, each prefixed with tag, is read at once from buf, a bytearray
+        copy of data.
+    """
+    field_type = field.type
+    fixed = _FIXED_FORMATS.get(field_type)
+    if wire_type == _WIRETYPE_LENGTH_DELIMITED:
+        size, pos = _read_str_varint(data, pos)
+        end = pos + size
+        if end > len(data):
+            raise DecodeError("Truncated packed field.")
+    elif fixed is not None and wire_type == _wire_type(field_type):
+        end = pos + fixed.size
+        if end > len(data):
+            raise DecodeError("Truncated message.")
+    elif fixed is None and wire_type == _WIRETYPE_VARINT:
+        end = None
+    else:
+        raise DecodeError("Wrong wire type for " + field.name)
+
+    if fixed is not None:
+        if (end - pos) % fixed.size:
+            raise DecodeError("Truncated packed field.")
+        # Packed fixed width values are the array's memory as they are
+        if not _SWAP_BYTES:
+            values.fromstring(data[pos:end])
+        else:
+            chunk = array(values.typecode, data[pos:end])
+            chunk.byteswap()
+            values.extend(chunk)
+        return end
+
+    zigzag = field_type in _ZIGZAG_TYPES
+    signed = field_type in _SIGNED_VARINT_TYPES
+    append = values.append
+    if end is None:
+        # A run of unpacked values
+        tag_size = len(tag)
+        while True:
+            value, pos = _read_varint(buf, pos)
+            if zigzag:
+                value = value >> 1 ^ -(value & 1)
+            elif signed and value >= 1 << 63:
+                value -= 1 << 64
+            append(value)
+            if not buf.startswith(tag, pos):
+                return pos
+            pos += tag_size
+
+    # Packed varints are read from a copy of just the field
+    buf = bytearray(data[pos:end])
+    size = len(buf)
+    pos = 0
+    while pos < size:
+        value, pos = _read_varint(buf, pos)
+        if zigzag:
+            value = value >> 1 ^ -(value & 1)
+        elif signed and value >= 1 << 63:
+            value -= 1 << 64
+        append(value)
+    if pos != size:
+        raise DecodeError("Truncated packed field.")
+    return end
+
+
+def _write_packed_array(field, typecode, values, out):
+    """
+        Write values as a packed field. Values that aren't already an array
+        of typecode are converted to one, which checks their types and
+        ranges.
+    """
+    if not isinstance(values, array) or values.typecode != typecode:
+        try:
+            values = array(typecode, values)
+        except (OverflowError, TypeError):
+            raise EncodeError(
+                "Invalid values for field {0}".format(field.name)
+            )
+    if not values:
+        return
+    if field.type in _FIXED_FORMATS:
+        if _SWAP_BYTES:
+            values = array(typecode, values)
+            values.byteswap()
+        payload = values.tostring()
+    else:
+        payload = bytearray()
+        if field.type in _ZIGZAG_TYPES:
+            for value in values:
+                _write_varint(payload, value << 1 ^ value >> 63)
+        else:
+            for value in values:
+                _write_varint(payload, value)
+    _write_varint(out, field.number << 3 | _WIRETYPE_LENGTH_DELIMITED)
+    _write_varint(out, len(payload))
+    out += payload
+
+
+# Streamed requests are read in chunks of this many bytes
+STREAM_READ_SIZE = 64 * 1024
+
+# The largest single message or record a streamed request may contain
+DEFAULT_MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+
+def _iter_delimited(stream, max_size):
+    """
+        Yield the messages of a stream of varint length-prefixed messages.
+    """
+    buf = bytearray()
+    pos = 0
+    eof = False
+    while True:
+        try:
+            size, start = _read_varint(buf, pos)
+            end = start + size
+            if size > max_size:
+                abort(413)  # Request Entity Too Large
+        except IndexError:
+            # Not enough data for the length prefix
+            start = end = None
+        except DecodeError:
+            abort(400)
+
+        if end is not None and end <= len(buf):
+            yield str(buf[start:end])
+            pos = end
+            continue
+
+        if eof:
+            if pos < len(buf):
+                abort(400)  # Truncated message
+            return
+
+        # Drop the messages already read before reading more
+        del buf[:pos]
+        pos = 0
+        chunk = stream.read(
+            STREAM_READ_SIZE if end is None
+            else max(STREAM_READ_SIZE, end - start)
+        )
+        if chunk:
+            buf += chunk
+        else:
+            eof = True
+
+
+def _iter_lines(stream, max_size):
+    """
+        Yield the lines of a stream, without their line endings.
+    """
+    pending = []
+    pending_size = 0
+    while True:
+        chunk = stream.read(STREAM_READ_SIZE)
+        if not chunk:
+            break
+        lines = chunk.split('\n')
+        if len(lines) > 1:
+            pending.append(lines[0])
+            lines[0] = ''.join(pending)
+            pending = [lines.pop()]
+            pending_size = len(pending[0])
+            for line in lines:
+                if len(line) > max_size:
+                    abort(413)  # Request Entity Too Large
+                yield line
+        else:
+            pending.append(chunk)
+            pending_size += len(chunk)
+        if pending_size > max_size:
+            abort(413)  # Request Entity Too Large
+    if pending:
+        yield ''.join(pending)
+
+
+class _BrotliCompressor(object):
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def sync(self):
+        return self.compressor.flush()
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+def _compressor(encoding, level):
+    """
+        Return an object with compress and flush methods which writes data
+        in the given content encoding.
+    """
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return zlib.compressobj(level)
+    if encoding == 'br':
+        return _BrotliCompressor(level)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError("Unsupported content encoding " + encoding)
+
+
+def _compress(encoding, level, data):
+    compressor = _compressor(encoding, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _sync_flush(encoding, compressor):
+    """
+        Return a function which writes out everything given to a compressor
+        so far, so clients can decode it before the stream ends.
+    """
+    if encoding == 'br':
+        return compressor.sync
+    if encoding == 'zstd':
+        return partial(compressor.flush, zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+    return partial(compressor.flush, zlib.Z_SYNC_FLUSH)
+
+
+def _compress_chunks(encoding, level, chunks):
+    compressor = _compressor(encoding, level)
+    sync = _sync_flush(encoding, compressor)
+    for chunk in chunks:
+        if chunk:
+            yield compressor.compress(chunk) + sync()
+    yield compressor.flush()
+
+
+# Content encodings in order of preference, and their default levels
+CONTENT_ENCODINGS = ['gzip', 'deflate']
+DEFAULT_COMPRESS_LEVELS = {'gzip': 6, 'deflate': 6}
+if brotli is not None:
+    CONTENT_ENCODINGS.insert(0, 'br')
+    DEFAULT_COMPRESS_LEVELS['br'] = 5
+if zstandard is not None:
+    CONTENT_ENCODINGS.insert(0, 'zstd')
+    DEFAULT_COMPRESS_LEVELS['zstd'] = 3
+
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+
+
+def compress_response(response, encoding, level=None,
+                      min_size=DEFAULT_COMPRESS_MIN_SIZE):
+    """
+        Compress the body of a response with a content encoding. Streamed
+        responses are compressed as they are written, other responses only
+        if the body is at least min_size bytes.
+    """
+    response.vary.add('Accept-Encoding')
+    if encoding is None or 'Content-Encoding' in response.headers:
+        return response
+    if level is None:
+        level = DEFAULT_COMPRESS_LEVELS[encoding]
+
+    if response.is_streamed:
+        response.response = _compress_chunks(
+            encoding,
+            level,
+            response.response
+        )
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(_compress(encoding, level, data))
+    response.headers['Content-Encoding'] = encoding
+    # The compressed body is only semantically equivalent to the original
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# The most a compressed request body may decompress to
+DEFAULT_MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
+
+class _ZlibReader(object):
+    def __init__(self, stream, wbits):
+        self.stream = stream
+        self.decompressor = zlib.decompressobj(wbits)
+        self.eof = False
+
+    def read(self, size):
+        decompressor = self.decompressor
+        while True:
+            data = decompressor.unconsumed_tail
+            if not data:
+                if self.eof:
+                    return ''
+                data = self.stream.read(STREAM_READ_SIZE)
+                if not data:
+                    self.eof = True
+                    if not self.finished():
+                        raise zlib.error("Truncated compressed stream")
+                    return decompressor.flush()
+            # Limiting the output keeps a small, highly compressed request
+            # from inflating all at once
+            data = decompressor.decompress(data, size)
+            if data:
+                return data
+
+    def finished(self):
+        """
+            Whether the compressed stream has ended. zlib puts input given
+            after the end of a stream in unused_data, and decompresses any
+            other input, so a byte is fed to a copy of the decompressor.
+        """
+        if self.decompressor.unused_data:
+            return True
+        decompressor = self.decompressor.copy()
+        try:
+            decompressor.decompress('\0')
+        except zlib.error:
+            return False
+        return decompressor.unused_data == '\0'
+
+
+class DecompressingStream(object):
+    """
+        A file-like object that decompresses a gzip, deflate or zstd encoded
+        stream as it is read. Reading past max_size decompressed bytes aborts
+        the request with a 413.
+    """
+    def __init__(self, stream, encoding, max_size):
+        if encoding == 'gzip':
+            self.reader = _ZlibReader(stream, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.reader = _ZlibReader(stream, zlib.MAX_WBITS)
+        elif encoding == 'zstd' and zstandard is not None:
+            self.reader = zstandard.ZstdDecompressor().stream_reader(stream)
+        else:
+            raise ValueError("Unsupported content encoding " + encoding)
+        self.max_size = max_size
+        self.size = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            chunk = self._read(STREAM_READ_SIZE)
+            while chunk:
+                chunks.append(chunk)
+                chunk = self._read(STREAM_READ_SIZE)
+            return ''.join(chunks)
+        return self._read(size)
+
+    def _read(self, size):
+        try:
+            data = self.reader.read(size)
+        except zlib.error:
+            abort(400)  # Bad Request
+        except Exception as e:
+            if zstandard is not None and isinstance(e, zstandard.ZstdError):
+                abort(400)  # Bad Request
+            raise
+        self.size += len(data)
+        if self.size > self.max_size:
+            abort(413)  # Request Entity Too Large
+        return data
+
+
+# Content encodings accepted on request bodies
+REQUEST_CONTENT_ENCODINGS = ['gzip', 'deflate']
+if zstandard is not None:
+    REQUEST_CONTENT_ENCODINGS.append('zstd')
+
+
+class LRUCache(object):
+    """
+        A thread-safe mapping which holds at most max_size items, discarding
+        the least recently used.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+DEFAULT_NEGOTIATION_CACHE_SIZE = 256
+
+# Marks values missing from a cache, where None is a valid value
+_MISSING = object()
+
+
+# Request header carrying a field mask, like the fields query parameter
+FIELD_MASK_HEADER = 'X-Field-Mask'
+DEFAULT_FIELD_MASK_CACHE_SIZE = 256
+
+_field_masks = LRUCache(DEFAULT_FIELD_MASK_CACHE_SIZE)
+
+
+def compile_field_mask(spec):
+    """
+        Compile a comma separated list of dotted field paths, such as
+        'id,people.name', into a tree of dicts keyed by field name where None
+        selects the whole field. Compiled masks are cached.
+    """
+    mask = _field_masks.get(spec)
+    if mask is not None:
+        return mask
+
+    mask = {}
+    for path in spec.split(','):
+        names = path.strip().split('.')
+        if not names[0]:
+            continue
+        node = mask
+        for name in names[:-1]:
+            child = node.get(name, _MISSING)
+            if child is None:
+                break  # The whole field is already selected
+            if child is _MISSING:
+                child = node[name] = {}
+            node = child
+        else:
+            node[names[-1]] = None
+    _field_masks[spec] = mask
+    return mask
+
+
+def apply_field_mask(mask, data):
+    """
+        Return a copy of a dict or protobuf message with only the fields
+        selected by a compiled field mask.
+    """
+    if isinstance(data, ProtocolMessage):
+        return _mask_message(mask, data)
+    if isinstance(data, _DICT_TYPES):
+        return _mask_dict(mask, data)
+    return data
+
+
+def _mask_dict(mask, data):
+    masked = {}
+    for name, child in mask.iteritems():
+        if name not in data:
+            continue
+        value = data[name]
+        if child is not None:
+            if isinstance(value, list):
+                value = [apply_field_mask(child, item) for item in value]
+            else:
+                value = apply_field_mask(child, value)
+        masked[name] = value
+    return masked
+
+
+def _mask_message(mask, message):
+    masked = message.__class__()
+    fields = message.DESCRIPTOR.fields_by_name
+    for name, child in mask.iteritems():
+        field = fields.get(name)
+        if field is None:
+            continue
+        value = getattr(message, name)
+        is_message = field.cpp_type == FieldDescriptor.CPPTYPE_MESSAGE
+        if field.label == FieldDescriptor.LABEL_REPEATED:
+            if not is_message:
+                getattr(masked, name).extend(value)
+                continue
+            items = getattr(masked, name)
+            for item in value:
+                if child is not None:
+                    item = _mask_message(child, item)
+                items.add().MergeFrom(item)
+        elif message.HasField(name):
+            if not is_message:
+                setattr(masked, name, value)
+            elif child is None:
+                getattr(masked, name).MergeFrom(value)
+            else:
+                getattr(masked, name).MergeFrom(_mask_message(child, value))
+    return masked
+
+
+def _field_masked():
+    return bool(request) and getattr(request, 'field_mask_applied', False)
+
+
+def _serialize(message):
+    """
+        Serialize a message, without checking required fields when a field
+        mask was applied to the response and may have pruned them.
+    """
+    if _field_masked():
+        return message.SerializePartialToString()
+    return message.SerializeToString()
+
+
+CachedResponse = namedtuple(
+    'CachedResponse',
+    ['body', 'content_type', 'status_code', 'headers', 'etag']
+)
+
+
+class MemoryCache(object):
+    """
+        A thread-safe, in-process cache of encoded responses. It holds at
+        most max_entries responses and max_bytes of response bodies,
+        discarding the least recently used, and entries expire after
+        default_timeout seconds (0 never expires). Any cache with the same
+        get(key) and set(key, value, timeout) methods, such as the cachelib
+        caches, can be used in its place.
+    """
+    def __init__(self, max_entries=1024, max_bytes=None, default_timeout=300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_timeout = default_timeout
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = Lock()
+        self.clock = time.time
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value, expires = self.items.pop(key)
+            except KeyError:
+                return None
+            if expires and expires <= self.clock():
+                self.size -= len(value.body)
+                return None
+            self.items[key] = value, expires
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = self.clock() + timeout if timeout else 0
+        if self.max_bytes is not None and len(value.body) > self.max_bytes:
+            return False
+
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0].body)
+            self.items[key] = value, expires
+            self.size += len(value.body)
+            while len(self.items) > self.max_entries or (
+                self.max_bytes is not None and self.size > self.max_bytes
+            ):
+                old, _ = self.items.popitem(last=False)[1]
+                self.size -= len(old.body)
+        return True
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+        return True
+
+    def __len__(self):
+        return len(self.items)
+
+
+# Functions called with the RequestMetrics of each api request
+_metrics_hooks = []
+
+
+def add_metrics_hook(hook):
+    """
+        Call hook with the RequestMetrics of every request handled by an
+        api view.
+    """
+    _metrics_hooks.append(hook)
+
+
+def remove_metrics_hook(hook):
+    _metrics_hooks.remove(hook)
+
+
+def _mark(phase):
+    """
+        Charge the time since the last mark to phase, if the request is being
+        measured.
+    """
+    if _metrics_hooks:
+        metrics = getattr(request, 'metrics', None)
+        if metrics is not None:
+            metrics.mark(phase)
+
+
+class RequestMetrics(object):
+    """
+        The time spent in each phase of an api request (negotiate, decode,
+        convert, view, encode and response), the mimetypes used and the
+        request and response body sizes. Lazily decoded requests are decoded
+        during the view, and streamed responses are encoded after it returns
+        so only their setup is measured.
+    """
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.request_mimetype = None
+        self.response_mimetype = None
+        self.request_size = None
+        self.response_size = None
+        self.status_code = None
+        self.timings = OrderedDict()
+        self.started = self.last = default_timer()
+
+    def mark(self, phase):
+        now = default_timer()
+        self.timings[phase] = self.timings.get(phase, 0) + now - self.last
+        self.last = now
+
+    @property
+    def total(self):
+        return self.last - self.started
+
+    def finish(self, result):
+        """
+            Record the response a view returned and pass the metrics to the
+            hooks. result is None for requests that raised, whose
+            status_code is already set.
+        """
+        self.mark('response')
+        if result is not None:
+            if isinstance(result, tuple):
+                response, self.status_code = result[0], result[1]
+            else:
+                response, self.status_code = result, result.status_code
+            self.response_mimetype = response.mimetype
+            if not response.is_streamed:
+                self.response_size = response.calculate_content_length()
+        for hook in list(_metrics_hooks):
+            hook(self)
+
+
+DEFAULT_TIMING_BUCKETS = (
+    .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10
+)
+
+
+def _prometheus_labels(**labels):
+    pairs = []
+    for name, value in sorted(labels.iteritems()):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        pairs.append('{0}="{1}"'.format(name, value.replace('\n', '\\n')))
+    return ','.join(pairs)
+
+
+class MetricsHistogram(object):
+    """
+        A metrics hook which aggregates phase timings into histograms, and
+        body sizes and response counts into totals, per endpoint.
+    """
+    def __init__(self, buckets=DEFAULT_TIMING_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.endpoints = {}
+        self.lock = Lock()
+
+    def __call__(self, metrics):
+        with self.lock:
+            endpoint = self.endpoints.get(metrics.endpoint)
+            if endpoint is None:
+                endpoint = self.endpoints[metrics.endpoint] = {
+                    'phases': {},
+                    'request_bytes': {'count': 0, 'sum': 0},
+                    'response_bytes': {'count': 0, 'sum': 0},
+                    'responses': {},
+                }
+            for phase, seconds in metrics.timings.iteritems():
+                histogram = endpoint['phases'].get(phase)
+                if histogram is None:
+                    histogram = endpoint['phases'][phase] = {
+                        'count': 0,
+                        'sum': 0.0,
+                        'buckets': [0] * (len(self.buckets) + 1),
+                    }
+                histogram['count'] += 1
+                histogram['sum'] += seconds
+                histogram['buckets'][bisect_left(self.buckets, seconds)] += 1
+            for key, size in (('request_bytes', metrics.request_size),
+                              ('response_bytes', metrics.response_size)):
+                if size is not None:
+                    endpoint[key]['count'] += 1
+                    endpoint[key]['sum'] += size
+            key = (metrics.response_mimetype, metrics.status_code)
+            endpoint['responses'][key] = endpoint['responses'].get(key, 0) + 1
+
+    def snapshot(self):
+        """
+            Return the aggregated metrics as a plain dict keyed by endpoint.
+            Histogram buckets are cumulative and keyed by their upper bound.
+        """
+        snapshot = {}
+        with self.lock:
+            for name, endpoint in self.endpoints.iteritems():
+                phases = {}
+                for phase, histogram in endpoint['phases'].iteritems():
+                    buckets = OrderedDict()
+                    count = 0
+                    for bound, bucket_count in zip(
+                        self.buckets + (float('inf'),),
+                        histogram['buckets']
+                    ):
+                        count += bucket_count
+                        buckets[bound] = count
+                    phases[phase] = {
+                        'count': histogram['count'],
+                        'sum': histogram['sum'],
+                        'buckets': buckets,
+                    }
+                snapshot[name] = {
+                    'phases': phases,
+                    'request_bytes': dict(endpoint['request_bytes']),
+                    'response_bytes': dict(endpoint['response_bytes']),
+                    'responses': [
+                        {'mimetype': mimetype, 'status': status,
+                         'count': responses}
+                        for (mimetype, status), responses
+                        in sorted(endpoint['responses'].iteritems())
+                    ],
+                }
+        return snapshot
+
+    def prometheus_text(self):
+        """
+            Render the aggregated metrics in the Prometheus text format.
+        """
+        snapshot = self.snapshot()
+        lines = ['# TYPE pbj_phase_seconds histogram']
+        for name, endpoint in sorted(snapshot.iteritems()):
+            for phase, histogram in sorted(endpoint['phases'].iteritems()):
+                for bound, count in histogram['buckets'].iteritems():
+                    lines.append('pbj_phase_seconds_bucket{{{0}}} {1}'.format(
+                        _prometheus_labels(
+                            endpoint=name,
+                            phase=phase,
+                            le='+Inf' if bound == float('inf') else repr(bound)
+                        ),
+                        count
+                    ))
+                labels = _prometheus_labels(endpoint=name, phase=phase)
+                lines.append('pbj_phase_seconds_sum{{{0}}} {1!r}'.format(
+                    labels, histogram['sum']))
+                lines.append('pbj_phase_seconds_count{{{0}}} {1}'.format(
+                    labels, histogram['count']))
+
+        for key in ('request_bytes', 'response_bytes'):
+            lines.append('# TYPE pbj_{0} summary'.format(key))
+            for name, endpoint in sorted(snapshot.iteritems()):
+                labels = _prometheus_labels(endpoint=name)
+                for stat in ('sum', 'count'):
+                    lines.append('pbj_{0}_{1}{{{2}}} {3}'.format(
+                        key, stat, labels, endpoint[key][stat]))
+
+        lines.append('# TYPE pbj_responses_total counter')
+        for name, endpoint in sorted(snapshot.iteritems()):
+            for response in endpoint['responses']:
+                lines.append('pbj_responses_total{{{0}}} {1}'.format(
+                    _prometheus_labels(
+                        endpoint=name,
+                        mimetype=response['mimetype'] or '',
+                        status=response['status']
+                    ),
+                    response['count']
+                ))
+        return '\n'.join(lines) + '\n'
+
+    def prometheus_response(self):
+        """
+            A response for a metrics view to return to a Prometheus scraper.
+        """
+        return Flask.response_class(
+            self.prometheus_text(),
+            content_type='text/plain; version=0.0.4; charset=utf-8'
+        )
+
+
+def _batch_result(result):
+    """
+        Convert the result of a view for a batch item to (status_code, data).
+    """
+    if isinstance(result, int):
+        return result, None
+    data, status_code, headers = _result_to_response_tuple(result)
+    if not isinstance(data, _DICT_TYPES + (ProtocolMessage,)):
+        raise EncodeError(
+            "Batch views must return a dict, protobuf message or int status "
+            "code for each item."
+        )
+    return status_code, data
+
+
+def _result_to_response_tuple(result):
+    # Returned tuples are also evaluated
+    if isinstance(result, tuple):
+        assert(len(result) > 0 and len(result) <= 3)
+        if (len(result) == 1):
+            return result[0], 200, {}
+        if (len(result) == 2):
+            return result[0], result[1], {}
+        elif (len(result) == 3):
+            return result
+
+    return result, 200, {}
+
+
+class JsonDictKeyError(KeyError):
+    pass
+
+
+class JsonResponseDict(dict):
+    def __missing__(self, key):
+        raise JsonDictKeyError(key)
+
+
+def _json_default(value):
+    # JSON carries bytes as base64, as protobuf_to_json does
+    if isinstance(value, LazyMessageDict):
+        return convert_bytes_fields(value._plan, value.to_dict(), _base64_text)
+    if isinstance(value, ProtocolMessage):
+        return convert_bytes_fields(
+            compile_message_plan(value.DESCRIPTOR),
+            copy_pb_to_dict({}, value),
+            _base64_text
+        )
+    if isinstance(value, array):
+        return value.tolist()
+    if isinstance(value, (bytearray, memoryview)):
+        return _base64_text(value)
+    # Fall back on the application's encoder for dates, uuids and the like
+    if current_app:
+        return current_app.json_encoder().default(value)
+    raise TypeError("{0!r} is not JSON serializable".format(value))
+
+
+# ETags only need a stable encoding of data, and latin-1 decodes the bytes
+# fields of protobuf responses whatever they hold
+_canonical_json = _json.JSONEncoder(
+    separators=(',', ':'),
+    sort_keys=True,
+    encoding='latin-1',
+    default=_json_default
+)
+
+
+def _data_etag(mimetype, data):
+    """
+        Compute an ETag from the data a view returned rather than from the
+        encoded response.
+    """
+    if isinstance(data, ProtocolMessage):
+        body = data.SerializeToString()
+    elif isinstance(data, RawMessage):
+        body = data.mimetype + '\n' + data.data
+    else:
+        body = _canonical_json.encode(data)
+    return generate_etag(mimetype + '\n' + body)
+
+
+class JsonBackend(object):
+    """
+        Encodes and decodes JSON with the stdlib json module, or another
+        module with the same interface such as simplejson. Output is compact
+        and decoded objects are JsonResponseDicts, without copying.
+    """
+    def __init__(self, module=_json):
+        # Offloading workers import the module by name
+        self.module_name = module.__name__
+        self.encoder = module.JSONEncoder(
+            separators=(',', ':'),
+            default=_json_default
+        )
+        self.decoder = module.JSONDecoder(object_pairs_hook=JsonResponseDict)
+
+    def dumps(self, data):
+        return self.encoder.encode(data)
+
+    def loads(self, data):
+        return self.decoder.decode(data)
+
+
+DEFAULT_OFFLOAD_MIN_SIZE = 1024 * 1024
+
+
+class OffloadPool(object):
+    """
+        A pool of worker processes that codecs use to decode and encode
+        messages of at least offload_min_size bytes, so large messages don't
+        hold the GIL of a threaded server. Workers import each message type
+        once.
+    """
+    def __init__(self, processes=None):
+        self.processes = processes
+        self.pool = None
+        self.lock = Lock()
+
+    def start(self):
+        """
+            Fork the worker processes if they aren't running. Pbj(app) starts
+            the pools of the app's routes before it serves requests, since
+            forking from a request thread can copy locks other threads hold;
+            pools that aren't started are started on first use.
+        """
+        with self.lock:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.processes)
+
+    def apply(self, fn, *args):
+        self.start()
+        return self.pool.apply(fn, args)
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+
+def _message_type_ref(message_type):
+    """
+        Refer to a generated message type by its module and class path so
+        workers can import it.
+    """
+    names = []
+    descriptor = message_type.DESCRIPTOR
+    while descriptor is not None:
+        names.insert(0, descriptor.name)
+        descriptor = descriptor.containing_type
+    return message_type.__module__, tuple(names)
+
+
+# Message types and JSON backends imported by a worker process
+_worker_imports = {}
+
+
+def _worker_message_type(ref):
+    message_type = _worker_imports.get(ref)
+    if message_type is None:
+        module, names = ref
+        message_type = import_module(module)
+        for name in names:
+            message_type = getattr(message_type, name)
+        _worker_imports[ref] = message_type
+    return message_type
+
+
+def _worker_json_backend(module_name):
+    backend = _worker_imports.get(module_name)
+    if backend is None:
+        backend = JsonBackend(import_module(module_name))
+        _worker_imports[module_name] = backend
+    return backend
+
+
+def _decode_protobuf(ref, data, enums_as_names=False):
+    message_type = _worker_message_type(ref)
+    message = message_type()
+    try:
+        message.ParseFromString(data)
+    except DecodeError:
+        return None
+    plan = compile_message_plan(message_type.DESCRIPTOR, enums_as_names)
+    return _pb_to_dict(plan, {}, message)
+
+
+def _encode_protobuf(ref, pickled):
+    message_type = _worker_message_type(ref)
+    message = message_type()
+    plan = compile_message_plan(message_type.DESCRIPTOR)
+    _dict_to_pb(plan, message, cPickle.loads(pickled))
+    return message.SerializeToString()
+
+
+def _decode_json(module_name, data):
+    try:
+        return _worker_json_backend(module_name).loads(data)
+    except ValueError:
+        return None
+
+
+def _encode_json(module_name, pickled):
+    return _worker_json_backend(module_name).dumps(cPickle.loads(pickled))
+
+
+def _offload_encode(pool, min_size, fn, target, data):
+    """
+        Encode data in the pool if it pickles to at least min_size bytes, or
+        return None to encode it inline.
+    """
+    if not isinstance(data, dict):
+        return None
+    try:
+        pickled = cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+    except (cPickle.PicklingError, TypeError):
+        return None
+    if len(pickled) < min_size:
+        return None
+    try:
+        return pool.apply(fn, target, pickled)
+    except TypeError:
+        # Workers have no app context, so values only the app's JSON encoder
+        # handles fail there; encoding inline handles them or raises as usual
+        return None
+
+
+class MessagePool(object):
+    """
+        Per-thread free lists of at most size cleared messages of each type,
+        so codecs reuse the messages of requests and responses instead of
+        allocating new ones. A message is only released when nothing else
+        can still refer to it.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.local = local()
+
+    def free_list(self, message_type):
+        try:
+            free_lists = self.local.free_lists
+        except AttributeError:
+            free_lists = self.local.free_lists = {}
+        try:
+            return free_lists[message_type]
+        except KeyError:
+            return free_lists.setdefault(message_type, [])
+
+    def acquire(self, message_type):
+        free_list = self.free_list(message_type)
+        if free_list:
+            return free_list.pop()
+        return message_type()
+
+    def release(self, message):
+        free_list = self.free_list(type(message))
+        if len(free_list) < self.size:
+            message.Clear()
+            free_list.append(message)
+
+
+class JsonCodec(object):
+    mimetype = "application/json"
+    ndjson_mimetype = "application/x-ndjson"
+    # Converts the bytes fields of responses with a protobuf schema
+    bytes_value = staticmethod(_base64_text)
+
+    def __init__(self, backend=None, stream_format='array',
+                 max_message_size=DEFAULT_MAX_MESSAGE_SIZE,
+                 compress_min_size=DEFAULT_COMPRESS_MIN_SIZE,
+                 compress_level=None, offload=None,
+                 offload_min_size=DEFAULT_OFFLOAD_MIN_SIZE):
+        """
+            backend is any object with dumps and loads methods like
+            JsonBackend, which is used by default. stream_format selects how
+            streamed responses are written, either as a JSON 'array' or as
+            newline delimited JSON, 'ndjson'. max_message_size limits the
+            length of each record of a streamed request. Responses shorter
+            than compress_min_size are not compressed, and compress_level
+            overrides the default level of each content encoding. Requests
+            and responses of at least offload_min_size bytes are decoded
+            and encoded in the offload OffloadPool, if the backend is a
+            JsonBackend.
+        """
+        assert(stream_format in ('array', 'ndjson'))
+        self.backend = backend or JsonBackend()
+        self.stream_format = stream_format
+        self.max_message_size = max_message_size
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+        self.offload = offload
+        self.offload_min_size = offload_min_size
+        self.offload_module = getattr(self.backend, 'module_name', None)
+        if self.offload_module is None:
+            self.offload = None
+
+    def parse_request_data(self, _request):
+        body = _request.get_data()
+        if self.offload is not None and len(body) >= self.offload_min_size:
+            data = self.offload.apply(_decode_json, self.offload_module, body)
+            if data is None:
+                abort(400)
+            return self._request_dict(data)
+        try:
+            data = self.backend.loads(body)
+        except ValueError:
+            abort(400)
+        return self._request_dict(data)
+
+    def iter_request_data(self, _request):
+        """
+            Yield the records of a newline delimited JSON request as they are
+            read.
+        """
+        loads = self.backend.loads
+        for line in _iter_lines(_request.stream, self.max_message_size):
+            if not line.strip():
+                continue
+            try:
+                data = loads(line)
+            except ValueError:
+                abort(400)
+            yield self._request_dict(data)
+
+    def parse_batch_request_data(self, _request):
+        """
+            Parse a JSON array, or an object with the array in 'items', into a
+            list of dicts.
+        """
+        try:
+            data = self.backend.loads(_request.get_data())
+        except ValueError:
+            abort(400)
+        if isinstance(data, dict):
+            data = data.get('items')
+        if not isinstance(data, list):
+            abort(400)
+        return [self._request_dict(item) for item in data]
+
+    def make_batch_response(self, results, status_code, headers):
+        """
+            Encode a list of (status_code, data) results as an object with a
+            'results' array of {'status': status_code, 'body': data} objects.
+        """
+        body = []
+        for item_status_code, data in results:
+            result = {'status': item_status_code}
+            if data is not None:
+                result['body'] = data
+            body.append(result)
+        return Flask.response_class(
+            self.backend.dumps({'results': body}),
+            mimetype=self.mimetype
+        ), status_code, headers
+
+    def _request_dict(self, data):
+        if not isinstance(data, JsonResponseDict):
+            if not isinstance(data, dict):
+                abort(400)
+            data = JsonResponseDict(data)
+        return data
+
+    def make_response(self, data, status_code, headers):
+        body = None
+        if isinstance(data, RawMessage):
+            body = self.encode_raw_message(data)
+        elif self.offload is not None:
+            body = _offload_encode(
+                self.offload,
+                self.offload_min_size,
+                _encode_json,
+                self.offload_module,
+                data
+            )
+        if body is None:
+            body = self.backend.dumps(data)
+        return Flask.response_class(
+            body,
+            mimetype=self.mimetype
+        ), status_code, headers
+
+    def make_stream_response(self, items, status_code, headers):
+        if self.stream_format == 'ndjson':
+            chunks = self._ndjson(items)
+            mimetype = self.ndjson_mimetype
+        else:
+            chunks = self._array(items)
+            mimetype = self.mimetype
+        return Flask.response_class(
+            stream_with_context(chunks),
+            mimetype=mimetype
+        ), status_code, headers
+
+    def _array(self, items):
+        dumps = self.backend.dumps
+        separator = '['
+        for item in items:
+            yield separator + dumps(item)
+            separator = ','
+        yield '[]' if separator == '[' else ']'
+
+    def _ndjson(self, items):
+        dumps = self.backend.dumps
+        for item in items:
+            yield dumps(item) + '\n'
+
+    def encode_raw_message(self, raw_message):
+        if raw_message.mimetype == self.mimetype:
+            return raw_message.data
+        if raw_message.plan is None:
+            raise EncodeError(
+                "Can not transcode {0} data to JSON.".format(
+                    raw_message.mimetype
+                )
+            )
+        try:
+            return _protobuf_to_json(raw_message.plan, raw_message.data)
+        except DecodeError:
+            abort(400)
+
+
+class ProtobufCodec(object):
+    mimetype = "application/x-protobuf"
+
+    def __init__(self, sends=None, receives=None, errors=None,
+                 as_message=False, max_message_size=DEFAULT_MAX_MESSAGE_SIZE,
+                 compress_min_size=DEFAULT_COMPRESS_MIN_SIZE,
+                 compress_level=None, offload=None,
+                 offload_min_size=DEFAULT_OFFLOAD_MIN_SIZE,
+                 enums_as_names=False, pool_size=0, arrays=False,
+                 zero_copy=False):
+        """
+            sends, receives and errors are the protobuf message types used for
+            responses, requests and 4xx responses. Enum values in request
+            dicts are numbers, or names with enums_as_names. When as_message
+            is set, requests are not copied into request.data_dict; the view
+            reads the parsed message from request.message instead.
+            max_message_size limits the length of each message of a streamed
+            request. Responses shorter than compress_min_size are not
+            compressed, and compress_level overrides the default level of
+            each content encoding. Requests and responses of at least
+            offload_min_size bytes are converted in the offload OffloadPool;
+            request.message is not set for offloaded requests. With a
+            pool_size, each thread keeps up to pool_size cleared messages of
+            each type for reuse; in apps set up with Pbj(app),
+            request.message is then reused after the request ends, so views
+            must not keep it. With arrays, the repeated numeric fields of
+            request dicts are array.arrays decoded straight from the wire,
+            and response dicts may give them as arrays, which are written as
+            packed fields without a message in between. With zero_copy,
+            the bytes fields of request dicts are memoryviews of the request
+            body, and response bytes values of at least ZERO_COPY_MIN_SIZE
+            are written as separate chunks of the response rather than
+            copied into the encoded message. request.message is not set
+            with arrays or zero_copy, and requests are then never offloaded,
+            so their values have the same types whatever their size.
+        """
+        assert(sends or receives)
+        if sends:
+            assert(isinstance(sends, GeneratedProtocolMessageType))
+        if receives:
+            assert(isinstance(receives, GeneratedProtocolMessageType))
+        if errors:
+            assert(isinstance(errors, GeneratedProtocolMessageType))
+
+        self.send_type = sends
+        self.receive_type = receives
+        self.error_type = errors
+        self.as_message = as_message
+        self.max_message_size = max_message_size
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+        self.offload = offload
+        self.offload_min_size = offload_min_size
+        self.pool = pool_size and MessagePool(pool_size) or None
+
+        # Compile the conversion plans up front so requests only run the
+        # precomputed field tables
+        self.send_plan = sends and compile_message_plan(
+            sends.DESCRIPTOR,
+            enums_as_names
+        )
+        self.receive_plan = receives and compile_message_plan(
+            receives.DESCRIPTOR,
+            enums_as_names
+        )
+        self.error_plan = errors and compile_message_plan(
+            errors.DESCRIPTOR,
+            enums_as_names
+        )
+        self.arrays = arrays
+        self.zero_copy = zero_copy
+        # The fields of requests decoded by splitting them off the wire
+        self.receive_split = {}
+        if receives and arrays:
+            self.receive_split.update(compile_array_fields(self.receive_plan))
+        if receives and zero_copy:
+            self.receive_split.update(compile_view_fields(self.receive_plan))
+
+    def parse_request_data(self, _request):
+        # Arrays and memoryviews come from the request body itself, so split
+        # requests are never offloaded whatever their size
+        if self.receive_split and not self.as_message:
+            return self.parse_request_split(_request)
+
+        if (self.offload is not None and self.receive_type and
+                not self.as_message):
+            body = _request.get_data()
+            if len(body) >= self.offload_min_size:
+                data = self.offload.apply(
+                    _decode_protobuf,
+                    _message_type_ref(self.receive_type),
+                    body,
+                    self.receive_plan.enums_as_names
+                )
+                if data is None:
+                    abort(400)
+                return data
+
+        message = self.parse_request_message(_request)
+        if self.as_message:
+            return None
+        _mark('decode')
+        data = _pb_to_dict(self.receive_plan, {}, message)
+        _mark('convert')
+        return data
+
+    def parse_request_split(self, _request):
+        """
+            Decode the repeated numeric fields of a request into arrays, and
+            its bytes fields into memoryviews with zero_copy, and the rest of
+            it through a receive_type message.
+        """
+        try:
+            split, rest = _split_fields(
+                self.receive_split,
+                _request.get_data()
+            )
+            message = self.receive_type()
+            message.ParseFromString(rest)
+        except DecodeError:
+            abort(400)
+        _mark('decode')
+        data = _pb_to_dict(self.receive_plan, {}, message)
+        data.update(split)
+        _mark('convert')
+        return data
+
+    def iter_request_data(self, _request):
+        """
+            Yield the messages of a stream of length-prefixed receive_type
+            messages as they are read.
+        """
+        if not self.receive_type:
+            abort(400)  # Bad Request
+        receive_type = self.receive_type
+        if self.as_message:
+            for data in _iter_delimited(_request.stream,
+                                        self.max_message_size):
+                message = receive_type()
+                try:
+                    message.ParseFromString(data)
+                except DecodeError:
+                    abort(400)
+                yield message
+            return
+
+        # The dicts are copies, so one message is parsed into for the
+        # whole stream
+        pool = self.pool
+        if pool is None:
+            message = receive_type()
+        else:
+            message = pool.acquire(receive_type)
+        try:
+            for data in _iter_delimited(_request.stream,
+                                        self.max_message_size):
+                try:
+                    message.ParseFromString(data)
+                except DecodeError:
+                    abort(400)
+                yield _pb_to_dict(self.receive_plan, {}, message)
+        finally:
+            if pool is not None:
+                pool.release(message)
+
+    def parse_request_message(self, _request):
+        if not self.receive_type:
+            abort(400)  # Bad Request
+        pool = self.pool
+        if pool is not None and hasattr(_request, 'call_on_close'):
+            message = pool.acquire(self.receive_type)
+            _request.call_on_close(partial(pool.release, message))
+        else:
+            message = self.receive_type()
+        try:
+            message.ParseFromString(_request.data)
+        except DecodeError:
+            abort(400)
+
+        _request.message = message
+        return message
+
+    def parse_request_data_lazy(self, _request):
+        """
+            Like parse_request_data, but the returned LazyMessageDict only
+            converts the fields the view reads.
+        """
+        if self.receive_split and not self.as_message:
+            return self.parse_request_split(_request)
+        message = self.parse_request_message(_request)
+        if self.as_message:
+            return None
+        return LazyMessageDict(self.receive_plan, message)
+
+    def make_response(self, data, status_code, headers):
+        if not data:
+            Flask.response_class(
+                "",
+                mimetype=self.mimetype
+            ), status_code, headers
+
+        message_type, plan = self.response_type(status_code)
+        if self.zero_copy and isinstance(data, _DICT_TYPES):
+            chunks = self.encode_chunks(data, message_type, plan)
+            if len(chunks) > 1:
+                # Werkzeug would join the chunks to measure them
+                response = Flask.response_class(
+                    chunks,
+                    mimetype=self.mimetype
+                )
+                response.content_length = sum(len(chunk) for chunk in chunks)
+                return response, status_code, headers
+            body = chunks[0]
+        else:
+            body = self.encode(data, message_type, plan)
+        return Flask.response_class(
+            body,
+            mimetype=self.mimetype
+        ), status_code, headers
+
+    def warm(self):
+        for message_type in (self.send_type, self.receive_type,
+                             self.error_type):
+            if message_type:
+                warm_message_type(message_type)
+
+    def response_type(self, status_code):
+        """
+            Return the message type and plan used to send a response with
+            status_code.
+        """
+        # if the status code is a client error code
+        if status_code // 100 == 4 and self.error_type:
+            return self.error_type, self.error_plan
+        self.check_send_type()
+        return self.send_type, self.send_plan
+
+    def parse_batch_request_data(self, _request):
+        """
+            Parse a batch of receive_type messages, encoded as a message with
+            the items in repeated field 1, into a list of dicts, or of
+            messages with as_message.
+        """
+        if not self.receive_type:
+            abort(400)  # Bad Request
+        data = _request.get_data()
+        items = []
+        try:
+            for number, wire_type, start, end in _iter_wire_fields(data):
+                if (number != 1 or
+                        wire_type != _WIRETYPE_LENGTH_DELIMITED):
+                    abort(400)
+                message = self.receive_type()
+                message.ParseFromString(data[start:end])
+                if self.as_message:
+                    items.append(message)
+                else:
+                    items.append(_pb_to_dict(self.receive_plan, {}, message))
+        except DecodeError:
+            abort(400)
+        return items
+
+    def make_batch_response(self, results, status_code, headers):
+        """
+            Encode a list of (status_code, data) results as a message with
+            one result per item in repeated field 1. Each result has the
+            status code in field 1 and, unless data is None, the send_type or
+            error_type message in field 2.
+        """
+        out = bytearray()
+        for item_status_code, data in results:
+            result = bytearray()
+            _write_varint(result, 1 << 3 | _WIRETYPE_VARINT)
+            _write_varint(result, item_status_code)
+            if data is not None:
+                message_type, plan = self.response_type(item_status_code)
+                body = self.encode(data, message_type, plan)
+                _write_varint(result, 2 << 3 | _WIRETYPE_LENGTH_DELIMITED)
+                _write_varint(result, len(body))
+                result += body
+            _write_varint(out, 1 << 3 | _WIRETYPE_LENGTH_DELIMITED)
+            _write_varint(out, len(result))
+            out += result
+        return Flask.response_class(
+            str(out),
+            mimetype=self.mimetype
+        ), status_code, headers
+
+    def make_stream_response(self, items, status_code, headers):
+        """
+            Stream items as a sequence of send_type messages, each prefixed
+            with its length as a varint.
+        """
+        self.check_send_type()
+        return Flask.response_class(
+            stream_with_context(self._delimited(items)),
+            mimetype=self.mimetype
+        ), status_code, headers
+
+    def _delimited(self, items):
+        send_type = self.send_type
+        send_plan = self.send_plan
+        for item in items:
+            data = self.encode(item, send_type, send_plan)
+            prefix = bytearray()
+            _write_varint(prefix, len(data))
+            yield str(prefix) + data
+
+    def check_send_type(self):
+        if not self.send_type:
+            raise EncodeError(
+                "Data could not be encoded into a protobuf message. No "
+                "protobuf message type specified to send."
+            )
+
+    def encode(self, data, message_type, plan):
+        """
+            Serialize a dict, message or RawMessage as a message_type.
+        """
+        if isinstance(data, RawMessage):
+            return self.encode_raw_message(data, plan)
+
+        # Messages returned by the view are serialized as they are
+        if isinstance(data, ProtocolMessage):
+            if not isinstance(data, message_type):
+                raise EncodeError(
+                    "Expected a {0} message but the view returned a "
+                    "{1}.".format(
+                        message_type.DESCRIPTOR.full_name,
+                        data.DESCRIPTOR.full_name
+                    )
+                )
+            return _serialize(data)
+
+        assert(isinstance(data, _DICT_TYPES))
+        if self.offload is not None and not _field_masked():
+            body = _offload_encode(
+                self.offload,
+                self.offload_min_size,
+                _encode_protobuf,
+                _message_type_ref(message_type),
+                data
+            )
+            if body is not None:
+                return body
+
+        packed = None
+        if self.arrays:
+            data, packed = self.pack_arrays(data, plan)
+
+        pool = self.pool
+        if pool is None:
+            message = message_type()
+            _dict_to_pb(plan, message, data)
+            _mark('convert')
+            body = _serialize(message)
+            return body + str(packed) if packed else body
+        message = pool.acquire(message_type)
+        try:
+            _dict_to_pb(plan, message, data)
+            _mark('convert')
+            body = _serialize(message)
+            return body + str(packed) if packed else body
+        finally:
+            pool.release(message)
+
+    def encode_chunks(self, data, message_type, plan):
+        """
+            Encode a dict as a list of chunks. Bytes fields with a value of
+            at least ZERO_COPY_MIN_SIZE are written after the rest of the
+            message, each value a chunk of its own, rather than copied into
+            the encoded message.
+        """
+        rest = None
+        chunks = []
+        for field, _ in compile_view_fields(plan).itervalues():
+            value = data.get(field.name)
+            if value is None:
+                continue
+            values = value if field.kind is _REPEATED_BYTES else [value]
+            if not any(
+                isinstance(item, _BLOB_TYPES) and
+                len(item) >= ZERO_COPY_MIN_SIZE
+                for item in values
+            ):
+                continue
+            if rest is None:
+                rest = dict(data)
+            del rest[field.name]
+            if field.label == FieldDescriptor.LABEL_REQUIRED:
+                # The last value of a field on the wire wins, so the
+                # message can be encoded with an empty placeholder
+                rest[field.name] = ''
+            for item in values:
+                # WSGI servers write str chunks
+                item = _bytes_value(item)
+                prefix = bytearray()
+                _write_varint(
+                    prefix,
+                    field.number << 3 | _WIRETYPE_LENGTH_DELIMITED
+                )
+                _write_varint(prefix, len(item))
+                chunks.append(str(prefix))
+                chunks.append(item)
+        if rest is None:
+            return [self.encode(data, message_type, plan)]
+        return [self.encode(rest, message_type, plan)] + chunks
+
+    def pack_arrays(self, data, plan):
+        """
+            Write the repeated numeric fields of data as packed fields, and
+            return the rest of data with them. The message parsers accept
+            fields in any order, so they can follow the rest of the message.
+        """
+        packed = bytearray()
+        rest = None
+        for field, typecode in compile_array_fields(plan).itervalues():
+            values = data.get(field.name)
+            if values is None:
+                continue
+            _write_packed_array(field, typecode, values, packed)
+            if rest is None:
+                rest = dict(data)
+            del rest[field.name]
+        if rest is None:
+            return data, None
+        return rest, packed
+
+    def encode_raw_message(self, raw_message, plan):
+        if raw_message.mimetype == self.mimetype:
+            return raw_message.data
+        if raw_message.mimetype != JsonCodec.mimetype:
+            raise EncodeError(
+                "Can not transcode {0} data to protobuf.".format(
+                    raw_message.mimetype
+                )
+            )
+        try:
+            return _json_to_protobuf(plan, raw_message.data)
+        except ValueError:
+            abort(400)
+
+
+def _binary_default(value):
+    if isinstance(value, LazyMessageDict):
+        return value.to_dict()
+    if isinstance(value, ProtocolMessage):
+        return copy_pb_to_dict({}, value)
+    if isinstance(value, array):
+        return value.tolist()
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    raise TypeError("{0!r} can not be encoded".format(value))
+
+
+def _binary_value(value):
+    """
+        Prepare data for the binary codecs, which send python 2 str as byte
+        strings. str that is valid UTF-8 is sent as text, as JsonCodec would,
+        and other str, bytearrays and memoryviews as bytes.
+    """
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value
+    if isinstance(value, (list, tuple)):
+        return [_binary_value(item) for item in value]
+    if isinstance(value, array):
+        return value.tolist()
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    # Bytes fields of messages are sent as bytes even when they are UTF-8
+    if isinstance(value, LazyMessageDict):
+        value = convert_bytes_fields(value._plan, value.to_dict(), bytearray)
+    if isinstance(value, _DICT_TYPES):
+        return dict(
+            (_binary_value(key), _binary_value(item))
+            for key, item in value.iteritems()
+        )
+    if isinstance(value, ProtocolMessage):
+        return _binary_value(convert_bytes_fields(
+            compile_message_plan(value.DESCRIPTOR),
+            copy_pb_to_dict({}, value),
+            bytearray
+        ))
+    return value
+
+
+class SchemalessCodec(object):
+    """
+        The base of codecs for binary formats with JSON's data model, such as
+        MessagePack and CBOR. Subclasses implement dumps and loads, which
+        raises decode_errors for malformed data, and iter_loads, which yields
+        the items of a stream of concatenated items.
+    """
+    mimetype = None
+    decode_errors = (ValueError,)
+    # Converts the bytes fields of responses with a protobuf schema
+    bytes_value = bytearray
+
+    def __init__(self, receives=None, sends=None,
+                 compress_min_size=DEFAULT_COMPRESS_MIN_SIZE,
+                 compress_level=None,
+                 max_message_size=DEFAULT_MAX_MESSAGE_SIZE):
+        """
+            Requests and responses are dicts without a schema, like
+            JsonCodec. When receives or sends is a protobuf message type,
+            requests that don't fit it are rejected with a 400 and the parsed
+            message is request.message, and responses that don't fit it raise
+            an EncodeError. Responses shorter than compress_min_size are not
+            compressed, and compress_level overrides the default level of
+            each content encoding. Streams are sequences of concatenated
+            items, and max_message_size limits the size of each item of a
+            streamed request. Batches are an array of items, or a map with
+            the array in 'items', and are answered like JsonCodec's.
+        """
+        if receives:
+            assert(isinstance(receives, GeneratedProtocolMessageType))
+        if sends:
+            assert(isinstance(sends, GeneratedProtocolMessageType))
+        self.receive_type = receives
+        self.send_type = sends
+        self.receive_plan = (
+            receives and compile_message_plan(receives.DESCRIPTOR)
+        )
+        self.send_plan = sends and compile_message_plan(sends.DESCRIPTOR)
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+        self.max_message_size = max_message_size
+
+    def parse_request_data(self, _request):
+        try:
+            data = self.loads(_request.get_data())
+        except self.decode_errors:
+            abort(400)
+        message = self.check_request_item(data)
+        if message is not None:
+            _request.message = message
+        return data
+
+    def check_request_item(self, data):
+        """
+            Abort with a 400 unless data is a dict that fits the receive type,
+            and return the receive_type message, if there is one.
+        """
+        if not isinstance(data, dict):
+            abort(400)
+        if self.receive_type:
+            message = self.check_message(self.receive_type, data)
+            if message is None:
+                abort(400)
+            return message
+        return None
+
+    def iter_request_data(self, _request):
+        """
+            Yield the items of a stream of concatenated items as they are
+            read.
+        """
+        items = self.iter_loads(_request.stream, self.max_message_size)
+        while True:
+            try:
+                data = next(items)
+            except StopIteration:
+                return
+            except self.decode_errors:
+                abort(400)
+            self.check_request_item(data)
+            yield data
+
+    def parse_batch_request_data(self, _request):
+        """
+            Parse an array, or a map with the array in 'items', into a list of
+            dicts.
+        """
+        try:
+            data = self.loads(_request.get_data())
+        except self.decode_errors:
+            abort(400)
+        if isinstance(data, dict):
+            data = data.get('items')
+        if not isinstance(data, list):
+            abort(400)
+        for item in data:
+            self.check_request_item(item)
+        return data
 
-# TODO: consider using the word 'decode' and 'encode' instead of copy
-def copy_dict_to_pb(instance, dictionary):
-    """
-        Copy the key, value pairs in a dictionary to the fields of an instance
-        of a protobuf message. This method assumes that key values in the
-        dictionary correspond to field names in the message. Enums are not well
-        supported.
-    """
-    assert(isinstance(dictionary, dict))
-    for key, value in dictionary.iteritems():
-        if value is None:
-            continue
-        # If the value is another dictionary set the field to the values
-        # in the nested dictionary
-        if isinstance(value, dict):
-            attribute = getattr(instance, key)
-            copy_dict_to_pb(attribute, value)
-        # If the value is iterable, copy the list into the repeated field
-        elif hasattr(value, "__iter__"):
-            attribute = getattr(instance, key)
-            if len(value) == 0 or not isinstance(value[0], dict):
-                attribute.extend(value)
-            else:
-                for item in value:
-                    copy_dict_to_pb(attribute.add(), item)
-        # Otherwise the value is a basic type, so set the field directly
-        else:
-            setattr(instance, key, value)
+    def make_batch_response(self, results, status_code, headers):
+        """
+            Encode a list of (status_code, data) results as a map with a
+            'results' array of {'status': status_code, 'body': data} maps.
+        """
+        body = []
+        for item_status_code, data in results:
+            result = {'status': item_status_code}
+            if data is not None:
+                result['body'] = data
+            body.append(result)
+        return Flask.response_class(
+            self.dumps({'results': body}),
+            mimetype=self.mimetype
+        ), status_code, headers
 
+    def make_stream_response(self, items, status_code, headers):
+        """
+            Stream items as a sequence of concatenated items.
+        """
+        return Flask.response_class(
+            stream_with_context(self._sequence(items)),
+            mimetype=self.mimetype
+        ), status_code, headers
 
-def copy_pb_to_dict(dictionary, instance):
+    def _sequence(self, items):
+        dumps = self.dumps
+        for item in items:
+            yield dumps(item)
 
-    for descriptor, value in instance.ListFields():
-        # If the field is another Protobuf Message, make a new dictionary
-        # and copy the messages fields
-        if isinstance(value, ProtocolMessage):
-            dictionary[descriptor.name] = {}
-            copy_pb_to_dict(dictionary[descriptor.name], value)
-        # If the field is repeated, create a list and copy the repeated field
-        # values into the dictionary
-        elif isinstance(value, BaseContainer):
-            dictionary[descriptor.name] = []
-            for item in value:
-                if isinstance(item, ProtocolMessage):
-                    dict_item = {}
-                    copy_pb_to_dict(dict_item, item)
-                    dictionary[descriptor.name].append(dict_item)
-                else:
-                    dictionary[descriptor.name].append(item)
-        # Otherwise the field value is just a basic type and should be set
-        # on the dict.
-        else:
-            dictionary[descriptor.name] = value
+    def make_response(self, data, status_code, headers):
+        if isinstance(data, RawMessage):
+            data = self.raw_message_data(data)
+        if self.send_type and isinstance(data, _DICT_TYPES):
+            if self.check_message(self.send_type, data) is None:
+                raise EncodeError(
+                    "Response data does not fit the {0} message.".format(
+                        self.send_type.DESCRIPTOR.full_name
+                    )
+                )
+        return Flask.response_class(
+            self.dumps(data),
+            mimetype=self.mimetype
+        ), status_code, headers
 
+    def warm(self):
+        for message_type in (self.send_type, self.receive_type):
+            if message_type:
+                warm_message_type(message_type)
 
-def _result_to_response_tuple(result):
-    # Returned tuples are also evaluated
-    if isinstance(result, tuple):
-        assert(len(result) > 0 and len(result) <= 3)
-        if (len(result) == 1):
-            return result[0], 200, {}
-        if (len(result) == 2):
-            return result[0], result[1], {}
-        elif (len(result) == 3):
-            return result
+    def check_message(self, message_type, data):
+        """
+            Copy data into a message_type, returning None if it has fields the
+            message doesn't, values of the wrong type or missing required
+            fields.
+        """
+        plan = compile_message_plan(message_type.DESCRIPTOR)
+        message = message_type()
+        try:
+            _dict_to_pb(plan, message, data)
+        except (AttributeError, TypeError, ValueError):
+            return None
+        if not message.IsInitialized():
+            return None
+        return message
 
-    return result, 200, {}
+    def raw_message_data(self, raw_message):
+        """
+            Decode a forwarded JSON or protobuf request to re-encode it.
+        """
+        if raw_message.mimetype == self.mimetype:
+            return self.loads(raw_message.data)
+        try:
+            if raw_message.mimetype == JsonCodec.mimetype:
+                return _json.loads(raw_message.data)
+            if raw_message.plan is not None:
+                return _json.loads(
+                    _protobuf_to_json(raw_message.plan, raw_message.data)
+                )
+        except (DecodeError, ValueError):
+            abort(400)
+        raise EncodeError(
+            "Can not transcode {0} data to {1}.".format(
+                raw_message.mimetype,
+                self.mimetype
+            )
+        )
 
 
-class JsonDictKeyError(KeyError):
-    pass
+class MsgpackCodec(SchemalessCodec):
+    mimetype = "application/x-msgpack"
+    decode_errors = (ValueError, TypeError)
 
+    def __init__(self, *args, **kwargs):
+        if _msgpack is None:
+            raise ImportError("MsgpackCodec needs the msgpack package")
+        super(MsgpackCodec, self).__init__(*args, **kwargs)
 
-class JsonResponseDict(dict):
-    def __getitem__(self, key):
-        try:
-            return super(JsonResponseDict, self).__getitem__(key)
-        except KeyError:
-            raise JsonDictKeyError(key)
+    def dumps(self, data):
+        return _msgpack.packb(
+            _binary_value(data),
+            use_bin_type=True,
+            default=_binary_default
+        )
 
+    def loads(self, data):
+        return _msgpack.unpackb(
+            data,
+            raw=False,
+            object_pairs_hook=JsonResponseDict
+        )
 
-class JsonCodec(object):
-    mimetype = "application/json"
+    def iter_loads(self, stream, max_size):
+        unpacker = _msgpack.Unpacker(
+            raw=False,
+            object_pairs_hook=JsonResponseDict,
+            max_buffer_size=max_size + STREAM_READ_SIZE
+        )
+        size = 0
+        while True:
+            chunk = stream.read(STREAM_READ_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            try:
+                unpacker.feed(chunk)
+            except _msgpack.BufferFull:
+                abort(413)  # Request Entity Too Large
+            for item in unpacker:
+                yield item
+        if unpacker.tell() != size:
+            abort(400)  # Truncated item
 
-    def parse_request_data(self, _request):
-        return JsonResponseDict(_request.get_json())
 
-    def make_response(self, data, status_code, headers):
-        response = jsonify(**data)
-        return response, status_code, headers
+def _cbor_object_hook(decoder, value):
+    return JsonResponseDict(value)
 
 
-class ProtobufCodec(object):
-    mimetype = "application/x-protobuf"
+class CborCodec(SchemalessCodec):
+    mimetype = "application/cbor"
 
-    def __init__(self, sends=None, receives=None, errors=None):
-        assert(sends or receives)
-        if sends:
-            assert(isinstance(sends, GeneratedProtocolMessageType))
-        if receives:
-            assert(isinstance(receives, GeneratedProtocolMessageType))
-        if errors:
-            assert(isinstance(errors, GeneratedProtocolMessageType))
+    def __init__(self, *args, **kwargs):
+        if _cbor2 is None:
+            raise ImportError("CborCodec needs the cbor2 package")
+        super(CborCodec, self).__init__(*args, **kwargs)
+        self.decode_errors = (_cbor2.CBORDecodeError, ValueError, TypeError)
 
-        self.send_type = sends
-        self.receive_type = receives
-        self.error_type = errors
+    def dumps(self, data):
+        return _cbor2.dumps(_binary_value(data))
 
-    def parse_request_data(self, _request):
-        if not self.receive_type:
-            abort(400)  # Bad Request
-        data_dict = {}
-        message = self.receive_type()
-        try:
-            message.ParseFromString(_request.data)
-        except DecodeError:
-            abort(400)
-        copy_pb_to_dict(data_dict, message)
+    def loads(self, data):
+        return _cbor2.loads(data, object_hook=_cbor_object_hook)
 
-        return data_dict
+    def iter_loads(self, stream, max_size):
+        reader = _LimitedReader(stream)
+        decoder = _cbor2.CBORDecoder(reader, object_hook=_cbor_object_hook)
+        while True:
+            start = reader.position
+            reader.limit = start + max_size
+            try:
+                item = decoder.decode()
+            except _cbor2.CBORDecodeEOF:
+                if reader.position != start:
+                    abort(400)  # Truncated item
+                return
+            yield item
 
-    def make_response(self, data, status_code, headers):
-        if not data:
-            Flask.response_class(
-                "",
-                mimetype=self.mimetype
-            ), status_code, headers
 
-        # if the status code is not a success code
-        if status_code % 100 == 4 and self.error_type:
-            response_data = self.error_type()
-        else:
-            if not self.send_type:
-                raise EncodeError(
-                    "Data could not be encoded into a protobuf message. No "
-                    "protobuf message type specified to send."
-                )
-            response_data = self.send_type()
+class _LimitedReader(object):
+    """
+        Counts the bytes read from a stream, aborting with a 413 once more
+        than limit have been read.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+        self.limit = None
 
-        copy_dict_to_pb(
-            instance=response_data,
-            dictionary=data
-        )
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.position += len(data)
+        if self.limit is not None and self.position > self.limit:
+            abort(413)  # Request Entity Too Large
+        return data
 
-        return Flask.response_class(
-            response_data.SerializeToString(),
-            mimetype=self.mimetype
-        ), status_code, headers
 
 json = JsonCodec()
 protobuf = ProtobufCodec
+# None when the msgpack or cbor2 package isn't installed
+msgpack = _msgpack and MsgpackCodec()
+cbor = _cbor2 and CborCodec()
+if msgpack is not None:
+    __all__.append('msgpack')
+if cbor is not None:
+    __all__.append('cbor')
+
+# Types a view may return for pbj to encode
+_DICT_TYPES = (dict, LazyMessageDict)
+_ENCODABLE_TYPES = _DICT_TYPES + (ProtocolMessage, RawMessage, GeneratorType)
 
 
 class api(object):
@@ -201,6 +3440,94 @@ class api(object):
     input and return a dictionary for output. The client's accept and
     content-type headers determine the format of the messages.
 
+    Protobuf requests also set request.message to the parsed message, and a
+    view may return a protobuf message instead of a dictionary. Together with
+    protobuf(..., as_message=True) this skips the dictionary copies entirely.
+
+    With api(..., lazy=True) the request body is only decoded when the view
+    first reads request.data_dict or request.message, and protobuf requests
+    are converted one field at a time as the view reads them. Unsupported
+    content types are still rejected before the view is called. Lazy
+    decoding needs the app's requests to come from Pbj(app), and views of
+    other apps raise a RuntimeError.
+
+    A view may also return a generator of dictionaries or messages. The items
+    are streamed as a JSON array, or newline delimited JSON with
+    JsonCodec(stream_format='ndjson'), and as length-prefixed send_type
+    messages for protobuf, so large results are never held in memory at once.
+
+    With api(..., stream_request=True) the request body is read in chunks
+    as the view iterates over request.data_iter, which yields a dictionary,
+    or a message with as_message, for each record of a newline delimited JSON
+    body or each message of a stream of length-prefixed protobuf messages.
+
+    Routes declared with api(..., batch=True) accept many requests at once,
+    as a JSON array or as a protobuf message with the receives messages in
+    repeated field 1. The view is called for each item, or once with the
+    list of items for batch='list', and the results are sent back with a
+    status code for each item:
+
+        message Batch {
+            repeated Person items = 1;
+        }
+
+        message BatchResults {
+            message Result {
+                optional uint32 status = 1;
+                optional Team body = 2;
+            }
+            repeated Result results = 1;
+        }
+
+    With api(..., etag=True) successful GET responses get an ETag computed
+    from the encoded body, unless the view returns an ETag header of its
+    own, and requests with a matching If-None-Match get an empty 304.
+    etag='data' computes the ETag from the data the view returned instead,
+    so a match skips encoding the response as well.
+
+    api(..., cache=MemoryCache()) caches the encoded responses to GET
+    requests, keyed on the view's arguments, the query string, the
+    negotiated mimetype and the value of cache_version(*args, **kwargs) if
+    given. A cached response is returned without calling the view.
+    cache_timeout overrides the cache's default timeout and the api counts
+    cache_hits and cache_misses. Views that return generators are streamed
+    and never cached or counted.
+
+    With api(..., field_mask=True) clients select the fields of successful
+    responses with a fields query parameter or an X-Field-Mask header, as
+    comma separated dotted paths such as 'id,people.name'. The compiled mask
+    is request.field_mask, and responses are pruned before they are encoded.
+
+    With api(..., validate=True) requests are checked against the receives
+    message type of the api's codecs, or the message type given as
+    validate, before the view is called: required and unknown fields, value
+    types, integer ranges, enum values and nested messages for dictionaries,
+    and required fields for protobuf messages. Invalid requests get a 400
+    with validation_errors(errors) as the body, encoded by the negotiated
+    codec, and the view isn't called. errors is a list of FieldErrors, and
+    the default validation_error_data returns {'errors': [{'field': ...,
+    'message': ...}]}, so a protobuf codec's errors type needs matching
+    fields or validation_errors must build a dictionary that fits it.
+    Protobuf responses without an errors type that fits are an empty 400.
+    Streamed requests are not validated.
+
+    Metrics hooks added with add_metrics_hook are called with the
+    RequestMetrics of each request.
+
+    Request bodies may be sent with a gzip, deflate or, when the zstandard
+    module is installed, zstd Content-Encoding. They are decompressed as
+    codecs read them, up to api(..., max_decompressed_size) bytes.
+
+    With api(..., compress=True) responses are compressed with the best
+    content encoding the client accepts: zstd and br when the zstandard and
+    brotli modules are installed, then gzip and deflate. Codecs set the
+    minimum size worth compressing and the compression level.
+
+    Views that only forward a request can return request.raw_message. The
+    body is sent back unchanged, or transcoded between JSON and the
+    protobuf receive and send types directly, without building a dictionary
+    or message in between.
+
     Similar to flask, routes can avoid pbj.api's response serialization by
     directly returning a flask.Response object.
 
@@ -256,87 +3583,662 @@ class api(object):
             -H "Content-type: application/x-protobuf" \
             http://127.0.0.1:5000/teams --data-binary @person.pb > team.pb
     """
-    def __init__(self, *codecs):
-        self.codecs = dict([(codec.mimetype, codec) for codec in codecs])
+    def __init__(self, *codecs, **options):
+        # Codecs by the mimetype of the request bodies they read
+        self.body_codecs = dict([(codec.mimetype, codec) for codec in codecs])
+        # and by the mimetypes of the responses they write
+        self.codecs = dict(self.body_codecs)
         self.mimetypes = [
             codec.mimetype for codec in codecs
         ]
+        for codec in codecs:
+            if getattr(codec, 'stream_format', None) == 'ndjson':
+                self.codecs[codec.ndjson_mimetype] = codec
+                self.mimetypes.append(codec.ndjson_mimetype)
+        self.lazy = options.pop('lazy', False)
+        self.stream_request = options.pop('stream_request', False)
+        if self.stream_request:
+            # Streamed JSON bodies are newline delimited JSON
+            for codec in codecs:
+                ndjson_mimetype = getattr(codec, 'ndjson_mimetype', None)
+                if ndjson_mimetype is not None:
+                    self.body_codecs[ndjson_mimetype] = codec
+        self.batch = options.pop('batch', False)
+        assert(self.batch in (False, True, 'list'))
+        self.compress = options.pop('compress', False)
+        self.etag = options.pop('etag', False)
+        assert(self.etag in (False, True, 'data'))
+        self.warmed = False
+        self.field_mask = options.pop('field_mask', False)
+        self.cache = options.pop('cache', None)
+        self.cache_timeout = options.pop('cache_timeout', None)
+        self.cache_version = options.pop('cache_version', None)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_lock = Lock()
+        # Views known to stream their responses, which skip the cache
+        self.streamed_views = set()
+        self.max_decompressed_size = options.pop(
+            'max_decompressed_size',
+            DEFAULT_MAX_DECOMPRESSED_SIZE
+        )
+        self.validator = None
+        validate = options.pop('validate', False)
+        if validate is True:
+            receive_types = [
+                codec.receive_type for codec in codecs
+                if getattr(codec, 'receive_type', None)
+            ]
+            if not receive_types:
+                raise ValueError(
+                    "api(validate=True) needs a codec with a receives "
+                    "message type"
+                )
+            validate = receive_types[0]
+        if validate:
+            self.validator = compile_validator(validate.DESCRIPTOR)
+        # Lazy decoding, and pooled request messages which go back to the
+        # pool when the request ends, need the request class of Pbj(app)
+        self.needs_extension = self.lazy or any(
+            getattr(codec, 'pool', None) is not None and
+            getattr(codec, 'receive_type', None)
+            for codec in codecs
+        )
+        # The plan of the first send type among the codecs, which finds the
+        # bytes fields of responses for codecs without a schema of their own
+        send_plans = [
+            codec.send_plan for codec in codecs
+            if getattr(codec, 'send_plan', None)
+        ]
+        self.send_plan = send_plans[0] if send_plans else None
+        self.validation_errors = options.pop(
+            'validation_errors',
+            validation_error_data
+        )
+
+        # Clients send the same few headers over and over, so the result of
+        # negotiating each raw header value is remembered
+        cache_size = options.pop(
+            'negotiation_cache_size',
+            DEFAULT_NEGOTIATION_CACHE_SIZE
+        )
+        self.request_codecs = LRUCache(cache_size)
+        self.response_mimetypes = LRUCache(cache_size)
+        self.response_encodings = LRUCache(cache_size)
+        if options:
+            raise TypeError(
+                "Unexpected api options: {0}".format(", ".join(options))
+            )
+
+    def request_codec(self, _request):
+        """
+        Return the codec for the body of a PUT or POST request, or None for
+        other methods.
+        """
+        if _request.method in ('POST', 'PUT'):
+            header = _request.environ.get('CONTENT_TYPE', '')
+            codec = self.request_codecs.get(header, _MISSING)
+            if codec is _MISSING:
+                # Ignore parameters such as charset=utf-8
+                mimetype = parse_options_header(header)[0].lower()
+                codec = self.body_codecs.get(mimetype)
+                self.request_codecs[header] = codec
+            if codec is None:
+                abort(415)  # Unsupported media type
+            self.decompress_request(_request)
+            return codec
+
+    def decompress_request(self, _request):
+        """
+        Decompress a gzip, deflate or zstd encoded request body as codecs
+        read it.
+        """
+        encoding = _request.headers.get('Content-Encoding', '')
+        encoding = encoding.strip().lower()
+        if not encoding or encoding == 'identity':
+            return
+        if encoding not in REQUEST_CONTENT_ENCODINGS:
+            abort(415)  # Unsupported media type
+        # Werkzeug reads all request data through the stream attribute, so
+        # replacing it decompresses the body for every way codecs read it
+        _request.__dict__['stream'] = DecompressingStream(
+            _request.stream,
+            encoding,
+            self.max_decompressed_size
+        )
 
     def parse_request_data(self, _request):
         """
         For PUT and POST requests, convert message into a dictionary which can
         be used by app.route functions.
         """
-        if _request.method in ('POST', 'PUT'):
-            if _request.content_type in self.mimetypes:
-                codec = self.codecs[_request.content_type]
-                return codec.parse_request_data(_request)
+        codec = self.request_codec(_request)
+        if codec is not None:
+            return codec.parse_request_data(_request)
+
+    def defer_request_data(self, _request, codec):
+        """
+        Decode the request with codec when the view first reads it.
+        """
+        parse = getattr(
+            codec,
+            'parse_request_data_lazy',
+            codec.parse_request_data
+        )
+        _request.defer_data(partial(parse, _request))
+
+    def response_encoding(self, _request):
+        """
+        Return the content encoding to compress the response with, or None.
+        """
+        header = _request.environ.get('HTTP_ACCEPT_ENCODING', '')
+        encoding = self.response_encodings.get(header, _MISSING)
+        if encoding is _MISSING:
+            encoding = _request.accept_encodings.best_match(CONTENT_ENCODINGS)
+            self.response_encodings[header] = encoding
+        return encoding
+
+    def finish_response(self, codec, response_tuple, etag=None):
+        """
+        Apply the api's response options to a codec's response.
+        """
+        response, status_code, headers = response_tuple
+        if (self.etag and etag is None and status_code == 200 and
+                request.method in ('GET', 'HEAD') and
+                not response.is_streamed):
+            etag = generate_etag(response.get_data())
+            if request.if_none_match.contains_weak(etag):
+                return self.not_modified(etag)
+        if etag is not None:
+            response.set_etag(etag)
+
+        if self.compress:
+            compress_response(
+                response,
+                self.response_encoding(request),
+                level=getattr(codec, 'compress_level', None),
+                min_size=getattr(
+                    codec,
+                    'compress_min_size',
+                    DEFAULT_COMPRESS_MIN_SIZE
+                )
+            )
+        return response_tuple
+
+    def request_field_mask(self, _request):
+        """
+        Return the compiled field mask from the fields query parameter or the
+        X-Field-Mask header, or None if the request has neither.
+        """
+        spec = _request.args.get('fields')
+        if spec is None:
+            spec = _request.headers.get(FIELD_MASK_HEADER)
+        if not spec:
+            return None
+        return compile_field_mask(spec)
+
+    def cache_key(self, mimetype, args, kwargs):
+        """
+        Key a response on the view and its arguments, the query string, the
+        negotiated mimetype and the version returned by cache_version.
+        """
+        version = None
+        if self.cache_version is not None:
+            version = self.cache_version(*args, **kwargs)
+        key = repr((
+            request.endpoint,
+            args,
+            sorted(kwargs.items()),
+            request.query_string,
+            request.headers.get(FIELD_MASK_HEADER),
+            mimetype,
+            version
+        ))
+        return 'pbj:' + sha1(key).hexdigest()
+
+    def cache_get(self, key):
+        cached = self.cache.get(key)
+        with self.cache_lock:
+            if cached is None:
+                self.cache_misses += 1
             else:
-                abort(415)  # Unsupported media type
+                self.cache_hits += 1
+        return cached
+
+    def uncache_view(self, fn):
+        """
+        Stop looking up the responses of a view that turned out to stream,
+        taking back the miss its request counted.
+        """
+        with self.cache_lock:
+            self.streamed_views.add(fn)
+            self.cache_misses -= 1
+
+    def cache_set(self, key, response_tuple, etag):
+        response, status_code, headers = response_tuple
+        self.cache.set(key, CachedResponse(
+            response.get_data(),
+            response.headers['Content-Type'],
+            status_code,
+            list(Headers(headers).items()),
+            etag
+        ), self.cache_timeout)
+
+    def cached_response(self, mimetype, cached):
+        """
+        Respond with a cached encoding, applying the api's response options
+        as if it had just been encoded.
+        """
+        if (cached.etag is not None and
+                request.if_none_match.contains_weak(cached.etag)):
+            return self.not_modified(cached.etag)
+        response = Flask.response_class(
+            cached.body,
+            content_type=cached.content_type
+        )
+        return self.finish_response(
+            self.codecs[mimetype],
+            (response, cached.status_code, cached.headers),
+            cached.etag
+        )
+
+    def not_modified(self, etag):
+        """
+        An empty 304 for a request whose If-None-Match matched.
+        """
+        response = Flask.response_class(status=304)
+        response.set_etag(etag)
+        if self.compress:
+            response.vary.add('Accept-Encoding')
+        return response
 
     def response_mimetype(self, _request):
         # Do we support this mimetype?
         # Will the method return a message?
         # if the method won't return a message, can we use another mimetype?
-        return _request.accept_mimetypes.best_match(
-            self.mimetypes
-        )
+        header = _request.environ.get('HTTP_ACCEPT', '')
+        mimetype = self.response_mimetypes.get(header, _MISSING)
+        if mimetype is _MISSING:
+            mimetype = _request.accept_mimetypes.best_match(self.mimetypes)
+            self.response_mimetypes[header] = mimetype
+        return mimetype
 
     def __call__(self, fn):
+        if isgeneratorfunction(fn):
+            self.streamed_views.add(fn)
+
         @wraps(fn)
         def to_response(*args, **kwargs):
+            if not _metrics_hooks:
+                return self.respond(fn, args, kwargs)
 
-            request.data_dict = self.parse_request_data(request)
+            metrics = request.metrics = RequestMetrics(request.endpoint)
+            metrics.request_size = request.content_length
+            result = None
             try:
-                result = fn(*args, **kwargs)
-            except JsonDictKeyError:
-                abort(400)
-
-            # Similar to flask's app.route, returned werkzeug responses are
-            # passed directly back to the caller
-            if isinstance(result, Response):
+                result = self.respond(fn, args, kwargs)
                 return result
+            except HTTPException as e:
+                metrics.status_code = e.code
+                raise
+            except Exception:
+                metrics.status_code = 500
+                raise
+            finally:
+                codec = getattr(request, 'codec', None)
+                if codec is not None:
+                    metrics.request_mimetype = codec.mimetype
+                metrics.finish(result)
 
-            # If the view method returns a default flask-style tuple throw
-            # an error as when making rest API's the view method more likely
-            # to return dicts and status codes than strings and headres
-            if (isinstance(result, tuple) and (
-                len(result) == 0 or
-                not isinstance(result[0], dict)
-            )):
-                raise EncodeError(
-                    "Pbj does not support flask's default tuple format "
-                    "of (response, headers) or (response, headers, "
-                    "status_code). Either return an instance of "
-                    "flask.response_class to override pbj's response "
-                    "encoding or return a tuple of (dict, status_code) "
-                    "or (dict, status_code, headers)."
-                )
+        # Lets Pbj find and warm the api of each route
+        to_response.pbj_api = self
+        return to_response
+
+    def warm(self):
+        """
+        Set up the message classes and conversion plans of the api's codecs,
+        and start their offload pools, ahead of the first request.
+        """
+        for codec in set(self.body_codecs.itervalues()):
+            warm = getattr(codec, 'warm', None)
+            if warm is not None:
+                warm()
+            offload = getattr(codec, 'offload', None)
+            if offload is not None:
+                offload.start()
+        self.warmed = True
+
+    def respond(self, fn, args, kwargs):
+        """
+        Decode the request, call the view and encode its result.
+        """
+        extended = isinstance(request._get_current_object(), PbjRequestMixin)
+        if self.needs_extension and not extended:
+            raise RuntimeError(
+                "api(..., lazy=True) and protobuf(receives=..., pool_size) "
+                "need an app set up with Pbj(app)"
+            )
+        codec = request.codec = self.request_codec(request)
+        _mark('negotiate')
+        if self.batch:
+            return self.batch_response(codec, fn, args, kwargs)
+
+        if self.field_mask:
+            request.field_mask = self.request_field_mask(request)
 
-            # Verify the server can respond to the client using
-            # a mimetype the client accepts. We check after calling because
-            # of the nature of Http 406
+        cache_key = None
+        if (self.cache is not None and request.method in ('GET', 'HEAD') and
+                fn not in self.streamed_views):
             mimetype = self.response_mimetype(request)
             if not mimetype:
                 abort(406)  # Not Acceptable
+            cache_key = self.cache_key(mimetype, args, kwargs)
+            cached = self.cache_get(cache_key)
+            if cached is not None:
+                return self.cached_response(mimetype, cached)
+
+        if not extended and not self.stream_request:
+            # Plain requests have no raw_message property
+            request.raw_message = _raw_message(request)
+        if codec is None:
+            request.data_dict = None
+        elif self.stream_request:
+            request.data_dict = None
+            request.data_iter = codec.iter_request_data(request)
+        elif self.lazy:
+            self.defer_request_data(request, codec)
+        else:
+            request.data_dict = codec.parse_request_data(request)
+        _mark('decode')
+        if (self.validator is not None and codec is not None and
+                not self.stream_request):
+            errors = self.request_errors(codec)
+            if errors:
+                return self.invalid_request(errors)
+        try:
+            result = fn(*args, **kwargs)
+        except JsonDictKeyError:
+            abort(400)
+        _mark('view')
+
+        # Similar to flask's app.route, returned werkzeug responses are
+        # passed directly back to the caller
+        if isinstance(result, Response):
+            return result
 
-            # If result is just an int, it must be a status code, so return
-            # the response with no data and a status code
-            if isinstance(result, int):
-                return Flask.response_class("", mimetype=mimetype), result, []
+        # If the view method returns a default flask-style tuple throw
+        # an error as when making rest API's the view method more likely
+        # to return dicts and status codes than strings and headres
+        if (isinstance(result, tuple) and (
+            len(result) == 0 or
+            not isinstance(result[0], _ENCODABLE_TYPES)
+        )):
+            raise EncodeError(
+                "Pbj does not support flask's default tuple format "
+                "of (response, headers) or (response, headers, "
+                "status_code). Either return an instance of "
+                "flask.response_class to override pbj's response "
+                "encoding or return a tuple of (dict, status_code) "
+                "or (dict, status_code, headers)."
+            )
 
-            data, status_code, headers = _result_to_response_tuple(result)
+        # Verify the server can respond to the client using
+        # a mimetype the client accepts. We check after calling because
+        # of the nature of Http 406
+        mimetype = self.response_mimetype(request)
+        if not mimetype:
+            abort(406)  # Not Acceptable
+        _mark('negotiate')
 
-            if not isinstance(data, dict):
-                raise EncodeError(
-                    "Methods decorated with api must return a dict, int "
-                    "status code or flask Response."
-                )
+        # If result is just an int, it must be a status code, so return
+        # the response with no data and a status code
+        if isinstance(result, int):
+            return Flask.response_class("", mimetype=mimetype), result, []
 
-            return self.codecs[mimetype].make_response(
+        data, status_code, headers = _result_to_response_tuple(result)
+
+        if not isinstance(data, _ENCODABLE_TYPES):
+            raise EncodeError(
+                "Methods decorated with api must return a dict, "
+                "generator, protobuf message, int status code or flask "
+                "Response."
+            )
+
+        field_mask = request.field_mask if self.field_mask else None
+        if field_mask is not None and status_code // 100 == 2:
+            if isinstance(data, GeneratorType):
+                data = (apply_field_mask(field_mask, item) for item in data)
+            else:
+                data = apply_field_mask(field_mask, data)
+            request.field_mask_applied = True
+
+        codec = self.codecs[mimetype]
+        if status_code // 100 == 2:
+            data = self.convert_bytes_fields(codec, data)
+        if isinstance(data, GeneratorType):
+            if cache_key is not None:
+                self.uncache_view(fn)
+            response_tuple = codec.make_stream_response(
                 data,
                 status_code,
                 headers
             )
+            _mark('encode')
+            return self.finish_response(codec, response_tuple)
 
-        return to_response
+        etag = None
+        if (self.etag and status_code == 200 and
+                request.method in ('GET', 'HEAD')):
+            # Check ETags supplied by the view, or computed from the
+            # view's data, before spending any time on encoding
+            headers = Headers(headers)
+            etag = headers.pop('ETag', None)
+            if etag is not None:
+                etag = unquote_etag(etag)[0]
+            elif self.etag == 'data':
+                etag = _data_etag(mimetype, data)
+            if (etag is not None and
+                    request.if_none_match.contains_weak(etag)):
+                return self.not_modified(etag)
+
+        response_tuple = codec.make_response(data, status_code, headers)
+        _mark('encode')
+        if cache_key is not None and status_code == 200:
+            self.cache_set(cache_key, response_tuple, etag)
+        return self.finish_response(codec, response_tuple, etag)
+
+    def convert_bytes_fields(self, codec, data):
+        """
+        Convert the bytes fields of response data, found with the send type,
+        for codecs that send bytes unlike text: base64 for JSON and byte
+        strings for the binary formats.
+        """
+        convert = getattr(codec, 'bytes_value', None)
+        plan = getattr(codec, 'send_plan', None) or self.send_plan
+        if convert is None or plan is None or not compile_bytes_fields(plan):
+            return data
+        if isinstance(data, GeneratorType):
+            return (convert_bytes_fields(plan, item, convert) for item in data)
+        return convert_bytes_fields(plan, data, convert)
+
+    def request_errors(self, codec):
+        """
+        Validate the request's message, or dictionary when the codec doesn't
+        parse messages, and return its FieldErrors.
+        """
+        message = None
+        if isinstance(codec, ProtobufCodec):
+            message = getattr(request, 'message', None)
+        return self.item_errors(
+            request.data_dict if message is None else message
+        )
+
+    def item_errors(self, item):
+        if isinstance(item, ProtocolMessage):
+            return message_errors(item)
+        if item is None:
+            return []
+        return self.validator.errors(item)
+
+    def invalid_request(self, errors):
+        """
+        Respond to a request that failed validation with a 400.
+        """
+        mimetype = self.response_mimetype(request)
+        if not mimetype:
+            abort(406)  # Not Acceptable
+        codec = self.codecs[mimetype]
+        data = self.error_data(codec, errors)
+        if data is None:
+            response_tuple = (
+                Flask.response_class("", mimetype=mimetype), 400, []
+            )
+        else:
+            response_tuple = codec.make_response(data, 400, {})
+        _mark('encode')
+        return self.finish_response(codec, response_tuple)
+
+    def error_data(self, codec, errors):
+        """
+        Return validation_errors(errors), or None if codec can't encode it:
+        a protobuf codec without an errors type, or whose errors type the
+        data doesn't fit.
+        """
+        data = self.validation_errors(errors)
+        error_plan = getattr(codec, 'error_plan', _MISSING)
+        if error_plan is None:
+            return None
+        if error_plan is not _MISSING:
+            message = codec.error_type()
+            try:
+                _dict_to_pb(error_plan, message, data)
+            except (AttributeError, TypeError, ValueError):
+                return None
+            if not message.IsInitialized():
+                return None
+        return data
+
+    def batch_response(self, codec, fn, args, kwargs):
+        """
+        Run the view for a batch request and encode its results. The view is
+        called once per item, or once with the list of items as
+        request.data_dict for api(..., batch='list').
+        """
+        if codec is None:
+            abort(400)  # Batches must be sent with PUT or POST
+        items = codec.parse_batch_request_data(request)
+
+        if self.batch == 'list':
+            if self.validator is not None:
+                errors = []
+                for index, item in enumerate(items):
+                    errors.extend(
+                        FieldError(
+                            '[{0}]{1}{2}'.format(
+                                index,
+                                '.' if error.field else '',
+                                error.field
+                            ),
+                            error.message
+                        )
+                        for error in self.item_errors(item)
+                    )
+                if errors:
+                    return self.invalid_request(errors)
+            request.data_dict = items
+            try:
+                results = fn(*args, **kwargs)
+            except JsonDictKeyError:
+                abort(400)
+            if isinstance(results, Response):
+                return results
+            if not isinstance(results, list) or len(results) != len(items):
+                raise EncodeError(
+                    "Batch views must return a list with one result for "
+                    "each item."
+                )
+            results = [_batch_result(result) for result in results]
+        else:
+            results = [
+                self.call_batch_item(fn, args, kwargs, item) for item in items
+            ]
+
+        mimetype = self.response_mimetype(request)
+        if not mimetype:
+            abort(406)  # Not Acceptable
+        codec = self.codecs[mimetype]
+        for index, (status_code, data) in enumerate(results):
+            # Items that failed validation are sent with errors the codec
+            # can encode
+            if isinstance(data, _FieldErrors):
+                data = self.error_data(codec, data)
+            elif status_code // 100 == 2:
+                data = self.convert_bytes_fields(codec, data)
+            results[index] = (status_code, data)
+        return self.finish_response(
+            codec,
+            codec.make_batch_response(results, 200, {})
+        )
+
+    def call_batch_item(self, fn, args, kwargs, item):
+        if self.validator is not None:
+            errors = self.item_errors(item)
+            if errors:
+                return 400, _FieldErrors(errors)
+        if isinstance(item, ProtocolMessage):
+            request.data_dict = None
+            request.message = item
+        else:
+            request.data_dict = item
+        try:
+            result = fn(*args, **kwargs)
+        except JsonDictKeyError:
+            return 400, None
+        except HTTPException as e:
+            return e.code, None
+        return _batch_result(result)
+
+
+class Pbj(object):
+    """
+        The flask extension. Pbj(app), or pbj.init_app(app) for application
+        factories, gives the app a request class with the attributes api
+        sets, such as request.data_dict and request.message, and warms the
+        api of every route so the first requests don't pay for setting up
+        message classes and conversion plans.
+    """
+    def __init__(self, app=None):
+        # The endpoints warmed so far
+        self.warmed = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not issubclass(app.request_class, PbjRequestMixin):
+            app.request_class = type(
+                'Pbj' + app.request_class.__name__,
+                (PbjRequestMixin, app.request_class),
+                {}
+            )
+        app.extensions['pbj'] = self
+        self.warm(app)
+        # Routes are often added after the extension is set up
+        before_first_request = getattr(app, 'before_first_request', None)
+        if before_first_request is not None:
+            before_first_request(partial(self.warm, app))
+
+    def warm(self, app):
+        """
+            Warm the api of each of the app's routes that hasn't been warmed
+            and return their endpoints.
+        """
+        warmed = []
+        for endpoint, view in sorted(app.view_functions.iteritems()):
+            pbj_api = getattr(view, 'pbj_api', None)
+            if pbj_api is not None and not pbj_api.warmed:
+                pbj_api.warm()
+                warmed.append(endpoint)
+        if warmed:
+            app.logger.debug("pbj warmed %s", ", ".join(warmed))
+            self.warmed.extend(warmed)
+        return warmed
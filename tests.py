@@ -1,13 +1,64 @@
+import array
+import datetime
 import unittest
+import zlib
 import flask
-from flask_pbj import api, json, protobuf
+import flask_pbj
+from flask_pbj import (
+    add_metrics_hook,
+    api,
+    apply_field_mask,
+    compile_field_mask,
+    CborCodec,
+    compile_message_plan,
+    compile_validator,
+    copy_dict_to_pb,
+    copy_pb_to_dict,
+    EncodeError,
+    ZERO_COPY_MIN_SIZE,
+    json,
+    JsonBackend,
+    JsonCodec,
+    json_to_protobuf,
+    LazyMessageDict,
+    MemoryCache,
+    MessagePool,
+    MetricsHistogram,
+    MsgpackCodec,
+    OffloadPool,
+    Pbj,
+    PbjRequestMixin,
+    protobuf,
+    protobuf_to_json,
+    remove_metrics_hook
+)
+from base64 import b64encode
 from json import dumps, loads
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+from google.protobuf.descriptor import (
+    Descriptor,
+    EnumDescriptor,
+    EnumValueDescriptor,
+    FieldDescriptor
+)
+from google.protobuf.internal.decoder import _DecodeVarint
+from google.protobuf.internal.encoder import _EncodeVarint
+from google.protobuf.message import DecodeError, Message
+from google.protobuf.reflection import GeneratedProtocolMessageType
 from werkzeug.exceptions import (
     BadRequest,
     NotAcceptable,
+    RequestEntityTooLarge,
     UnsupportedMediaType
 )
-from test_pb import Person
+from test_pb import Person, Village
 
 # TODO:
 # Empty data (both in requests and returned from view method)
@@ -118,6 +169,103 @@ class TestJson(unittest.TestCase):
             with self.assertRaises(BadRequest):
                 view_method()
 
+    def test_nested_missing_data(self):
+        app = flask.Flask(__name__)
+        with app.test_request_context(
+            data=dumps({'a': {'b': 1}}),
+            method='POST',
+            content_type="application/json",
+            headers={
+                "Accept": "application/json"
+            }
+        ):
+            @api(json)
+            def view_method():
+                return flask.request.data_dict['a']['c']
+
+            with self.assertRaises(BadRequest):
+                view_method()
+
+    def test_compact_response(self):
+        app = flask.Flask(__name__)
+        app.debug = True
+        with app.test_request_context(
+            method='GET',
+            headers={
+                "Accept": "application/json"
+            }
+        ):
+            @api(json)
+            def view_method():
+                return {'a': [1, 2], 'when': datetime.date(2014, 1, 1)}
+
+            response, status_code, headers = view_method()
+
+        self.assertTrue(response.data.startswith('{"a":[1,2],'))
+        self.assertEquals(
+            loads(response.data),
+            {'a': [1, 2], 'when': 'Wed, 01 Jan 2014 00:00:00 GMT'}
+        )
+
+    def test_custom_backend(self):
+        class UpperBackend(JsonBackend):
+            def dumps(self, data):
+                return super(UpperBackend, self).dumps(data).upper()
+
+        app = flask.Flask(__name__)
+        with app.test_request_context(
+            method='GET',
+            headers={
+                "Accept": "application/json"
+            }
+        ):
+            @api(JsonCodec(backend=UpperBackend()))
+            def view_method():
+                return {'a': 'b'}
+
+            response, status_code, headers = view_method()
+
+        self.assertEquals(response.data, '{"A":"B"}')
+
+    def test_content_type_parameters(self):
+        app = flask.Flask(__name__)
+        with app.test_request_context(
+            data=dumps({'a': 1}),
+            method='POST',
+            content_type="application/json; charset=utf-8",
+            headers={
+                "Accept": "application/json"
+            }
+        ):
+            @api(json)
+            def view_method():
+                return flask.request.data_dict
+
+            response, status_code, headers = view_method()
+            self.assertEquals(loads(response.data), {'a': 1})
+
+    def test_negotiation_cache(self):
+        negotiating_api = api(json, negotiation_cache_size=1)
+
+        @negotiating_api
+        def view_method():
+            return {'a': 1}
+
+        app = flask.Flask(__name__)
+        for accept, status in [
+            ("application/json", 200),
+            ("application/x-plist", 406),
+            ("application/json", 200),
+        ]:
+            with app.test_request_context(headers={"Accept": accept}):
+                try:
+                    response, status_code, headers = view_method()
+                except NotAcceptable as e:
+                    status_code = e.code
+                self.assertEquals(status_code, status)
+        self.assertEquals(len(negotiating_api.response_mimetypes), 1)
+
+
 class TestProtobuf(unittest.TestCase):
     def test_simple_pb_request(self):
         data = Person()
@@ -223,6 +371,49 @@ class TestProtobuf(unittest.TestCase):
             with self.assertRaises(BadRequest):
                 view_method()
 
+    def test_as_message(self):
+        person = Person()
+        person.id = 1
+        person.name = "tester"
+
+        app = flask.Flask(__name__)
+        with app.test_request_context(
+            data=person.SerializeToString(),
+            method='POST',
+            content_type="application/x-protobuf",
+            headers={
+                "Accept": "application/x-protobuf"
+            }
+        ):
+            @api(protobuf(receives=Person, sends=Person, as_message=True))
+            def view_method():
+                self.assertIsNone(flask.request.data_dict)
+                self.assertEqual(flask.request.message, person)
+                flask.request.message.email = "tester@example.com"
+                return flask.request.message
+
+            response, status_code, headers = view_method()
+
+        response_data = Person()
+        response_data.ParseFromString(response.data)
+        self.assertEquals(response_data.email, "tester@example.com")
+        self.assertEquals(status_code, 200)
+
+    def test_wrong_message_type(self):
+        app = flask.Flask(__name__)
+        with app.test_request_context(
+            method='GET',
+            headers={
+                "Accept": "application/x-protobuf"
+            }
+        ):
+            @api(protobuf(sends=Person))
+            def view_method():
+                return Village()
+
+            with self.assertRaises(EncodeError):
+                view_method()
+
 
 class TestPbj(unittest.TestCase):
     def test_json_favored(self):
@@ -256,6 +447,1961 @@ class TestPbj(unittest.TestCase):
         self.assertEquals(loads(response.data), response_data)
         self.assertEquals(response.mimetype, "application/json")
 
+    def test_message_as_json(self):
+        person = Person()
+        person.id = 1
+        person.name = "tester"
+
+        app = flask.Flask(__name__)
+        with app.test_request_context(
+            method='GET',
+            headers={
+                "Accept": "application/json"
+            }
+        ):
+            @api(json, protobuf(sends=Person))
+            def view_method():
+                return person, 201
+
+            response, status_code, headers = view_method()
+
+        self.assertEquals(loads(response.data), {'id': 1, 'name': 'tester'})
+        self.assertEquals(status_code, 201)
+
+
+class TestLazy(unittest.TestCase):
+    def test_unread_data_is_not_decoded(self):
+        app = flask.Flask(__name__)
+        Pbj(app)
+        with app.test_request_context(
+            data="this data is malformed because it is not a json object literal.",
+            method='POST',
+            content_type="application/json",
+            headers={
+                "Accept": "application/json"
+            }
+        ):
+            @api(json, lazy=True)
+            def view_method():
+                return 204
+
+            response, status_code, headers = view_method()
+
+        self.assertEquals(status_code, 204)
+
+    def test_unsupported_media_type(self):
+        app = flask.Flask(__name__)
+        Pbj(app)
+        with app.test_request_context(
+            method='POST',
+            content_type="application/x-plist",
+            headers={
+                "Accept": "application/json"
+            }
+        ):
+            @api(json, lazy=True)
+            def view_method():
+                return 204
+
+            with self.assertRaises(UnsupportedMediaType):
+                view_method()
+
+    def test_missing_json_key(self):
+        app = flask.Flask(__name__)
+        Pbj(app)
+        with app.test_request_context(
+            data=dumps({'a': 1}),
+            method='POST',
+            content_type="application/json",
+            headers={
+                "Accept": "application/json"
+            }
+        ):
+            @api(json, lazy=True)
+            def view_method():
+                return flask.request.data_dict['b']
+
+            with self.assertRaises(BadRequest):
+                view_method()
+
+    def test_protobuf_fields_converted_on_read(self):
+        village = Village()
+        copy_dict_to_pb(village, TestConversion.village_dict)
+
+        app = flask.Flask(__name__)
+        Pbj(app)
+        with app.test_request_context(
+            data=village.SerializeToString(),
+            method='POST',
+            content_type="application/x-protobuf",
+            headers={
+                "Accept": "application/json"
+            }
+        ):
+            @api(json, protobuf(receives=Village), lazy=True)
+            def view_method():
+                data_dict = flask.request.data_dict
+                self.assertIsInstance(data_dict, LazyMessageDict)
+                self.assertEqual(data_dict['people'][1]['name'], 'two')
+                self.assertEqual(
+                    sorted(data_dict.keys()),
+                    ['numbers', 'people']
+                )
+                return data_dict
+
+            response, status_code, headers = view_method()
+
+        self.assertEquals(loads(response.data), TestConversion.village_dict)
+
+
+class TestConversion(unittest.TestCase):
+    village_dict = {
+        'people': [
+            {'id': 1, 'name': 'one', 'email': 'one@example.com'},
+            {'id': 2, 'name': 'two'},
+        ],
+        'numbers': [1, 2, 3],
+    }
+
+    def test_round_trip(self):
+        village = Village()
+        copy_dict_to_pb(village, self.village_dict)
+        self.assertEquals(village.people[1].name, 'two')
+        self.assertEquals(list(village.numbers), [1, 2, 3])
+
+        data = {}
+        copy_pb_to_dict(data, village)
+        self.assertEquals(data, self.village_dict)
+
+    def test_empty_and_none_values(self):
+        village = Village()
+        copy_dict_to_pb(village, {'people': [], 'numbers': None})
+        data = {}
+        copy_pb_to_dict(data, village)
+        self.assertEquals(data, {})
+
+    def test_unknown_field(self):
+        with self.assertRaises(AttributeError):
+            copy_dict_to_pb(Person(), {'nickname': 'tester'})
+
+    def test_plans_are_shared(self):
+        village_plan = compile_message_plan(Village.DESCRIPTOR)
+        self.assertIs(village_plan, compile_message_plan(Village.DESCRIPTOR))
+        self.assertIs(
+            village_plan.fields_by_name['people'].message_plan,
+            compile_message_plan(Person.DESCRIPTOR)
+        )
+
+
+class TestTranscode(unittest.TestCase):
+    def test_json_to_protobuf(self):
+        village = Village()
+        copy_dict_to_pb(village, TestConversion.village_dict)
+        self.assertEquals(
+            json_to_protobuf(Village, dumps(TestConversion.village_dict)),
+            village.SerializeToString()
+        )
+
+    def test_protobuf_to_json(self):
+        village = Village()
+        copy_dict_to_pb(village, TestConversion.village_dict)
+        village.numbers.append(-5)
+        expected = dict(TestConversion.village_dict, numbers=[1, 2, 3, -5])
+        self.assertEquals(
+            loads(protobuf_to_json(Village, village.SerializeToString())),
+            expected
+        )
+
+    def test_invalid_json(self):
+        with self.assertRaises(ValueError):
+            json_to_protobuf(Person, dumps({'id': 1}))
+        with self.assertRaises(ValueError):
+            json_to_protobuf(Person, dumps({'id': 1, 'name': 'a', 'age': 2}))
+        with self.assertRaises(ValueError):
+            json_to_protobuf(Person, dumps({'id': 'one', 'name': 'a'}))
+
+    def test_invalid_protobuf(self):
+        with self.assertRaises(DecodeError):
+            protobuf_to_json(Person, '\x0a\x05abc')
+
+    def test_int_out_of_range(self):
+        for value in (2 ** 32 + 1, 2 ** 31, -2 ** 31 - 1):
+            with self.assertRaises(ValueError):
+                json_to_protobuf(Person, dumps({'id': value, 'name': 'x'}))
+        data = json_to_protobuf(Person, dumps({'id': -2 ** 31, 'name': 'x'}))
+        self.assertEquals(data,
+                          Person(id=-2 ** 31, name='x').SerializeToString())
+        self.assertEquals(loads(protobuf_to_json(Person, data)),
+                          {'id': -2 ** 31, 'name': 'x'})
+
+    def test_varint32_truncated(self):
+        # Parsers keep the low 32 bits of a varint sent for an int32 field
+        data = bytearray([0x08])
+        data.extend('\x81\x80\x80\x80\x10')  # 2 ** 32 + 1
+        data.extend('\x12\x01x')
+        person = Person()
+        person.ParseFromString(str(data))
+        self.assertEquals(person.id, 1)
+        self.assertEquals(loads(protobuf_to_json(Person, str(data))),
+                          {'id': 1, 'name': 'x'})
+
+    def test_raw_message_json_to_protobuf(self):
+        app = flask.Flask(__name__)
+        Pbj(app)
+        with app.test_request_context(
+            data=dumps({'id': 1, 'name': 'tester'}),
+            method='POST',
+            content_type="application/json",
+            headers={
+                "Accept": "application/x-protobuf"
+            }
+        ):
+            @api(json, protobuf(receives=Person, sends=Person), lazy=True)
+            def view_method():
+                return flask.request.raw_message
+
+            response, status_code, headers = view_method()
+
+        person = Person()
+        person.ParseFromString(response.data)
+        self.assertEquals(person.name, 'tester')
+        self.assertEquals(response.mimetype, 'application/x-protobuf')
+
+    def test_raw_message_protobuf_to_json(self):
+        person = Person()
+        person.id = 1
+        person.name = 'tester'
+
+        app = flask.Flask(__name__)
+        Pbj(app)
+        with app.test_request_context(
+            data=person.SerializeToString(),
+            method='POST',
+            content_type="application/x-protobuf",
+            headers={
+                "Accept": "application/json"
+            }
+        ):
+            @api(json, protobuf(receives=Person, sends=Person), lazy=True)
+            def view_method():
+                return flask.request.raw_message
+
+            response, status_code, headers = view_method()
+
+        self.assertEquals(loads(response.data), {'id': 1, 'name': 'tester'})
+        self.assertEquals(response.mimetype, 'application/json')
+
+
+class TestStreaming(unittest.TestCase):
+    def make_app(self, *codecs):
+        app = flask.Flask(__name__)
+
+        @app.route('/people')
+        @api(*codecs)
+        def people():
+            return (
+                {'id': i, 'name': 'person {0}'.format(i)} for i in range(3)
+            )
+
+        return app.test_client()
+
+    def test_json_array(self):
+        response = self.make_app(json).get(
+            '/people',
+            headers={"Accept": "application/json"}
+        )
+        self.assertEquals(
+            loads(response.data),
+            [{'id': i, 'name': 'person {0}'.format(i)} for i in range(3)]
+        )
+
+    def test_items_written_as_yielded(self):
+        pulled = []
+        app = flask.Flask(__name__)
+
+        @app.route('/people')
+        @api(json, protobuf(sends=Person))
+        def people():
+            for i in range(2):
+                pulled.append(i)
+                yield {'id': i, 'name': 'person {0}'.format(i)}
+
+        client = app.test_client()
+        # Each JSON item is written with its separator before the next one
+        # is produced
+        response = client.get(
+            '/people',
+            headers={"Accept": "application/json"},
+            buffered=False
+        )
+        chunks = iter(response.response)
+        self.assertEquals(loads(next(chunks)[1:]),
+                          {'id': 0, 'name': 'person 0'})
+        self.assertEquals(pulled, [0])
+        self.assertEquals(loads(next(chunks)[1:]),
+                          {'id': 1, 'name': 'person 1'})
+        self.assertEquals(pulled, [0, 1])
+        response.close()
+
+        # Each protobuf message is written with its length prefix
+        del pulled[:]
+        response = client.get(
+            '/people',
+            headers={"Accept": "application/x-protobuf"},
+            buffered=False
+        )
+        chunk = next(iter(response.response))
+        size, position = _DecodeVarint(chunk, 0)
+        self.assertEquals(position + size, len(chunk))
+        person = Person()
+        person.ParseFromString(chunk[position:])
+        self.assertEquals(person.name, 'person 0')
+        self.assertEquals(pulled, [0])
+        response.close()
+
+    def test_ndjson(self):
+        client = self.make_app(JsonCodec(stream_format='ndjson'))
+        for accept in ("application/json", "application/x-ndjson"):
+            response = client.get('/people', headers={"Accept": accept})
+            self.assertEquals(response.mimetype, 'application/x-ndjson')
+            self.assertEquals(
+                [loads(line) for line in response.data.splitlines()],
+                [{'id': i, 'name': 'person {0}'.format(i)} for i in range(3)]
+            )
+
+        # Only ndjson streams are offered as ndjson
+        response = self.make_app(json).get(
+            '/people',
+            headers={"Accept": "application/x-ndjson"}
+        )
+        self.assertEquals(response.status_code, 406)
+
+    def test_delimited_protobuf(self):
+        response = self.make_app(protobuf(sends=Person)).get(
+            '/people',
+            headers={"Accept": "application/x-protobuf"}
+        )
+        data = response.data
+        names = []
+        position = 0
+        while position < len(data):
+            size, position = _DecodeVarint(data, position)
+            person = Person()
+            person.ParseFromString(data[position:position + size])
+            names.append(person.name)
+            position += size
+        self.assertEquals(names, ['person 0', 'person 1', 'person 2'])
+
+    def test_ndjson_request(self):
+        records = [{'id': i} for i in range(3)]
+        app = flask.Flask(__name__)
+        for content_type in ("application/json", "application/x-ndjson"):
+            with app.test_request_context(
+                data='\n'.join(dumps(record) for record in records) + '\n',
+                method='POST',
+                content_type=content_type,
+                headers={
+                    "Accept": "application/json"
+                }
+            ):
+                @api(json, stream_request=True)
+                def view_method():
+                    self.assertIsNone(flask.request.data_dict)
+                    self.assertEquals(list(flask.request.data_iter), records)
+                    return 204
+
+                view_method()
+
+    def test_ndjson_needs_stream_request(self):
+        app = flask.Flask(__name__)
+        with app.test_request_context(
+            data=dumps({'id': 1}) + '\n',
+            method='POST',
+            content_type="application/x-ndjson",
+            headers={
+                "Accept": "application/json"
+            }
+        ):
+            @api(json)
+            def view_method():
+                return 204
+
+            with self.assertRaises(UnsupportedMediaType):
+                view_method()
+
+    def test_delimited_protobuf_request(self):
+        data = bytearray()
+        for i in range(3):
+            person = Person()
+            person.id = i
+            person.name = 'person {0}'.format(i) * 10000
+            _EncodeVarint(data.extend, person.ByteSize())
+            data.extend(person.SerializeToString())
+
+        app = flask.Flask(__name__)
+        with app.test_request_context(
+            data=str(data),
+            method='POST',
+            content_type="application/x-protobuf",
+            headers={
+                "Accept": "application/x-protobuf"
+            }
+        ):
+            @api(protobuf(receives=Person), stream_request=True)
+            def view_method():
+                self.assertEquals(
+                    [item['id'] for item in flask.request.data_iter],
+                    [0, 1, 2]
+                )
+                return 204
+
+            view_method()
+
+    def test_message_too_large(self):
+        person = Person()
+        person.id = 1
+        person.name = 'tester'
+        data = bytearray()
+        _EncodeVarint(data.extend, person.ByteSize())
+        data.extend(person.SerializeToString())
+
+        app = flask.Flask(__name__)
+        with app.test_request_context(
+            data=str(data),
+            method='POST',
+            content_type="application/x-protobuf"
+        ):
+            @api(
+                protobuf(receives=Person, max_message_size=4),
+                stream_request=True
+            )
+            def view_method():
+                list(flask.request.data_iter)
+
+            with self.assertRaises(RequestEntityTooLarge):
+                view_method()
+
+
+class TestBatch(unittest.TestCase):
+    def make_app(self, batch=True):
+        app = flask.Flask(__name__)
+
+        @app.route('/people', methods=['POST'])
+        @api(json, protobuf(receives=Person, sends=Person), batch=batch)
+        def people():
+            if batch == 'list':
+                return [
+                    dict(item, email='list')
+                    for item in flask.request.data_dict
+                ]
+            person = flask.request.data_dict
+            if person['id'] < 0:
+                flask.abort(404)
+            return dict(person, email='item'), 201
+
+        return app.test_client()
+
+    def test_json_batch(self):
+        response = self.make_app().post(
+            '/people',
+            data=dumps([{'id': 1, 'name': 'one'}, {'id': -1, 'name': 'two'}]),
+            content_type="application/json",
+            headers={"Accept": "application/json"}
+        )
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(loads(response.data), {'results': [
+            {'status': 201, 'body': {'id': 1, 'name': 'one', 'email': 'item'}},
+            {'status': 404},
+        ]})
+
+    def test_json_batch_list(self):
+        response = self.make_app('list').post(
+            '/people',
+            data=dumps({'items': [{'id': 1, 'name': 'one'}]}),
+            content_type="application/json",
+            headers={"Accept": "application/json"}
+        )
+        self.assertEquals(loads(response.data), {'results': [
+            {'status': 200, 'body': {'id': 1, 'name': 'one', 'email': 'list'}},
+        ]})
+
+    def test_protobuf_batch(self):
+        def field(number, data):
+            # A length-delimited field
+            prefix = bytearray()
+            _EncodeVarint(prefix.extend, number << 3 | 2)
+            _EncodeVarint(prefix.extend, len(data))
+            return str(prefix) + data
+
+        data = ''
+        for i in (1, -1):
+            person = Person()
+            person.id = i
+            person.name = 'tester'
+            data += field(1, person.SerializeToString())
+
+        response = self.make_app().post(
+            '/people',
+            data=data,
+            content_type="application/x-protobuf",
+            headers={"Accept": "application/x-protobuf"}
+        )
+
+        person = Person()
+        person.id = 1
+        person.name = 'tester'
+        person.email = 'item'
+        status = bytearray()
+        _EncodeVarint(status.extend, 201)
+        self.assertEquals(
+            response.data,
+            field(1, '\x08' + str(status) + field(2, person.SerializeToString())) +
+            field(1, '\x08\x94\x03')
+        )
+
+
+class TestCompression(unittest.TestCase):
+    def make_app(self):
+        app = flask.Flask(__name__)
+
+        @app.route('/numbers/<int:count>')
+        @api(json, protobuf(sends=Village), compress=True)
+        def numbers(count):
+            return {'numbers': range(count)}
+
+        @app.route('/people')
+        @api(json, compress=True)
+        def people():
+            return ({'id': i} for i in range(1000))
+
+        return app.test_client()
+
+    def test_gzip(self):
+        response = self.make_app().get('/numbers/1000', headers={
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip, deflate",
+        })
+        self.assertEquals(response.headers['Content-Encoding'], 'gzip')
+        self.assertEquals(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEquals(
+            loads(zlib.decompress(response.data, 16 + zlib.MAX_WBITS)),
+            {'numbers': range(1000)}
+        )
+
+    def test_deflate(self):
+        response = self.make_app().get('/numbers/1000', headers={
+            "Accept": "application/x-protobuf",
+            "Accept-Encoding": "deflate",
+        })
+        self.assertEquals(response.headers['Content-Encoding'], 'deflate')
+        village = Village()
+        village.ParseFromString(zlib.decompress(response.data))
+        self.assertEquals(list(village.numbers), range(1000))
+
+    def test_small_response(self):
+        response = self.make_app().get('/numbers/3', headers={
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip",
+        })
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEquals(loads(response.data), {'numbers': [0, 1, 2]})
+
+    def test_streamed_response(self):
+        response = self.make_app().get('/people', headers={
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip",
+        })
+        self.assertEquals(response.headers['Content-Encoding'], 'gzip')
+        self.assertEquals(
+            loads(zlib.decompress(response.data, 16 + zlib.MAX_WBITS)),
+            [{'id': i} for i in range(1000)]
+        )
+
+    def test_streamed_chunks_flushed(self):
+        chunks = ['[{"id":0}', ',{"id":1}', ']']
+        compressed = list(flask_pbj._compress_chunks('gzip', 6, chunks))
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for chunk, data in zip(chunks, compressed):
+            self.assertEquals(decompressor.decompress(data), chunk)
+
+    def post(self, data, encoding, content_type="application/json",
+             **options):
+        app = flask.Flask(__name__)
+        with app.test_request_context(
+            data=data,
+            method='POST',
+            content_type=content_type,
+            headers={
+                "Accept": "application/json",
+                "Content-Encoding": encoding,
+            }
+        ):
+            @api(json, protobuf(receives=Village), **options)
+            def view_method():
+                return flask.request.data_dict
+
+            response, status_code, headers = view_method()
+            return loads(response.data)
+
+    def test_gzip_request(self):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(dumps({'a': 1})) + compressor.flush()
+        self.assertEquals(self.post(data, 'gzip'), {'a': 1})
+
+    def test_deflate_request(self):
+        village = Village()
+        village.numbers.extend(range(1000))
+        data = zlib.compress(village.SerializeToString())
+        self.assertEquals(
+            self.post(data, 'deflate', "application/x-protobuf"),
+            {'numbers': range(1000)}
+        )
+
+    def test_decompressed_size_limit(self):
+        data = zlib.compress(dumps({'a': ' ' * 100000}))
+        with self.assertRaises(RequestEntityTooLarge):
+            self.post(data, 'deflate', max_decompressed_size=1000)
+
+    def test_corrupt_request(self):
+        with self.assertRaises(BadRequest):
+            self.post('not deflate data', 'deflate')
+
+    def test_truncated_request(self):
+        village = Village()
+        village.numbers.extend(range(20000))
+        for encoding, wbits in (('gzip', 16 + zlib.MAX_WBITS),
+                                ('deflate', zlib.MAX_WBITS)):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+            data = (compressor.compress(village.SerializeToString()) +
+                    compressor.flush())
+            self.assertEquals(
+                len(self.post(data, encoding,
+                              "application/x-protobuf")['numbers']),
+                20000
+            )
+            for size in range(1, len(data), len(data) // 20 or 1) + [
+                    len(data) - 1]:
+                with self.assertRaises(BadRequest):
+                    self.post(data[:size], encoding,
+                              "application/x-protobuf")
+
+    def test_unsupported_encoding(self):
+        with self.assertRaises(UnsupportedMediaType):
+            self.post(dumps({'a': 1}), 'compress')
+
+
+class CountingJsonCodec(JsonCodec):
+    def __init__(self):
+        super(CountingJsonCodec, self).__init__()
+        self.encoded = 0
+
+    def make_response(self, data, status_code, headers):
+        self.encoded += 1
+        return super(CountingJsonCodec, self).make_response(
+            data, status_code, headers)
+
+
+class TestETag(unittest.TestCase):
+    def make_app(self, **options):
+        app = flask.Flask(__name__)
+        self.codec = CountingJsonCodec()
+
+        @app.route('/numbers/<int:count>', methods=['GET', 'POST'])
+        @api(self.codec, **options)
+        def numbers(count):
+            return {'numbers': range(count)}
+
+        @app.route('/versioned')
+        @api(self.codec, **options)
+        def versioned():
+            return {'a': 1}, 200, {'ETag': '"v1"'}
+
+        self.client = app.test_client()
+
+    def get(self, path, **headers):
+        headers['Accept'] = 'application/json'
+        return self.client.get(path, headers=headers)
+
+    def test_etag(self):
+        self.make_app(etag=True)
+        response = self.get('/numbers/3')
+        etag = response.headers['ETag']
+        self.assertEquals(loads(response.data), {'numbers': [0, 1, 2]})
+
+        response = self.get('/numbers/3', **{'If-None-Match': etag})
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response.data, '')
+        self.assertEquals(response.headers['ETag'], etag)
+
+        response = self.get('/numbers/4', **{'If-None-Match': etag})
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response.headers['ETag'], etag)
+
+    def test_post_has_no_etag(self):
+        self.make_app(etag=True)
+        response = self.client.post(
+            '/numbers/3',
+            headers={'Accept': 'application/json'},
+            data=dumps({}),
+            content_type='application/json'
+        )
+        self.assertNotIn('ETag', response.headers)
+
+    def test_view_etag(self):
+        self.make_app(etag=True)
+        response = self.get('/versioned')
+        self.assertEquals(response.headers['ETag'], '"v1"')
+        self.assertEquals(self.codec.encoded, 1)
+
+        response = self.get('/versioned', **{'If-None-Match': '"v1"'})
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(self.codec.encoded, 1)
+
+    def test_data_etag_skips_encoding(self):
+        self.make_app(etag='data')
+        etag = self.get('/numbers/3').headers['ETag']
+        response = self.get('/numbers/3', **{'If-None-Match': etag})
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(self.codec.encoded, 1)
+
+    def test_compressed_etag_is_weak(self):
+        self.make_app(etag=True, compress=True)
+        response = self.get('/numbers/1000', **{'Accept-Encoding': 'gzip'})
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        response = self.get('/numbers/1000', **{
+            'Accept-Encoding': 'gzip',
+            'If-None-Match': etag,
+        })
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response.headers['Vary'], 'Accept-Encoding')
+
+
+class TestResponseCache(unittest.TestCase):
+    def make_app(self, cache, **options):
+        app = flask.Flask(__name__)
+        self.codec = CountingJsonCodec()
+        self.calls = 0
+        self.version = 1
+        self.api = api(self.codec, cache=cache, **options)
+
+        @app.route('/numbers/<int:count>')
+        @self.api
+        def numbers(count):
+            self.calls += 1
+            return {'numbers': range(count)}
+
+        self.client = app.test_client()
+
+    def get(self, path, **headers):
+        headers['Accept'] = 'application/json'
+        return self.client.get(path, headers=headers)
+
+    def test_cache(self):
+        self.make_app(MemoryCache())
+        for _ in range(3):
+            response = self.get('/numbers/3')
+            self.assertEquals(loads(response.data), {'numbers': [0, 1, 2]})
+            self.assertEquals(response.mimetype, 'application/json')
+        self.assertEquals(self.calls, 1)
+        self.assertEquals(self.codec.encoded, 1)
+
+        self.get('/numbers/4')
+        self.get('/numbers/3?page=2')
+        self.assertEquals(self.calls, 3)
+        self.assertEquals(self.api.cache_hits, 2)
+        self.assertEquals(self.api.cache_misses, 3)
+
+    def test_streamed_views_are_not_cached(self):
+        app = flask.Flask(__name__)
+        stream_api = api(json, cache=MemoryCache())
+
+        @app.route('/generator')
+        @stream_api
+        def generator():
+            for i in range(3):
+                yield {'id': i}
+
+        @app.route('/expression')
+        @stream_api
+        def expression():
+            return ({'id': i} for i in range(3))
+
+        client = app.test_client()
+        for path in ('/generator', '/expression'):
+            for _ in range(2):
+                response = client.get(path, headers={
+                    "Accept": "application/json",
+                })
+                self.assertEquals(loads(response.data),
+                                  [{'id': i} for i in range(3)])
+        self.assertEquals(stream_api.cache_hits, 0)
+        self.assertEquals(stream_api.cache_misses, 0)
+
+    def test_version(self):
+        self.make_app(MemoryCache(), cache_version=lambda count: self.version)
+        self.get('/numbers/3')
+        self.get('/numbers/3')
+        self.version = 2
+        self.get('/numbers/3')
+        self.assertEquals(self.calls, 2)
+
+    def test_timeout(self):
+        cache = MemoryCache(default_timeout=10)
+        now = [1000.0]
+        cache.clock = lambda: now[0]
+        self.make_app(cache)
+        self.get('/numbers/3')
+        now[0] += 9
+        self.get('/numbers/3')
+        self.assertEquals(self.calls, 1)
+        now[0] += 1
+        self.get('/numbers/3')
+        self.assertEquals(self.calls, 2)
+
+    def test_eviction(self):
+        cache = MemoryCache(max_entries=2)
+        self.make_app(cache)
+        for count in (1, 2, 3, 1):
+            self.get('/numbers/{0}'.format(count))
+        self.assertEquals(self.calls, 4)
+        self.assertEquals(len(cache), 2)
+
+        cache = MemoryCache(max_bytes=40)
+        self.make_app(cache)
+        for count in (1, 2, 3, 100, 100):
+            self.get('/numbers/{0}'.format(count))
+        self.assertEquals(self.calls, 5)
+        self.assertEquals(len(cache), 2)
+        self.assertTrue(cache.size <= 40)
+
+    def test_backend(self):
+        class DictCache(dict):
+            def set(self, key, value, timeout=None):
+                self[key] = value
+
+        cache = DictCache()
+        self.make_app(cache, etag=True)
+        etag = self.get('/numbers/3').headers['ETag']
+        response = self.get('/numbers/3')
+        self.assertEquals(loads(response.data), {'numbers': [0, 1, 2]})
+        self.assertEquals(response.headers['ETag'], etag)
+        self.assertEquals(
+            self.get('/numbers/3', **{'If-None-Match': etag}).status_code,
+            304
+        )
+        self.assertEquals(self.calls, 1)
+        self.assertEquals(len(cache), 1)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = []
+        self.histogram = MetricsHistogram()
+        add_metrics_hook(self.metrics.append)
+        add_metrics_hook(self.histogram)
+
+        app = flask.Flask(__name__)
+
+        @app.route('/people', methods=['POST'])
+        @api(json, protobuf(receives=Person, sends=Person))
+        def people():
+            return flask.request.data_dict
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        remove_metrics_hook(self.metrics.append)
+        remove_metrics_hook(self.histogram)
+
+    def post(self):
+        person = Person(id=1, name="Jim")
+        return self.client.post(
+            '/people',
+            data=person.SerializeToString(),
+            headers={
+                "Content-Type": "application/x-protobuf",
+                "Accept": "application/json",
+            }
+        )
+
+    def test_metrics(self):
+        response = self.post()
+        metrics, = self.metrics
+        self.assertEquals(metrics.endpoint, 'people')
+        self.assertEquals(metrics.request_mimetype, 'application/x-protobuf')
+        self.assertEquals(metrics.response_mimetype, 'application/json')
+        self.assertEquals(metrics.request_size, len(
+            Person(id=1, name="Jim").SerializeToString()))
+        self.assertEquals(metrics.response_size, len(response.data))
+        self.assertEquals(metrics.status_code, 200)
+        self.assertEquals(list(metrics.timings), [
+            'negotiate', 'decode', 'convert', 'view', 'encode', 'response'
+        ])
+        self.assertAlmostEquals(sum(metrics.timings.values()), metrics.total)
+
+    def test_aborted_request(self):
+        response = self.client.post(
+            '/people',
+            data='not a protobuf message',
+            headers={
+                "Content-Type": "application/x-protobuf",
+                "Accept": "application/json",
+            }
+        )
+        self.assertEquals(response.status_code, 400)
+        metrics, = self.metrics
+        self.assertEquals(metrics.status_code, 400)
+        self.assertEquals(metrics.request_mimetype, 'application/x-protobuf')
+        self.assertIsNone(metrics.response_mimetype)
+        self.assertEquals(self.histogram.snapshot()['people']['responses'], [
+            {'mimetype': None, 'status': 400, 'count': 1}
+        ])
+
+    def test_histogram(self):
+        self.post()
+        self.post()
+        snapshot = self.histogram.snapshot()['people']
+        self.assertEquals(snapshot['phases']['view']['count'], 2)
+        self.assertEquals(
+            snapshot['phases']['view']['buckets'][float('inf')], 2)
+        self.assertEquals(snapshot['responses'], [
+            {'mimetype': 'application/json', 'status': 200, 'count': 2}
+        ])
+        self.assertEquals(snapshot['request_bytes']['count'], 2)
+
+        text = self.histogram.prometheus_response().data
+        self.assertIn(
+            'pbj_phase_seconds_count{endpoint="people",phase="view"} 2', text)
+        self.assertIn(
+            'pbj_phase_seconds_bucket{endpoint="people",le="+Inf",'
+            'phase="decode"} 2',
+            text
+        )
+        self.assertIn(
+            'pbj_responses_total{endpoint="people",'
+            'mimetype="application/json",status="200"} 2',
+            text
+        )
+
+
+class TestOffload(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = OffloadPool(1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def make_app(self, offload_min_size=0):
+        app = flask.Flask(__name__)
+        options = {'offload': self.pool, 'offload_min_size': offload_min_size}
+
+        @app.route('/village', methods=['POST'])
+        @api(
+            JsonCodec(**options),
+            protobuf(receives=Village, sends=Village, **options)
+        )
+        def village():
+            self.assertIsInstance(flask.request.data_dict, dict)
+            return flask.request.data_dict
+
+        return app.test_client()
+
+    def post(self, client, data, mimetype):
+        return client.post('/village', data=data, headers={
+            "Content-Type": mimetype,
+            "Accept": mimetype,
+        })
+
+    def test_protobuf(self):
+        village = Village(numbers=range(100))
+        village.people.add(id=1, name="Jim")
+        response = self.post(
+            self.make_app(),
+            village.SerializeToString(),
+            "application/x-protobuf"
+        )
+        self.assertEquals(response.data, village.SerializeToString())
+
+    def test_json(self):
+        data = {'people': [{'id': 1, 'name': 'Jim'}], 'numbers': range(100)}
+        response = self.post(self.make_app(), dumps(data), "application/json")
+        self.assertEquals(loads(response.data), data)
+
+    def test_malformed(self):
+        client = self.make_app()
+        for data, mimetype in (('{"people": [', "application/json"),
+                               ('\x0a\xff', "application/x-protobuf")):
+            self.assertEquals(self.post(client, data, mimetype).status_code,
+                              400)
+
+    def test_small_messages_are_inline(self):
+        pool = OffloadPool(1)
+        codec = protobuf(sends=Village, offload=pool, offload_min_size=1024)
+        response, _, _ = codec.make_response({'numbers': [1, 2]}, 200, {})
+        self.assertEquals(
+            response.data,
+            Village(numbers=[1, 2]).SerializeToString()
+        )
+        self.assertIsNone(pool.pool)
+
+    def test_started_by_extension(self):
+        pool = OffloadPool(1)
+        app = flask.Flask(__name__)
+
+        @app.route('/village')
+        @api(JsonCodec(offload=pool), protobuf(sends=Village, offload=pool))
+        def village():
+            return {}
+
+        self.assertIsNone(pool.pool)
+        Pbj(app)
+        self.assertIsNotNone(pool.pool)
+        pool.close()
+
+
+class TestFieldMask(unittest.TestCase):
+    village = {
+        'people': [
+            {'id': 1, 'name': 'Jim', 'email': 'jim@example.com'},
+            {'id': 2, 'name': 'Bob'},
+        ],
+        'numbers': [1, 2, 3],
+    }
+
+    def make_app(self):
+        app = flask.Flask(__name__)
+
+        @app.route('/village')
+        @api(json, protobuf(sends=Village), field_mask=True)
+        def village():
+            self.field_mask = flask.request.field_mask
+            return self.village
+
+        @app.route('/message')
+        @api(json, protobuf(sends=Village), field_mask=True)
+        def message():
+            village = Village()
+            copy_dict_to_pb(village, self.village)
+            return village
+
+        @app.route('/missing')
+        @api(json, protobuf(sends=Village), field_mask=True)
+        def missing():
+            return {'people': [{'name': 'Jim'}]}, 404
+
+        return app.test_client()
+
+    def test_compile(self):
+        self.assertEquals(
+            compile_field_mask('numbers, people.name,people.id,,'),
+            {'numbers': None, 'people': {'name': None, 'id': None}}
+        )
+        self.assertEquals(compile_field_mask('people.name,people'),
+                          {'people': None})
+        self.assertEquals(compile_field_mask('people,people.name'),
+                          {'people': None})
+        self.assertIs(compile_field_mask('people'),
+                      compile_field_mask('people'))
+
+    def test_json(self):
+        client = self.make_app()
+        response = client.get('/village?fields=people.name', headers={
+            "Accept": "application/json",
+        })
+        self.assertEquals(loads(response.data),
+                          {'people': [{'name': 'Jim'}, {'name': 'Bob'}]})
+        self.assertEquals(self.field_mask, {'people': {'name': None}})
+
+        response = client.get('/village', headers={
+            "Accept": "application/json",
+            "X-Field-Mask": "numbers",
+        })
+        self.assertEquals(loads(response.data), {'numbers': [1, 2, 3]})
+
+        response = client.get('/village', headers={
+            "Accept": "application/json",
+        })
+        self.assertEquals(loads(response.data), self.village)
+        self.assertIsNone(self.field_mask)
+
+    def test_protobuf(self):
+        # Required fields may be pruned
+        expected = Village()
+        for name in ('Jim', 'Bob'):
+            expected.people.add().name = name
+        client = self.make_app()
+        for path in ('/village', '/message'):
+            response = client.get(
+                path + '?fields=people.name',
+                headers={"Accept": "application/x-protobuf"}
+            )
+            village = Village()
+            village.ParseFromString(response.data)
+            self.assertEquals(village, expected)
+
+    def test_unmasked_error(self):
+        # Only masked responses may leave out required fields
+        response = self.make_app().get(
+            '/missing?fields=people.name',
+            headers={"Accept": "application/x-protobuf"}
+        )
+        self.assertEquals(response.status_code, 500)
+
+    def test_message(self):
+        village = Village()
+        copy_dict_to_pb(village, self.village)
+        masked = apply_field_mask(compile_field_mask('people.id'), village)
+        self.assertEquals([person.id for person in masked.people], [1, 2])
+        self.assertFalse(masked.people[0].HasField('name'))
+        self.assertEquals(len(masked.numbers), 0)
+
+
+class SchemalessCodecTests(object):
+    """
+        Tests shared by the MessagePack and CBOR codecs.
+    """
+    def make_app(self, **options):
+        app = flask.Flask(__name__)
+        Pbj(app)
+        codec = self.codec_class(**options)
+        self.mimetype = codec.mimetype
+
+        @app.route('/people', methods=['POST'])
+        @api(json, codec)
+        def people():
+            self.message = flask.request.message
+            data = flask.request.data_dict
+            return {'id': data['id'], 'name': data['name']}
+
+        @app.route('/village')
+        @api(codec)
+        def village():
+            village = Village(numbers=[1, 2])
+            village.people.add(id=1, name='Jim')
+            return village
+
+        @app.route('/forward', methods=['POST'])
+        @api(json, codec, lazy=True)
+        def forward():
+            return flask.request.raw_message
+
+        return app.test_client()
+
+    def post(self, client, data, path='/people',
+             content_type=None, accept=None):
+        return client.post(path, data=data, headers={
+            "Content-Type": content_type or self.mimetype,
+            "Accept": accept or self.mimetype,
+        })
+
+    def test_round_trip(self):
+        client = self.make_app()
+        response = self.post(client, self.dumps({'id': 1, 'name': u'Jim'}))
+        self.assertEquals(response.mimetype, self.mimetype)
+        self.assertEquals(self.loads(response.data), {'id': 1, 'name': 'Jim'})
+        self.assertIsNone(self.message)
+
+        response = self.post(client, self.dumps({'id': 1}))
+        self.assertEquals(response.status_code, 400)
+        response = self.post(client, self.dumps([1, 2]))
+        self.assertEquals(response.status_code, 400)
+        response = self.post(client, '\xc1\xff')
+        self.assertEquals(response.status_code, 400)
+
+    def test_message(self):
+        response = self.make_app().get('/village', headers={
+            "Accept": self.mimetype,
+        })
+        self.assertEquals(self.loads(response.data), {
+            'people': [{'id': 1, 'name': 'Jim'}],
+            'numbers': [1, 2],
+        })
+
+    def test_validation(self):
+        client = self.make_app(receives=Person, sends=Person)
+        response = self.post(client, self.dumps({'id': 1, 'name': u'Jim'}))
+        self.assertEquals(self.message, Person(id=1, name='Jim'))
+        for data in ({'id': 1}, {'id': 'x', 'name': 'Jim'},
+                     {'id': 1, 'name': 'Jim', 'age': 3}):
+            response = self.post(client, self.dumps(data))
+            self.assertEquals(response.status_code, 400)
+
+        with self.assertRaises(EncodeError):
+            with flask.Flask(__name__).test_request_context():
+                self.codec_class(sends=Village).make_response(
+                    {'people': 1}, 200, {})
+
+    def test_forward_json(self):
+        response = self.post(
+            self.make_app(),
+            dumps({'numbers': [1, 2]}),
+            path='/forward',
+            content_type='application/json'
+        )
+        self.assertEquals(self.loads(response.data), {'numbers': [1, 2]})
+
+    def test_bytes(self):
+        codec = self.codec_class()
+        data = codec.loads(codec.dumps({
+            'name': 'Jim',
+            'data': '\xff',
+            'parts': [bytearray('\xff\x00'), memoryview('\xfe')],
+        }))
+        self.assertEquals(data, {
+            'name': u'Jim',
+            'data': '\xff',
+            'parts': ['\xff\x00', '\xfe'],
+        })
+        self.assertIsInstance(data.keys()[0], unicode)
+        self.assertIsInstance(data['name'], unicode)
+
+        app = flask.Flask(__name__)
+
+        @app.route('/message')
+        @api(self.codec_class())
+        def blob_message():
+            return Blob(data='\xff\x00', parts=['ok'], name=u'blob')
+
+        @app.route('/dict')
+        @api(protobuf(sends=Blob), self.codec_class())
+        def blob_dict():
+            return {'data': '\xff\x00', 'parts': ['ok'], 'name': 'blob'}
+
+        # Bytes fields are sent as bytes even when they are UTF-8
+        for path in ('/message', '/dict'):
+            response = app.test_client().get(path, headers={
+                "Accept": codec.mimetype,
+            })
+            data = self.loads(response.data)
+            self.assertEquals(data,
+                              {'data': '\xff\x00', 'parts': ['ok'],
+                               'name': u'blob'})
+            self.assertIsInstance(data['parts'][0], str)
+            self.assertIsInstance(data['name'], unicode)
+
+    def make_series_app(self, **options):
+        app = flask.Flask(__name__)
+        codec = self.codec_class(receives=Person)
+        self.mimetype = codec.mimetype
+
+        @app.route('/people', methods=['GET', 'POST'])
+        @api(json, codec, **options)
+        def people():
+            if options.get('stream_request'):
+                return {'names': [
+                    item['name'] for item in flask.request.data_iter
+                ]}
+            if options.get('batch'):
+                return {'name': flask.request.data_dict['name']}
+            return (
+                {'id': index, 'name': name}
+                for index, name in enumerate(['Jim', 'Bob'])
+            )
+
+        return app.test_client()
+
+    def test_stream_response(self):
+        response = self.make_series_app().get('/people', headers={
+            "Accept": self.mimetype,
+        })
+        codec = self.codec_class()
+        self.assertEquals(
+            response.data,
+            codec.dumps({'id': 0, 'name': 'Jim'}) +
+            codec.dumps({'id': 1, 'name': 'Bob'})
+        )
+
+    def test_stream_request(self):
+        client = self.make_series_app(stream_request=True)
+        body = (self.dumps({'id': 1, 'name': u'Jim'}) +
+                self.dumps({'id': 2, 'name': u'Bob'}))
+        response = self.post(client, body)
+        self.assertEquals(self.loads(response.data),
+                          {'names': ['Jim', 'Bob']})
+        for data in (body[:-1], self.dumps({'id': 3})):
+            self.assertEquals(self.post(client, data).status_code, 400)
+
+    def test_batch(self):
+        client = self.make_series_app(batch=True)
+        response = self.post(client, self.dumps([
+            {'id': 1, 'name': u'Jim'},
+            {'id': 2, 'name': u'Bob'},
+        ]))
+        self.assertEquals(self.loads(response.data), {'results': [
+            {'status': 200, 'body': {'name': 'Jim'}},
+            {'status': 200, 'body': {'name': 'Bob'}},
+        ]})
+        response = self.post(client, self.dumps([{'id': 1}]))
+        self.assertEquals(response.status_code, 400)
+
+
+@unittest.skipIf(msgpack is None, "msgpack is not installed")
+class TestMsgpack(SchemalessCodecTests, unittest.TestCase):
+    codec_class = MsgpackCodec
+
+    def dumps(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+@unittest.skipIf(cbor2 is None, "cbor2 is not installed")
+class TestCbor(SchemalessCodecTests, unittest.TestCase):
+    codec_class = CborCodec
+
+    def dumps(self, data):
+        return cbor2.dumps(data)
+
+    def loads(self, data):
+        return cbor2.loads(data)
+
+
+def make_field(name, number, field_type, cpp_type, label=1, default=None,
+               enum_type=None, message='Paint'):
+    return FieldDescriptor(
+        name=name, full_name=message + '.' + name, index=number - 1,
+        number=number, type=field_type, cpp_type=cpp_type, label=label,
+        has_default_value=False, default_value=default, message_type=None,
+        enum_type=enum_type, containing_type=None, is_extension=False,
+        extension_scope=None, options=None
+    )
+
+
+# Built by hand as test_pb was generated by protoc 2.5, which has no oneofs:
+# message Paint {
+#     enum Color { RED = 1; GREEN = 2; }
+#     optional Color color = 1;
+#     repeated Color colors = 2;
+#     optional bytes data = 3;
+#     oneof size { int32 width = 4; string label = 5; }
+# }
+_COLOR = EnumDescriptor(
+    name='Color', full_name='Paint.Color', filename=None, file=None,
+    values=[
+        EnumValueDescriptor(name='RED', index=0, number=1, options=None,
+                            type=None),
+        EnumValueDescriptor(name='GREEN', index=1, number=2, options=None,
+                            type=None),
+    ],
+    containing_type=None, options=None
+)
+_PAINT = Descriptor(
+    name='Paint', full_name='Paint', filename=None, containing_type=None,
+    fields=[
+        make_field('color', 1, 14, 8, default=1, enum_type=_COLOR),
+        make_field('colors', 2, 14, 8, label=3, default=[],
+                   enum_type=_COLOR),
+        make_field('data', 3, 12, 9, default=''),
+        make_field('width', 4, 5, 1, default=0),
+        make_field('label', 5, 9, 9, default=u''),
+    ],
+    nested_types=[], enum_types=[_COLOR], extensions=[]
+)
+
+
+class Oneof(object):
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+
+_PAINT.oneofs = [Oneof('size', [_PAINT.fields_by_name['width'],
+                                _PAINT.fields_by_name['label']])]
+Paint = GeneratedProtocolMessageType('Paint', (Message,), {
+    'DESCRIPTOR': _PAINT
+})
+
+
+class TestFieldTypes(unittest.TestCase):
+    def test_enums(self):
+        paint = Paint()
+        copy_dict_to_pb(paint, {'color': 'GREEN', 'colors': ['RED', 2]})
+        self.assertEquals(paint.color, 2)
+        self.assertEquals(list(paint.colors), [1, 2])
+        self.assertEquals(copy_pb_to_dict({}, paint),
+                          {'color': 2, 'colors': [1, 2]})
+        self.assertEquals(copy_pb_to_dict({}, paint, enums_as_names=True),
+                          {'color': 'GREEN', 'colors': ['RED', 'GREEN']})
+        with self.assertRaises(ValueError):
+            copy_dict_to_pb(Paint(), {'color': 'BLUE'})
+
+    def test_transcode_enums(self):
+        data = json_to_protobuf(Paint, dumps({'color': 'GREEN'}))
+        self.assertEquals(data, Paint(color=2).SerializeToString())
+        self.assertEquals(loads(protobuf_to_json(Paint, data)), {'color': 2})
+        self.assertEquals(
+            loads(protobuf_to_json(Paint, data, enums_as_names=True)),
+            {'color': 'GREEN'}
+        )
+
+    def test_lazy_enums(self):
+        plan = compile_message_plan(Paint.DESCRIPTOR, enums_as_names=True)
+        lazy = LazyMessageDict(plan, Paint(color=1, colors=[2]))
+        self.assertEquals(lazy['color'], 'RED')
+        self.assertEquals(lazy.to_dict(), {'color': 'RED', 'colors': ['GREEN']})
+
+    def test_bytes(self):
+        for value in ('\xff\x00', u'/wA=', bytearray('\xff\x00'),
+                      memoryview('\xff\x00'), buffer('\xff\x00')):
+            paint = Paint()
+            copy_dict_to_pb(paint, {'data': value})
+            self.assertEquals(paint.data, '\xff\x00')
+        with self.assertRaises(ValueError):
+            copy_dict_to_pb(Paint(), {'data': u'\xe9'})
+
+    def test_oneofs(self):
+        paint = Paint()
+        copy_dict_to_pb(paint, {'width': 3, 'label': None})
+        self.assertEquals(paint.width, 3)
+        with self.assertRaises(ValueError):
+            copy_dict_to_pb(Paint(), {'width': 3, 'label': 'big'})
+        with self.assertRaises(ValueError):
+            json_to_protobuf(Paint, dumps({'width': 3, 'label': 'big'}))
+
+
+# message Series {
+#     repeated double values = 1;
+#     repeated sint64 deltas = 2;
+#     repeated fixed32 counts = 3;
+#     optional string name = 4;
+# }
+Series = GeneratedProtocolMessageType('Series', (Message,), {
+    'DESCRIPTOR': Descriptor(
+        name='Series', full_name='Series', filename=None,
+        containing_type=None,
+        fields=[
+            make_field('values', 1, 1, 5, label=3, default=[],
+                       message='Series'),
+            make_field('deltas', 2, 18, 2, label=3, default=[],
+                       message='Series'),
+            make_field('counts', 3, 7, 3, label=3, default=[],
+                       message='Series'),
+            make_field('name', 4, 9, 9, default=u'', message='Series'),
+        ],
+        nested_types=[], enum_types=[], extensions=[]
+    )
+})
+
+
+class TestArrays(unittest.TestCase):
+    def parse(self, codec, body):
+        request = flask.Flask(__name__).test_request_context(
+            data=body,
+            method='POST'
+        )
+        with request:
+            return codec.parse_request_data(flask.request)
+
+    def test_unpacked_request(self):
+        village = Village(numbers=[1, -2, 3])
+        village.people.add(id=1, name='Jim')
+        codec = protobuf(receives=Village, arrays=True)
+        data = self.parse(codec, village.SerializeToString())
+        self.assertEquals(data['numbers'], array.array('i', [1, -2, 3]))
+        self.assertEquals(data['people'], [{'id': 1, 'name': 'Jim'}])
+
+    def test_round_trip(self):
+        codec = protobuf(receives=Series, sends=Series, arrays=True)
+        data = {
+            'values': array.array('d', [1.5, -2.0]),
+            'deltas': [-1, 5, 1 << 40],
+            'counts': array.array('I', [7, 0]),
+            'name': 'load',
+        }
+        response, _, _ = codec.make_response(data, 200, {})
+        series = Series()
+        series.ParseFromString(response.data)
+        self.assertEquals(list(series.values), [1.5, -2.0])
+        self.assertEquals(list(series.deltas), [-1, 5, 1 << 40])
+        self.assertEquals(list(series.counts), [7, 0])
+        self.assertEquals(series.name, 'load')
+
+        parsed = self.parse(codec, response.data)
+        self.assertEquals(parsed['values'], data['values'])
+        self.assertEquals(parsed['deltas'].tolist(), data['deltas'])
+        self.assertEquals(parsed['counts'], data['counts'])
+        self.assertEquals(parsed['name'], 'load')
+        self.assertEquals(self.parse(codec, series.SerializeToString()),
+                          parsed)
+
+    def test_offload(self):
+        pool = OffloadPool(1)
+        codec = protobuf(receives=Series, arrays=True, offload=pool,
+                         offload_min_size=0)
+        data = self.parse(codec, Series(values=[1.5]).SerializeToString())
+        self.assertEquals(data['values'], array.array('d', [1.5]))
+        self.assertIsNone(pool.pool)
+
+    def test_invalid_values(self):
+        codec = protobuf(sends=Village, arrays=True)
+        for numbers in ([1 << 40], ['one']):
+            with self.assertRaises(EncodeError):
+                codec.make_response({'numbers': numbers}, 200, {})
+        with self.assertRaises(BadRequest):
+            self.parse(protobuf(receives=Series, arrays=True), '\x0a\x03abc')
+
+    def test_truncated_fixed_value(self):
+        # An unpacked fixed32 counts value cut short
+        with self.assertRaises(BadRequest):
+            self.parse(protobuf(receives=Series, arrays=True), '\x1d\x01')
+
+    def test_other_codecs(self):
+        data = {'numbers': array.array('i', [1, 2])}
+        response, _, _ = json.make_response(data, 200, {})
+        self.assertEquals(loads(response.data), {'numbers': [1, 2]})
+        response, _, _ = protobuf(sends=Village).make_response(data, 200, {})
+        self.assertEquals(response.data,
+                          Village(numbers=[1, 2]).SerializeToString())
+
+
+# message Blob {
+#     required bytes data = 1;
+#     repeated bytes parts = 2;
+#     optional string name = 3;
+# }
+Blob = GeneratedProtocolMessageType('Blob', (Message,), {
+    'DESCRIPTOR': Descriptor(
+        name='Blob', full_name='Blob', filename=None, containing_type=None,
+        fields=[
+            make_field('data', 1, 12, 9, label=2, default='',
+                       message='Blob'),
+            make_field('parts', 2, 12, 9, label=3, default=[],
+                       message='Blob'),
+            make_field('name', 3, 9, 9, default=u'', message='Blob'),
+        ],
+        nested_types=[], enum_types=[], extensions=[]
+    )
+})
+
+
+class TestZeroCopy(unittest.TestCase):
+    def test_request_views(self):
+        blob = Blob(data='a' * 10, parts=['b', 'c'], name=u'thumb')
+        pool = OffloadPool(1)
+        # Requests of any size are split in the request thread
+        for options in ({}, {'offload': pool, 'offload_min_size': 0}):
+            codec = protobuf(receives=Blob, zero_copy=True, **options)
+            with flask.Flask(__name__).test_request_context(
+                data=blob.SerializeToString(),
+                method='POST'
+            ):
+                data = codec.parse_request_data(flask.request)
+            self.assertIsInstance(data['data'], memoryview)
+            self.assertEquals(data['data'].tobytes(), 'a' * 10)
+            self.assertEquals([part.tobytes() for part in data['parts']],
+                              ['b', 'c'])
+            self.assertEquals(data['name'], 'thumb')
+        self.assertIsNone(pool.pool)
+
+    def test_scattered_response(self):
+        codec = protobuf(sends=Blob, zero_copy=True)
+        large = 'x' * ZERO_COPY_MIN_SIZE
+        response, _, _ = codec.make_response(
+            {'data': large, 'parts': ['small', large], 'name': 'big'},
+            200,
+            {}
+        )
+        self.assertTrue(response.is_sequence)
+        self.assertIn(large, response.response)
+        self.assertEquals(response.content_length, len(response.get_data()))
+        blob = Blob()
+        blob.ParseFromString(response.get_data())
+        self.assertEquals(blob.data, large)
+        self.assertEquals(list(blob.parts), ['small', large])
+        self.assertEquals(blob.name, 'big')
+
+        response, _, _ = codec.make_response({'data': 'small'}, 200, {})
+        self.assertEquals(response.get_data(),
+                          Blob(data='small').SerializeToString())
+
+    def test_echo(self):
+        app = flask.Flask(__name__)
+
+        @app.route('/blobs', methods=['POST'])
+        @api(json, protobuf(receives=Blob, sends=Blob, zero_copy=True))
+        def blobs():
+            return flask.request.data_dict
+
+        blob = Blob(data='y' * ZERO_COPY_MIN_SIZE, name=u'echo')
+        client = app.test_client()
+        for mimetype in ("application/x-protobuf", "application/json"):
+            response = client.post('/blobs', data=blob.SerializeToString(),
+                                   headers={
+                                       "Content-Type":
+                                           "application/x-protobuf",
+                                       "Accept": mimetype,
+                                   })
+            self.assertEquals(response.status_code, 200)
+            if mimetype == "application/json":
+                self.assertEquals(loads(response.data)['data'],
+                                  b64encode('y' * ZERO_COPY_MIN_SIZE))
+            else:
+                echoed = Blob()
+                echoed.ParseFromString(response.data)
+                self.assertEquals(echoed, blob)
+
+    def test_binary_to_json(self):
+        blob = Blob(data='\xff\x00\x80', parts=['\xfe', 'ok'])
+        expected = {
+            'data': b64encode('\xff\x00\x80'),
+            'parts': [b64encode('\xfe'), b64encode('ok')],
+        }
+        for zero_copy in (False, True):
+            app = flask.Flask(__name__)
+
+            @app.route('/blobs', methods=['POST'])
+            @api(json, protobuf(receives=Blob, sends=Blob,
+                                zero_copy=zero_copy))
+            def blobs():
+                data = flask.request.data_dict
+                if not zero_copy:
+                    # Request dicts hold bytes as str
+                    self.assertIsInstance(data['data'], str)
+                    hash(data['data'])
+                return data
+
+            response = app.test_client().post(
+                '/blobs',
+                data=blob.SerializeToString(),
+                headers={
+                    "Content-Type": "application/x-protobuf",
+                    "Accept": "application/json",
+                }
+            )
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(loads(response.data), expected)
+
+    def test_binary_etag(self):
+        blob = Blob(data='\xff\x00\x80', parts=['\xfe', 'ok'])
+        app = flask.Flask(__name__)
+
+        @app.route('/dict')
+        @api(json, protobuf(sends=Blob), etag='data')
+        def blob_dict():
+            return {'data': blob.data, 'parts': blob.parts[:]}
+
+        @app.route('/message')
+        @api(json, protobuf(sends=Blob), etag='data')
+        def blob_message():
+            return blob
+
+        client = app.test_client()
+        for path in ('/dict', '/message'):
+            response = client.get(path, headers={
+                "Accept": "application/json",
+            })
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(loads(response.data)['data'],
+                              b64encode('\xff\x00\x80'))
+            self.assertIsNotNone(response.headers.get('ETag'))
+
+            response = client.get(path, headers={
+                "Accept": "application/x-protobuf",
+            })
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(Blob.FromString(response.data), blob)
+            self.assertIsNotNone(response.headers.get('ETag'))
+
+
+class TestValidation(unittest.TestCase):
+    def make_app(self, **options):
+        app = flask.Flask(__name__)
+        self.calls = 0
+
+        @app.route('/people', methods=['POST'])
+        @api(json, protobuf(receives=Person, sends=Person), validate=True,
+             **options)
+        def people():
+            self.calls += 1
+            return flask.request.data_dict
+
+        return app.test_client()
+
+    def post(self, client, data, mimetype="application/json"):
+        return client.post('/people', data=data, headers={
+            "Content-Type": mimetype,
+            "Accept": "application/json",
+        })
+
+    def test_dict_errors(self):
+        validator = compile_validator(Village.DESCRIPTOR)
+        self.assertItemsEqual(validator.errors({
+            'people': [{'id': 1, 'name': 'Jim'}, {'id': 'x'}],
+            'numbers': [2 ** 31, True],
+            'mayor': 'Jim',
+        }), [
+            ('people[1].name', 'is required'),
+            ('people[1].id', 'expected an integer'),
+            ('numbers[0]', 'is out of range for int32'),
+            ('numbers[1]', 'expected an integer'),
+            ('mayor', 'is not a field of Village'),
+        ])
+        self.assertEquals(validator.errors({'people': {}, 'numbers': None}),
+                          [('people', 'expected a list')])
+        self.assertItemsEqual(
+            compile_validator(Paint.DESCRIPTOR).errors({
+                'color': 'BLUE',
+                'colors': [1, 3],
+                'data': u'not base64!',
+                'width': 1,
+                'label': 'one',
+            }),
+            [
+                ('', 'Paint can not set both width and label of size'),
+                ('color', 'is not a Paint.Color value'),
+                ('colors[1]', 'is not a Paint.Color value'),
+                ('data', 'is not base64 encoded'),
+            ]
+        )
+
+    def test_invalid_json(self):
+        response = self.post(self.make_app(), dumps({'id': 'one'}))
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(loads(response.data), {'errors': [
+            {'field': 'name', 'message': 'is required'},
+            {'field': 'id', 'message': 'expected an integer'},
+        ]})
+        self.assertEquals(self.calls, 0)
+
+    def test_invalid_protobuf(self):
+        response = self.post(
+            self.make_app(),
+            Person(id=1).SerializePartialToString(),
+            "application/x-protobuf"
+        )
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(loads(response.data), {'errors': [
+            {'field': 'name', 'message': 'is required'},
+        ]})
+        self.assertEquals(self.calls, 0)
+
+    def test_valid(self):
+        response = self.post(self.make_app(), dumps({'id': 1, 'name': 'Jim'}))
+        self.assertEquals(loads(response.data), {'id': 1, 'name': 'Jim'})
+        self.assertEquals(self.calls, 1)
+
+    def test_validation_errors(self):
+        client = self.make_app(validation_errors=lambda errors: {
+            'message': ', '.join(error.field for error in errors)
+        })
+        response = self.post(client, dumps({}))
+        self.assertEquals(loads(response.data), {'message': 'id, name'})
+
+    def test_batch(self):
+        response = self.post(
+            self.make_app(batch=True),
+            dumps([{'id': 1, 'name': 'Jim'}, {'id': 2}])
+        )
+        self.assertEquals(loads(response.data), {'results': [
+            {'status': 200, 'body': {'id': 1, 'name': 'Jim'}},
+            {'status': 400, 'body': {'errors': [
+                {'field': 'name', 'message': 'is required'},
+            ]}},
+        ]})
+        self.assertEquals(self.calls, 1)
+
+        response = self.post(
+            self.make_app(batch='list'),
+            dumps([{'id': 1, 'name': 'Jim'}, {'id': 2}])
+        )
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(loads(response.data), {'errors': [
+            {'field': '[1].name', 'message': 'is required'},
+        ]})
+        self.assertEquals(self.calls, 0)
+
+    def test_no_errors_type(self):
+        client = self.make_app()
+        for data, mimetype in (
+            (dumps({'id': 'one'}), "application/json"),
+            (Person(id=1).SerializePartialToString(),
+             "application/x-protobuf"),
+        ):
+            response = client.post('/people', data=data, headers={
+                "Content-Type": mimetype,
+                "Accept": "application/x-protobuf",
+            })
+            self.assertEquals(response.status_code, 400)
+            self.assertEquals(response.data, '')
+        self.assertEquals(self.calls, 0)
+
+        response = self.make_app(batch=True).post(
+            '/people',
+            data=dumps([{'id': 2}]),
+            headers={
+                "Content-Type": "application/json",
+                "Accept": "application/x-protobuf",
+            }
+        )
+        self.assertEquals(response.status_code, 200)
+
+    def test_needs_a_message_type(self):
+        with self.assertRaises(ValueError):
+            api(json, validate=True)
+
+
+class TestMessagePool(unittest.TestCase):
+    def test_pool(self):
+        pool = MessagePool(1)
+        person = pool.acquire(Person)
+        person.id = 1
+        pool.release(person)
+        pool.release(Person(id=2))
+        reused = pool.acquire(Person)
+        self.assertIs(reused, person)
+        self.assertFalse(reused.HasField('id'))
+        self.assertIsNot(pool.acquire(Person), person)
+
+    def test_encode(self):
+        codec = protobuf(sends=Village, pool_size=2)
+        for size in (3, 1):
+            response, _, _ = codec.make_response(
+                {'numbers': range(size)}, 200, {}
+            )
+            self.assertEquals(
+                response.data,
+                Village(numbers=range(size)).SerializeToString()
+            )
+        self.assertEquals(len(codec.pool.free_list(Village)), 1)
+
+    def test_request_message_is_reused_after_the_request(self):
+        app = flask.Flask(__name__)
+        Pbj(app)
+        messages = []
+
+        @app.route('/people', methods=['POST'])
+        @api(json, protobuf(receives=Person, sends=Person, pool_size=1))
+        def people():
+            messages.append(flask.request.message)
+            return flask.request.data_dict
+
+        client = app.test_client()
+        for person in (Person(id=1, name='Jim'), Person(id=2, name='Bob')):
+            response = client.post(
+                '/people',
+                data=person.SerializeToString(),
+                headers={
+                    "Content-Type": "application/x-protobuf",
+                    "Accept": "application/json",
+                }
+            )
+            self.assertEquals(loads(response.data),
+                              {'id': person.id, 'name': person.name})
+        self.assertIs(messages[0], messages[1])
+        self.assertFalse(messages[1].HasField('id'))
+
+    def test_sends_only_without_extension(self):
+        app = flask.Flask(__name__)
+        codec = protobuf(sends=Person, pool_size=1)
+
+        @app.route('/person')
+        @api(json, codec)
+        def person():
+            return {'id': 1, 'name': 'Jim'}
+
+        response = app.test_client().get('/person', headers={
+            "Accept": "application/x-protobuf",
+        })
+        self.assertEquals(response.data,
+                          Person(id=1, name='Jim').SerializeToString())
+        self.assertEquals(len(codec.pool.free_list(Person)), 1)
+
+
+class TestExtension(unittest.TestCase):
+    def test_request_class(self):
+        class CustomRequest(flask.Request):
+            pass
+
+        app = flask.Flask(__name__)
+        app.request_class = CustomRequest
+        Pbj(app)
+        self.assertTrue(issubclass(app.request_class, CustomRequest))
+        self.assertTrue(issubclass(app.request_class, PbjRequestMixin))
+        self.assertIs(app.extensions['pbj'].__class__, Pbj)
+        self.assertFalse(issubclass(flask.Flask.request_class,
+                                    PbjRequestMixin))
+        self.assertFalse(issubclass(flask.Flask(__name__).request_class,
+                                    PbjRequestMixin))
+
+    def test_warm(self):
+        app = flask.Flask(__name__)
+        village_api = api(json, protobuf(receives=Village, sends=Village))
+
+        @app.route('/village', methods=['POST'])
+        @village_api
+        def village():
+            return flask.request.data_dict
+
+        @app.route('/plain')
+        def plain():
+            return 'plain'
+
+        pbj = Pbj(app)
+        self.assertEquals(pbj.warmed, ['village'])
+        self.assertTrue(village_api.warmed)
+
+        @app.route('/person')
+        @api(json, protobuf(sends=Person))
+        def person():
+            return {'id': 1, 'name': 'Jim'}
+
+        response = app.test_client().get('/person', headers={
+            "Accept": "application/json",
+        })
+        self.assertEquals(loads(response.data), {'id': 1, 'name': 'Jim'})
+        self.assertEquals(pbj.warmed, ['village', 'person'])
+
+    def test_without_extension(self):
+        app = flask.Flask(__name__)
+
+        @app.route('/people', methods=['POST'])
+        @api(json, protobuf(receives=Person, sends=Person))
+        def people():
+            return flask.request.data_dict
+
+        @app.route('/forward', methods=['POST'])
+        @api(json, protobuf(receives=Person, sends=Person))
+        def forward():
+            return flask.request.raw_message
+
+        person = Person(id=1, name='Jim')
+        client = app.test_client()
+        for path in ('/people', '/forward'):
+            response = client.post(
+                path,
+                data=person.SerializeToString(),
+                headers={
+                    "Content-Type": "application/x-protobuf",
+                    "Accept": "application/json",
+                }
+            )
+            self.assertEquals(loads(response.data), {'id': 1, 'name': 'Jim'})
+
+    def test_exports(self):
+        for name in flask_pbj.__all__:
+            self.assertIsNotNone(getattr(flask_pbj, name), name)
+        self.assertEquals('msgpack' in flask_pbj.__all__,
+                          flask_pbj.msgpack is not None)
+        self.assertEquals('cbor' in flask_pbj.__all__,
+                          flask_pbj.cbor is not None)
+
+    def test_needs_extension(self):
+        views = [
+            api(json, protobuf(receives=Person), lazy=True)(lambda: {}),
+            api(json, protobuf(receives=Person, pool_size=1))(lambda: {}),
+        ]
+        for view in views:
+            with flask.Flask(__name__).test_request_context(
+                headers={"Accept": "application/json"}
+            ):
+                with self.assertRaises(RuntimeError):
+                    view()
+
 
 if __name__ == "__main__":
     unittest.main()